@@ -0,0 +1,112 @@
+"""Memory and attribute-access benchmark of the slotted device model.
+
+Compares the current MaxThermostat/MaxWindowShutter/MaxRoom classes with the
+plain __dict__ based classes they replaced.
+
+    python -m benchmarks.bench_model [--count N]
+"""
+import argparse
+import gc
+import json
+import timeit
+import tracemalloc
+
+from maxcube.room import MaxRoom
+from maxcube.thermostat import MaxThermostat
+from maxcube.windowshutter import MaxWindowShutter
+
+LEGACY_KEYS = ['rf_address', 'type', 'room_id', 'firmware', 'serial', 'name', 'initialized',
+               'battery', 'comfort_temperature', 'eco_temperature', 'max_temperature',
+               'min_temperature', 'target_temperature', 'actual_temperature',
+               'locked', 'mode', 'vacation_until', 'temperature_offset', 'window_open_temperature',
+               'window_open_duration', 'boost_duration', 'boost_valve_position', 'decalcification',
+               'max_valve_setting', 'valve_offset', 'valve_position', 'programme']
+
+
+class LegacyDevice(object):
+    def __init__(self):
+        self.rf_address = None
+        self.type = None
+        self.room_id = None
+        self.firmware = None
+        self.serial = None
+        self.name = None
+        self.initialized = None
+        self.battery = None
+
+    def to_dict(self):
+        data = {}
+        for key in LEGACY_KEYS:
+            data[key] = getattr(self, key, None)
+        data['rf_address'] = self.rf_address
+        return data
+
+
+class LegacyThermostat(LegacyDevice):
+    def __init__(self):
+        super(LegacyThermostat, self).__init__()
+        for key in LEGACY_KEYS[8:]:
+            setattr(self, key, None)
+
+
+class LegacyWindowShutter(LegacyDevice):
+    def __init__(self):
+        super(LegacyWindowShutter, self).__init__()
+        self.is_open = None
+
+
+class LegacyRoom(object):
+    def __init__(self):
+        self.id = None
+        self.name = None
+        self.group_rf_address = None
+        self.has_changed = False
+        self.day_comfort = False
+
+
+def measure_memory(factory, count):
+    gc.collect()
+    tracemalloc.start()
+    objects = [factory() for _ in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size / float(count)
+
+
+def measure_access(factory, number):
+    device = factory()
+    device.target_temperature = 21.5
+    return min(timeit.repeat(lambda: device.target_temperature, number=number, repeat=5)) / number
+
+
+def measure_to_dict(factory, number):
+    device = factory()
+    return min(timeit.repeat(device.to_dict, number=number, repeat=5)) / number
+
+
+def run(count=10000, number=100000):
+    results = {}
+    for name, legacy, current in [('thermostat', LegacyThermostat, MaxThermostat),
+                                  ('window_shutter', LegacyWindowShutter, MaxWindowShutter),
+                                  ('room', LegacyRoom, MaxRoom)]:
+        results[name] = {
+            'legacy_bytes': measure_memory(legacy, count),
+            'slotted_bytes': measure_memory(current, count),
+        }
+    for name, legacy, current in [('thermostat', LegacyThermostat, MaxThermostat)]:
+        results[name]['legacy_access_ns'] = measure_access(legacy, number) * 1e9
+        results[name]['slotted_access_ns'] = measure_access(current, number) * 1e9
+    for name, legacy, current in [('thermostat', LegacyThermostat, MaxThermostat),
+                                  ('window_shutter', LegacyWindowShutter, MaxWindowShutter)]:
+        results[name]['legacy_to_dict_us'] = measure_to_dict(legacy, number // 10) * 1e6
+        results[name]['slotted_to_dict_us'] = measure_to_dict(current, number // 10) * 1e6
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the slotted device model')
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.count, args.number), indent=2, sort_keys=True))
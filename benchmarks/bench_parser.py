@@ -0,0 +1,94 @@
+"""Parser throughput and peak memory on synthetic installations.
+
+Measures MaxCube.parse_response (full greeting), parse_l_message (unchanged
+and fully changed L messages), get_programme and devices_as_json at 10, 100
+and 1000 devices and writes the results as JSON, so runs from different
+releases can be compared.
+
+    python -m benchmarks.bench_parser [--sizes 10 100 1000] [--output results.json]
+"""
+import argparse
+import base64
+import json
+import platform
+import sys
+import time
+import timeit
+import tracemalloc
+
+from maxcube.cube import MaxCube
+from maxcube.generator import SyntheticCube
+from maxcube.programme import get_programme
+
+
+def new_cube(synthetic):
+    cube = MaxCube(None, auto_init=False)
+    cube.parse_response(synthetic.greeting())
+    return cube
+
+
+def per_call(function, number, repeat=5):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def peak_memory(function):
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def bench_size(size, number):
+    synthetic = SyntheticCube(devices=size)
+    greeting = synthetic.greeting()
+    cube = new_cube(synthetic)
+    l_unchanged = synthetic.l_message()
+    changed = []
+    for _ in range(2):
+        synthetic.change(1.0)
+        changed.append(synthetic.l_message())
+    programme = bytes(bytearray(base64.b64decode(synthetic.c_message(synthetic.devices[0]).split(',')[1])))[29:211]
+
+    def parse_greeting():
+        MaxCube(None, auto_init=False).parse_response(greeting)
+
+    def parse_l_changed():
+        cube.parse_l_message(changed[0])
+        cube.parse_l_message(changed[1])
+
+    results = {
+        'devices': size,
+        'greeting_bytes': len(greeting),
+        'parse_response_s': per_call(parse_greeting, number),
+        'parse_l_message_unchanged_s': per_call(lambda: cube.parse_l_message(l_unchanged), number * 10),
+        'parse_l_message_changed_s': per_call(parse_l_changed, number * 5) / 2,
+        'get_programme_s': per_call(lambda: get_programme(programme), number * 10),
+        'devices_as_json_s': per_call(cube.devices_as_json, number),
+        'parse_response_peak_bytes': peak_memory(parse_greeting),
+        'parse_l_message_peak_bytes': peak_memory(parse_l_changed),
+        'devices_as_json_peak_bytes': peak_memory(cube.devices_as_json),
+    }
+    results['parse_response_devices_per_s'] = size / results['parse_response_s']
+    results['parse_l_message_changed_devices_per_s'] = size / results['parse_l_message_changed_s']
+    return results
+
+
+def run(sizes=(10, 100, 1000), number=20):
+    return {
+        'benchmark': 'parser',
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': [bench_size(size, max(number * 10 // size, 1)) for size in sizes],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Max! Cube message parser')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout)
+    args = parser.parse_args()
+    json.dump(run(args.sizes, args.number), args.output, indent=2, sort_keys=True)
+    args.output.write('\n')
@@ -0,0 +1,79 @@
+"""Micro-benchmark of the weekly programme codec.
+
+Compares get_programme and temp_and_time with the binary string
+implementation they replaced, on the 182 byte programme of a C message.
+
+    python -m benchmarks.bench_programme [--number N]
+"""
+import argparse
+import json
+import timeit
+
+from maxcube.generator import SyntheticCube
+from maxcube.programme import DAYS, get_programme, programme_bytes, temp_and_time, to_hex
+
+
+def legacy_get_programme(bits):
+    n = 26
+    programme = {}
+    days = [bits[i:i + n] for i in range(0, len(bits), n)]
+    for j, day in enumerate(days):
+        n = 2
+        settings = [day[i:i + n] for i in range(0, len(day), n)]
+        day_programme = []
+        for setting in settings:
+            word = format(setting[0], "08b") + format(setting[1], "08b")
+            temp = int(word[:7], 2) / 2.0
+            time_mins = int(word[7:], 2) * 5
+            mins = time_mins % 60
+            hours = int((time_mins - mins) / 60)
+            time = "{:02d}:{:02d}".format(hours, mins)
+            day_programme.append({"temp": temp, "until": time})
+            if time == "24:00":
+                break
+        programme[DAYS[j]] = day_programme
+    return programme
+
+
+def legacy_temp_and_time(temp, time):
+    temp = float(temp)
+    assert temp <= 32, "Temp must be 32 or lower"
+    assert temp % 0.5 == 0, "Temp must be increments of 0.5"
+    temp = int(temp * 2)
+    hours, mins = [int(x) for x in time.split(":")]
+    assert mins % 5 == 0, "Time must be a multiple of 5 mins"
+    mins = hours * 60 + mins
+    bits = format(temp, "07b") + format(int(mins / 5), "09b")
+    return to_hex(int(bits, 2))
+
+
+def per_call(function, number, repeat=5):
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def encode_week(encode, programme):
+    for day in DAYS[:7]:
+        for setting in programme[day]:
+            encode(setting['temp'], setting['until'])
+
+
+def run(number=2000):
+    programme = SyntheticCube(devices=1).devices[0].programme
+    data = programme_bytes(programme)
+    assert get_programme(data) == legacy_get_programme(data)
+    results = {
+        'get_programme_s': per_call(lambda: get_programme(data), number),
+        'legacy_get_programme_s': per_call(lambda: legacy_get_programme(data), number),
+        'temp_and_time_week_s': per_call(lambda: encode_week(temp_and_time, programme), number),
+        'legacy_temp_and_time_week_s': per_call(lambda: encode_week(legacy_temp_and_time, programme), number),
+    }
+    results['get_programme_speedup'] = results['legacy_get_programme_s'] / results['get_programme_s']
+    results['temp_and_time_speedup'] = results['legacy_temp_and_time_week_s'] / results['temp_and_time_week_s']
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the weekly programme codec')
+    parser.add_argument('--number', type=int, default=2000)
+    args = parser.parse_args()
+    print(json.dumps(run(args.number), indent=2, sort_keys=True))
@@ -0,0 +1,142 @@
+import logging
+
+from maxcube.device import MAX_DEVICE_MODE_BOOST
+
+logger = logging.getLogger(__name__)
+
+
+class RoomAggregate(object):
+    # Figures of one room as published by maxcubed. Thermostats and wall
+    # thermostats give the target temperature (highest), mode, actual
+    # temperature (lowest), battery (worst) and valve position (highest);
+    # window shutters give is_open (open if any is).
+    __slots__ = ('room_id', 'has_thermostat', 'target_temperature', 'mode', 'actual_temperature',
+                 'battery', 'valve_position', 'is_open', 'valves', 'open_valves', 'valve_sum')
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.has_thermostat = False
+        self.target_temperature = None
+        self.mode = None
+        self.actual_temperature = None
+        self.battery = None
+        self.valve_position = None
+        self.is_open = None
+        # Contribution of the room to the cube wide valve figures
+        self.valves = 0
+        self.open_valves = 0
+        self.valve_sum = 0
+
+    def add_device(self, device):
+        if device.is_thermostat() or device.is_wallthermostat():
+            self.add_thermostat(device)
+        if device.is_windowshutter() and device.is_open is not None:
+            self.is_open = device.is_open if self.is_open is None else max(self.is_open, device.is_open)
+
+    def add_thermostat(self, device):
+        if not self.has_thermostat:
+            self.has_thermostat = True
+            self.target_temperature = device.target_temperature
+            self.mode = device.mode
+        elif device.target_temperature is not None:
+            # None until the first L message, e.g. after a snapshot restore
+            if self.target_temperature is None or device.target_temperature > self.target_temperature:
+                self.target_temperature = device.target_temperature
+                if self.mode != MAX_DEVICE_MODE_BOOST:
+                    self.mode = device.mode
+        if device.mode == MAX_DEVICE_MODE_BOOST:
+            self.mode = device.mode
+
+        if device.actual_temperature is not None:
+            if self.actual_temperature is None:
+                self.actual_temperature = device.actual_temperature
+            else:
+                self.actual_temperature = min(self.actual_temperature, device.actual_temperature)
+
+        if device.battery is not None:
+            self.battery = device.battery if self.battery is None else max(self.battery, device.battery)
+
+        valve_position = getattr(device, 'valve_position', None)
+        if valve_position is not None:
+            self.valves += 1
+            self.valve_sum += valve_position
+            if valve_position > 0:
+                self.open_valves += 1
+            if self.valve_position is None:
+                self.valve_position = valve_position
+            else:
+                self.valve_position = max(self.valve_position, valve_position)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class MaxCubeAggregates(object):
+    # Room and cube wide figures of a MaxCube kept up to date incrementally.
+    # The cube invalidates a room whenever a field of one of its devices or
+    # its set of devices changes; only invalidated rooms are computed again,
+    # on the next read, and their old contribution to the cube wide valve
+    # totals is swapped for the new one. Reading without changes is O(1).
+    def __init__(self, cube):
+        self.cube = cube
+        self.rooms = {}
+        self.dirty = set()
+        self.stale = True
+        self.valves = 0
+        self.open_valves = 0
+        self.valve_sum = 0
+        self.max_valve_position = 0
+
+    def invalidate(self, room_id=None):
+        # Without a room id everything is computed again, e.g. after clear()
+        if room_id is None:
+            self.stale = True
+        else:
+            self.dirty.add(room_id)
+
+    def refresh(self):
+        if self.stale:
+            self.stale = False
+            self.dirty = set(room.id for room in self.cube.rooms)
+            self.rooms = {}
+            self.valves = self.open_valves = self.valve_sum = 0
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        for room_id in dirty:
+            old = self.rooms.pop(room_id, None)
+            if old is not None:
+                self.valves -= old.valves
+                self.open_valves -= old.open_valves
+                self.valve_sum -= old.valve_sum
+            room = self.cube.room_by_id(room_id)
+            if room is None:
+                continue
+            aggregate = RoomAggregate(room_id)
+            for device in self.cube.devices_by_room(room):
+                aggregate.add_device(device)
+            self.rooms[room_id] = aggregate
+            self.valves += aggregate.valves
+            self.open_valves += aggregate.open_valves
+            self.valve_sum += aggregate.valve_sum
+        self.max_valve_position = max([aggregate.valve_position for aggregate in self.rooms.values()
+                                       if aggregate.valve_position is not None] or [0])
+
+    def room(self, room_id):
+        self.refresh()
+        return self.rooms.get(room_id)
+
+    @property
+    def mean_valve_position(self):
+        self.refresh()
+        return self.valve_sum / max(self.valves, 1)
+
+    def totals(self):
+        self.refresh()
+        return {
+            'open_valves': self.open_valves,
+            'max_valve_position': self.max_valve_position,
+            'mean_valve_position': self.valve_sum / max(self.valves, 1),
+            'duty_cycle': self.cube.duty_cycle,
+            'memory_slots': self.cube.memory_slots,
+        }
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+
+from maxcube.connection import GREETING_REPLY, ReconnectBackoff, expected_reply, has_reply, is_reply
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMaxCubeConnection(object):
+    def __init__(self, host, port, timeout=2, backoff=None, metrics=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.backoff = backoff or ReconnectBackoff()
+        self.reconnects = 0
+        self.greeting = None
+        self.metrics = metrics
+        self.lines = None
+        self.text = None
+
+    @property
+    def response(self):
+        if self.text is None and self.lines is not None:
+            self.text = b''.join(self.lines).decode('utf-8')
+        return self.text
+
+    @response.setter
+    def response(self, value):
+        self.text = value
+        self.lines = None
+
+    async def connect(self):
+        async for _ in self.iter_connect():
+            pass
+
+    async def iter_connect(self):
+        # Connects and yields the lines of the greeting as they arrive
+        logger.debug('Connecting to Max! Cube at ' + self.host + ':' + str(self.port))
+        self.close()
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        async for line in self.iter_lines(GREETING_REPLY):
+            yield line
+        if self.metrics is not None:
+            self.metrics.observe_bytes(received=sum(len(line) for line in self.lines))
+
+    async def read_line(self):
+        try:
+            line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        except asyncio.TimeoutError:
+            return None
+        return line or None
+
+    async def iter_lines(self, expected=None):
+        lines = []
+        while True:
+            line = await self.read_line()
+            if line is None:
+                break
+            lines.append(line)
+            yield line
+            if expected is not None and is_reply(line, expected):
+                break
+        self.lines = lines
+        self.text = None
+
+    async def read(self, expected=None):
+        async for _ in self.iter_lines(expected):
+            pass
+
+    def alive(self):
+        return self.writer is not None and not self.reader.at_eof()
+
+    async def reconnect(self):
+        if not self.backoff.ready():
+            raise ConnectionError('Not reconnecting to cube for another %.1fs' % self.backoff.remaining())
+        self.reconnects += 1
+        if self.metrics is not None:
+            self.metrics.observe_reconnect()
+        try:
+            await self.connect()
+            if not has_reply(self.lines, GREETING_REPLY):
+                raise ConnectionError('Incomplete greeting from cube')
+        except (OSError, asyncio.TimeoutError):
+            logger.warning('Reconnect to cube failed, next attempt in %.1fs' % self.backoff.failed())
+            self.close()
+            raise
+        self.backoff.succeeded()
+        self.greeting = self.lines
+        logger.info('Reconnected to cube (%d reconnects)' % self.reconnects)
+
+    def take_greeting(self):
+        greeting, self.greeting = self.greeting, None
+        return greeting
+
+    async def write(self, command):
+        self.writer.write(command.encode('utf-8'))
+        await self.writer.drain()
+
+    async def send(self, command):
+        expected = expected_reply(command)
+        for attempt in range(2):
+            start = time.time()
+            try:
+                if not self.alive():
+                    await self.reconnect()
+                    start = time.time()
+                await self.write(command)
+                await self.read(expected)
+                if expected is not None and not has_reply(self.lines, expected):
+                    raise ConnectionError('No reply from cube')
+                self.observe_command(command, start, True)
+                return True
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.warning('Cube connection failed: %s' % e)
+                self.observe_command(command, start, False)
+                self.close()
+                if not self.backoff.ready():
+                    break
+        return False
+
+    def observe_command(self, command, start, success):
+        if self.metrics is not None:
+            received = sum(len(line) for line in self.lines or ()) if success else 0
+            self.metrics.observe_command(command, time.time() - start, len(command), received, success)
+
+    def close(self):
+        try:
+            if self.writer:
+                self.writer.close()
+        except Exception:
+            logger.debug('Tried disconnecting from cube, caught Exception probably due to stale connection.')
+        self.reader = None
+        self.writer = None
+
+    async def disconnect(self):
+        if self.alive():
+            await self.send('q:\r\n')
+        self.close()
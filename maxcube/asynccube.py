@@ -0,0 +1,120 @@
+import json
+import logging
+from collections import deque
+
+from maxcube.cube import MaxCube
+from maxcube.programmesync import ProgrammeSync
+from maxcube.schema import as_bytes
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMaxCube(MaxCube):
+    # Same model and decoding as MaxCube, but every round-trip to the cube is a
+    # coroutine. Nothing is sent on construction: await init() (or connect()).
+    def __init__(self, connection, snapshot=None, metrics=None, history=None):
+        super(AsyncMaxCube, self).__init__(connection, auto_init=False, snapshot=snapshot, metrics=metrics,
+                                           history=history)
+
+    async def init(self):
+        self.restore_snapshot()
+        await self.connect()
+        await self.update()
+        self.log()
+
+    async def connect(self):
+        async for _ in self.iter_connect():
+            pass
+
+    async def iter_connect(self):
+        hold = self.snapshot is not None or self.topology_digest is not None
+        greeting = []
+        async for line in self.connection.iter_connect():
+            for kind in self.parse_greeting_line(line, greeting, hold):
+                yield kind
+        for kind in self.end_greeting(greeting, hold):
+            yield kind
+        self.publish_changes()
+
+    async def update(self):
+        return await self.send_command('l:\r\n')
+
+    async def send_command(self, command):
+        logger.debug('Sending command: ' + command)
+        if await self.connection.send(command):
+            self.resync()
+            return self.handle_command_response(self.connection_response())
+        else:
+            logger.error('Command failed: Connection error')
+            return False
+
+    async def set_target_temperature(self, thermostat, temperature):
+        if not thermostat.is_thermostat() and not thermostat.is_wallthermostat():
+            logger.error('%s is no (wall-)thermostat!', thermostat.rf_address)
+            return
+
+        await self.set_temperature_mode(thermostat, temperature, thermostat.mode)
+
+    async def set_mode(self, thermostat, mode):
+        if not thermostat.is_thermostat() and not thermostat.is_wallthermostat():
+            logger.error('%s is no (wall-)thermostat!', thermostat.rf_address)
+            return
+
+        await self.set_temperature_mode(thermostat, thermostat.target_temperature, mode)
+
+    async def set_temperature_mode(self, thermostat, temperature, mode):
+        logger.debug('Setting temperature %s and mode %s on %s!', temperature, mode, thermostat.rf_address)
+
+        if not thermostat.is_thermostat() and not thermostat.is_wallthermostat():
+            logger.error('%s is no (wall-)thermostat!', thermostat.rf_address)
+            return True
+
+        command = self.temperature_mode_command(thermostat, temperature, mode)
+        if await self.send_command(command):
+            self.apply_temperature_mode(thermostat, temperature, mode)
+            self.publish_changes()
+            return True
+        return False
+
+    async def set_temperature_modes(self, changes, max_in_flight=8):
+        results = [[thermostat, False] for thermostat, _, _ in changes]
+        pending = deque(self.temperature_mode_commands(changes))
+        in_flight = deque()
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < max_in_flight:
+                    item = pending.popleft()
+                    if not in_flight and not self.connection.alive():
+                        # e.g. the cube closed the connection while it was idle
+                        await self.connection.reconnect()
+                    try:
+                        await self.connection.write(item[1])
+                    except Exception:
+                        logger.warning('Cube connection failed. Trying to reconnect.')
+                        self.fail_in_flight(in_flight)
+                        await self.connection.reconnect()
+                        await self.connection.write(item[1])
+                    in_flight.append(item)
+                await self.connection.read(b'S')
+                if not self.take_temperature_mode_reply(self.connection_response(), in_flight, results):
+                    await self.connection.reconnect()
+                self.resync()
+        except Exception:
+            logger.error('Command failed: Connection error')
+        self.publish_changes()
+        return [tuple(result) for result in results]
+
+    async def set_programme(self, thermostat, day, metadata):
+        command = self.programme_command(thermostat, day, metadata)
+        if command:
+            return await self.send_command(command)
+        else:
+            return True
+
+    async def set_programmes_from_config(self, config_file):
+        sync = ProgrammeSync.from_config(self, json.load(config_file))
+        while not sync.done:
+            if not await self.send_command(sync.next_frame().command):
+                return False
+            sync.frame_sent()
+        return True
@@ -0,0 +1,142 @@
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+try:
+    CONNECTION_ERRORS = (socket.timeout, socket.herror, socket.gaierror, ConnectionError)
+except NameError:
+    # Python 2
+    CONNECTION_ERRORS = (socket.timeout, socket.herror, socket.gaierror)
+
+
+def is_connection_error(error):
+    # socket.error itself (as raised by MaxCubeConnection) or one of its
+    # connection specific subclasses, but not e.g. a missing file
+    if isinstance(error, CONNECTION_ERRORS):
+        return True
+    return type(error) is socket.error and getattr(error, 'filename', None) is None
+
+
+class MaxCommandWorker(object):
+    # Runs requests such as "set the temperature of this room" on a thread of
+    # its own, so callers (e.g. MQTT callbacks) return at once. Requests are
+    # keyed, e.g. by (device, action): a request for a key already waiting
+    # replaces its value, so a burst of changes to the same setting ends up
+    # as one call of handler(key, value). A key is handled once it was left
+    # alone for ``debounce`` seconds; due requests are handled in the order
+    # their keys were first submitted. When the handler fails (returns False
+    # or raises a connection error), that request and the rest of the batch
+    # wait for another ``retry_delay`` seconds, unless a newer value replaced
+    # them meanwhile. A request whose handler raises anything else would fail
+    # again the same way; it is dropped and the batch goes on.
+    def __init__(self, handler, debounce=2.0, retry_delay=None, clock=time.time):
+        self.handler = handler
+        self.debounce = debounce
+        self.retry_delay = debounce if retry_delay is None else retry_delay
+        self.clock = clock
+        # key -> [value, due time]
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.handled = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def __len__(self):
+        with self.condition:
+            return len(self.pending)
+
+    def submit(self, key, value):
+        with self.condition:
+            entry = self.pending.get(key)
+            due = self.clock() + self.debounce
+            if entry is None:
+                self.pending[key] = [value, due]
+            else:
+                entry[0] = value
+                entry[1] = due
+            self.condition.notify()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running:
+                    delay = self.next_delay()
+                    if delay is not None and delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                if not self.running:
+                    return
+                batch = self.take_due()
+            self.handle(batch)
+
+    def next_delay(self):
+        # Seconds until the next request is due, None when there is none
+        if not self.pending:
+            return None
+        return min(due for _, due in self.pending.values()) - self.clock()
+
+    def take_due(self):
+        now = self.clock()
+        batch = [(key, entry[0]) for key, entry in self.pending.items() if entry[1] <= now]
+        for key, _ in batch:
+            del self.pending[key]
+        return batch
+
+    def flush(self):
+        # Handles everything waiting now, without the debounce, on the
+        # calling thread
+        with self.condition:
+            batch = [(key, entry[0]) for key, entry in self.pending.items()]
+            self.pending.clear()
+        return self.handle(batch)
+
+    def handle(self, batch):
+        for position, (key, value) in enumerate(batch):
+            try:
+                success = self.handler(key, value)
+            except Exception as e:
+                if not is_connection_error(e):
+                    logger.exception('Dropping command %r' % (key,))
+                    self.dropped += 1
+                    continue
+                logger.warning('Command %r failed: %s' % (key, e))
+                success = False
+            if success is False:
+                self.failed += 1
+                self.retry(batch[position:])
+                return False
+            self.handled += 1
+        return True
+
+    def retry(self, batch):
+        due = self.clock() + self.retry_delay
+        with self.condition:
+            # Keep the order of the batch ahead of requests submitted since
+            waiting = self.pending
+            self.pending = OrderedDict()
+            for key, value in batch:
+                if key not in waiting:
+                    self.pending[key] = [value, due]
+            self.pending.update(waiting)
+            self.condition.notify()
@@ -1,17 +1,103 @@
+import random
+import select
 import socket
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Message type the cube answers each command with. The greeting sent on connect
+# is a H/M/C.../L burst, so it is complete once the L message has arrived.
+GREETING_REPLY = b'L'
+COMMAND_REPLIES = {
+    'l:': b'L',
+    's:': b'S',
+    'c:': b'C',
+}
+
+
+def expected_reply(command):
+    return COMMAND_REPLIES.get(command[:2])
+
+
+def is_reply(line, expected):
+    # A line cut short by a timeout or a closed socket is no reply
+    return line.lstrip()[:1] == expected and line.endswith(b'\n')
+
+
+def has_reply(lines, expected):
+    return bool(lines) and is_reply(lines[-1], expected)
+
+
+class ReconnectBackoff(object):
+    # Jittered exponential delay between reconnect attempts: after the n-th
+    # failure in a row the next attempt waits between half and all of
+    # initial * 2 ** (n - 1) seconds, capped at maximum.
+    def __init__(self, initial=1, maximum=300, clock=time.time, random=random.random):
+        self.initial = initial
+        self.maximum = maximum
+        self.clock = clock
+        self.random = random
+        self.failures = 0
+        self.retry_at = 0
+
+    def remaining(self):
+        return max(0, self.retry_at - self.clock())
+
+    def ready(self):
+        return self.remaining() == 0
+
+    def failed(self):
+        self.failures += 1
+        delay = min(self.maximum, self.initial * 2 ** (self.failures - 1))
+        delay *= 0.5 + self.random() / 2
+        self.retry_at = self.clock() + delay
+        return delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.retry_at = 0
+
 
 class MaxCubeConnection(object):
-    def __init__(self, host, port):
+    def __init__(self, host, port, timeout=2, buffer_size=4096, backoff=None, metrics=None):
         self.host = host
         self.port = port
+        self.timeout = timeout
         self.socket = None
-        self.response = None
+        self.backoff = backoff or ReconnectBackoff()
+        # Number of times the connection was opened again after a failure
+        self.reconnects = 0
+        # Greeting replayed by the cube on the last reconnect, until taken
+        self.greeting = None
+        # Optional maxcube.metrics.MaxCubeMetrics
+        self.metrics = metrics
+        # Lines of the last reply as received (bytes); response decodes them
+        # to a str only when asked for
+        self.lines = None
+        self.text = None
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.pending = b''
+        self.position = 0
+
+    @property
+    def response(self):
+        if self.text is None and self.lines is not None:
+            self.text = b''.join(self.lines).decode('utf-8')
+        return self.text
+
+    @response.setter
+    def response(self, value):
+        self.text = value
+        self.lines = None
 
     def connect(self):
+        for _ in self.iter_connect():
+            pass
+
+    def iter_connect(self):
+        # Connects and yields the lines of the greeting as they arrive
         logger.debug('Connecting to Max! Cube at ' + self.host + ':' + str(self.port))
         try:
             if self.socket:
@@ -19,46 +105,152 @@ class MaxCubeConnection(object):
         except:
             logger.debug('Tried disconnecting from cube, caught Exception probably due to stale connection.')
 
+        self.pending = b''
+        self.position = 0
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(2)
+        self.socket.settimeout(self.timeout)
         self.socket.connect((self.host, self.port))
-        self.read()
+        return self.iter_greeting()
 
-    def read(self):
-        buffer_size = 4096
-        buffer = bytearray([])
-        more = True
+    def iter_greeting(self):
+        for line in self.iter_lines(GREETING_REPLY):
+            yield line
+        if self.metrics is not None:
+            self.metrics.observe_bytes(received=sum(len(line) for line in self.lines))
 
-        while more:
+    def read_line(self):
+        # Returns the next line including its terminator. A partial line is only
+        # handed out once the cube stops talking (timeout) or closes the socket.
+        # Lines are cut out of the received data by offset; what is left over
+        # is only moved when more data arrives.
+        while True:
+            end = self.pending.find(b'\n', self.position)
+            if end >= 0:
+                line = self.pending[self.position:end + 1]
+                self.position = end + 1
+                return line
             try:
-                tmp = self.socket.recv(buffer_size)
-                more = len(tmp) > 0
-                buffer += tmp
+                size = self.socket.recv_into(self.buffer)
             except socket.timeout:
+                size = 0
+            if size == 0:
+                line = self.pending[self.position:]
+                self.pending = b''
+                self.position = 0
+                return line or None
+            self.pending = self.pending[self.position:] + self.view[:size]
+            self.position = 0
+
+    def iter_lines(self, expected=None):
+        # Yields every line of a reply as soon as it is complete. Without an
+        # expected reply type this reads until the cube goes quiet.
+        lines = []
+        while True:
+            line = self.read_line()
+            if line is None:
                 break
-        self.response = buffer.decode('utf-8')
+            lines.append(line)
+            yield line
+            if expected is not None and is_reply(line, expected):
+                break
+        self.lines = lines
+        self.text = None
 
-    def send(self, command):
-        if not self.socket:
-            self.connect()
+    def read(self, expected=None):
+        for _ in self.iter_lines(expected):
+            pass
+
+    def alive(self):
+        # Cheap check without a round-trip: a socket the cube closed is
+        # readable and reads as end of file. What was received of earlier
+        # replies but not read, e.g. of one cut short by a timeout, is
+        # discarded first so it is neither taken for a sign of life nor for
+        # the next reply.
+        if self.socket is None:
+            return False
+        if self.position < len(self.pending):
+            logger.debug('Discarding %d bytes left over from an earlier reply' % (len(self.pending) - self.position))
+        self.pending = b''
+        self.position = 0
+        try:
+            readable, _, _ = select.select([self.socket], [], [], 0)
+            return not readable or self.socket.recv(1, socket.MSG_PEEK) != b''
+        except (socket.error, ValueError):
+            return False
+
+    def reconnect(self):
+        # Opens a new socket unless still backing off from failed attempts.
+        # The greeting the cube replays on it is kept for take_greeting().
+        if not self.backoff.ready():
+            raise socket.error('Not reconnecting to cube for another %.1fs' % self.backoff.remaining())
+        self.reconnects += 1
+        if self.metrics is not None:
+            self.metrics.observe_reconnect()
         try:
-            self.socket.send(command.encode('utf-8'))
-            self.read()
-            return True
-        except:
-            logger.warning('Cube connection failed. Trying to reconnect.')
             self.connect()
+            if not has_reply(self.lines, GREETING_REPLY):
+                raise socket.error('Incomplete greeting from cube')
+        except socket.error:
+            logger.warning('Reconnect to cube failed, next attempt in %.1fs' % self.backoff.failed())
+            self.close()
+            raise
+        self.backoff.succeeded()
+        self.greeting = self.lines
+        logger.info('Reconnected to cube (%d reconnects)' % self.reconnects)
+
+    def take_greeting(self):
+        greeting, self.greeting = self.greeting, None
+        return greeting
+
+    def write(self, command):
+        if not self.socket:
+            self.reconnect()
+        data = command.encode('utf-8')
+        self.socket.sendall(data)
+        if self.metrics is not None:
+            self.metrics.observe_bytes(sent=len(data))
+
+    def send(self, command):
+        # Sends over the open socket and reconnects once if it turns out to be
+        # dead. A command is only successful once its reply has arrived.
+        expected = expected_reply(command)
+        data = command.encode('utf-8')
+        for attempt in range(2):
+            start = time.time()
             try:
-                self.socket.send(command.encode('utf-8'))
-                logger.info('Resend succeeded.')
-                self.read()
+                if not self.alive():
+                    self.reconnect()
+                    start = time.time()
+                self.socket.sendall(data)
+                self.read(expected)
+                if expected is not None and not has_reply(self.lines, expected):
+                    raise socket.error('No reply from cube')
+                self.observe_command(command, start, data, True)
                 return True
-            except:
-                logger.warning('Resend failed.')
-                return False
+            except socket.error as e:
+                logger.warning('Cube connection failed: %s' % e)
+                self.observe_command(command, start, data, False)
+                self.close()
+                if not self.backoff.ready():
+                    break
+        return False
+
+    def observe_command(self, command, start, data, success):
+        if self.metrics is not None:
+            received = sum(len(line) for line in self.lines or ()) if success else 0
+            self.metrics.observe_command(command, time.time() - start, len(data), received, success)
+
+    def close(self):
+        try:
+            if self.socket:
+                self.socket.close()
+        except socket.error:
+            logger.debug('Tried disconnecting from cube, caught Exception probably due to stale connection.')
+        self.socket = None
+        self.pending = b''
+        self.position = 0
 
     def disconnect(self):
-        if self.socket:
+        if self.alive():
             self.send('q:\r\n')
-            self.socket.close()
-        self.socket = None
+        self.close()
@@ -1,7 +1,11 @@
 import json
 import base64
+import binascii
 import struct
+import time
+from collections import deque
 
+from maxcube.aggregate import MaxCubeAggregates
 from maxcube.device import \
     MaxDevice, \
     MAX_CUBE, \
@@ -14,7 +18,29 @@ from maxcube.device import \
     MAX_DEVICE_MODE_VACATION, \
     MAX_DEVICE_BATTERY_OK, \
     MAX_DEVICE_BATTERY_LOW
+from maxcube.programme import \
+    DAYS, \
+    get_programme, \
+    n_from_day_of_week, \
+    day_of_week_from_n, \
+    temp_and_time, \
+    to_hex
+from maxcube.events import MaxChangeEvent, deliver
+from maxcube.programmesync import ProgrammeSync
 from maxcube.room import MaxRoom
+from maxcube.snapshot import greeting_digest
+from maxcube.schema import \
+    C_DECODERS, \
+    CONFIG_DECODERS, \
+    L_DECODERS, \
+    H_SCHEMA, \
+    S_SCHEMA, \
+    M_ROOM, \
+    M_DEVICE, \
+    as_bytes, \
+    as_text, \
+    decode_tokens, \
+    read_record
 from maxcube.thermostat import MaxThermostat
 from maxcube.wallthermostat import MaxWallThermostat
 from maxcube.windowshutter import MaxWindowShutter
@@ -27,15 +53,19 @@ UNKNOWN = "00"
 RF_FLAG_IS_ROOM = "04"
 RF_FLAG_IS_DEVICE = "00"
 RF_NULL_ADDRESS = "000000"
-DAYS = ['saturday', 'sunday', 'monday', 'tuesday', 'wednesday', 'thursday',
-        'friday', 'saturday', 'sunday']
 MODES = ['auto', 'manu', 'vacation', 'boost']
 
 
 class MaxCube(MaxDevice):
-    def __init__(self, connection):
+    def __init__(self, connection, auto_init=True, snapshot=None, metrics=None, history=None):
         super(MaxCube, self).__init__()
         self.connection = connection
+        # Optional maxcube.snapshot.MaxCubeSnapshot to warm start from
+        self.snapshot = snapshot
+        # Optional maxcube.metrics.MaxCubeMetrics, usually shared with the connection
+        self.metrics = metrics
+        # Optional maxcube.history.MaxCubeHistory sampled on every L message
+        self.history = history
         self.name = 'Cube'
         self.type = MAX_CUBE
         self.firmware_version = None
@@ -44,14 +74,41 @@ class MaxCube(MaxDevice):
         self.memory_slots = None
         self.devices = []
         self.rooms = []
-        self.init()
+        self.device_index = {}
+        self.room_index = {}
+        self.room_devices = {}
+        # Raw L sub-record last decoded for each device, used to skip unchanged ones
+        self.l_records = {}
+        self.l_records_decoded = 0
+        self.l_records_skipped = 0
+        # Digest of the M and C messages of the last greeting decoded in full
+        self.topology_digest = None
+        # Rooms and devices listed so far by a greeting split into several M messages
+        self.m_listed = None
+        self.listeners = []
+        self.pending_changes = []
+        # Room and cube wide figures, e.g. the highest valve position
+        self.aggregates = MaxCubeAggregates(self)
+        if auto_init:
+            self.init()
 
     def init(self):
+        self.restore_snapshot()
         self.connect() # get H and C message
         self.update()  # get L message
         self.log()
 
+    def restore_snapshot(self):
+        # Only into a cube without devices: init() may run again, e.g. after
+        # the first connect failed, and the devices restored the first time
+        # may already have been handed out
+        if self.snapshot is not None and not self.devices:
+            self.snapshot.restore(self)
+
     def log(self):
+        if not logger.isEnabledFor(logging.INFO):
+            # Formatting every device would also decode all lazy config fields
+            return
         logger.info('Cube (rf=%s, firmware=%s)' % (self.rf_address, self.firmware_version))
         for room in self.rooms:
             logger.info('Room (id=%s, name=%s, group_rf=%s' % (room.id, room.name, room.group_rf_address))
@@ -133,9 +190,115 @@ class MaxCube(MaxDevice):
                     logger.info('Device (rf=%s, name=%s' % (device.rf_address, device.name))
 
     def connect(self):
+        for _ in self.iter_connect():
+            pass
+
+    def iter_connect(self):
+        # Connects and decodes the greeting while it arrives, yielding the
+        # type of every message parsed (b'H', b'M', b'C' or b'L'). Rooms and
+        # devices are known once b'M' was yielded, before the C messages are in.
+        # When they may be known already (from the snapshot or an earlier
+        # greeting) the M and C messages are held back until the greeting is
+        # complete and only decoded if they changed.
+        hold = self.snapshot is not None or self.topology_digest is not None
+        greeting = []
+        for line in self.greeting_lines():
+            for kind in self.parse_greeting_line(line, greeting, hold):
+                yield kind
+        for kind in self.end_greeting(greeting, hold):
+            yield kind
+        self.publish_changes()
+
+    def greeting_lines(self):
+        # A connection that overrides connect() but not iter_connect(), such
+        # as a test double, hands the greeting over as a whole once connected
+        for connection_type in type(self.connection).__mro__:
+            if 'iter_connect' in vars(connection_type):
+                return self.connection.iter_connect()
+            if 'connect' in vars(connection_type):
+                break
         self.connection.connect()
-        response = self.connection.response
-        self.parse_response(response)
+        response = self.connection_response()
+        if response is None:
+            return []
+        if not isinstance(response, (list, tuple)):
+            response = as_bytes(response).split(b'\n')
+        return response
+
+    def parse_greeting_line(self, line, greeting, hold):
+        # Returns the types of the messages decoded
+        kind = as_bytes(line).strip()[:1]
+        if not kind:
+            return []
+        kinds = []
+        if kind in (b'H', b'M', b'C'):
+            greeting.append(line)
+            if hold and kind != b'H':
+                return []
+        elif kind == b'L':
+            kinds = self.end_greeting(greeting, hold)
+        self.parse_response([line])
+        self.publish_changes()
+        return kinds + [kind]
+
+    def end_greeting(self, greeting, hold):
+        # Called once the H, M and C messages of a greeting are in
+        if not greeting:
+            return []
+        lines = list(greeting)
+        del greeting[:]
+        if not hold:
+            self.topology_digest = greeting_digest(lines)
+            return []
+        self.parse_greeting(lines)
+        return [kind for kind in (as_bytes(line).strip()[:1] for line in lines) if kind != b'H']
+
+    def connection_response(self):
+        # The reply as the lines received when the connection keeps them,
+        # which saves decoding it to a str first
+        lines = getattr(self.connection, 'lines', None)
+        if lines is not None:
+            return lines
+        return self.connection.response
+
+    def parse_greeting(self, response):
+        if self.snapshot is None:
+            self.parse_response(self.filter_greeting(response))
+            return
+        # M and C messages the snapshot already holds are not decoded again
+        self.parse_response(self.snapshot.filter(self, response))
+        self.snapshot.save(self)
+
+    def filter_greeting(self, response):
+        # A greeting replayed on reconnect usually describes the same rooms
+        # and devices; its M and C messages are then not decoded again
+        if response is None:
+            return response
+        if not isinstance(response, (list, tuple)):
+            response = as_bytes(response).split(b'\n')
+        digest = greeting_digest(response)
+        if digest == self.topology_digest:
+            return [line for line in response if as_bytes(line).lstrip()[:1] not in (b'M', b'C')]
+        self.topology_digest = digest
+        return response
+
+    def resync(self):
+        # Decodes the greeting the connection received when it had to
+        # reconnect, which also brings back any state missed meanwhile
+        greeting = self.connection.take_greeting()
+        if greeting:
+            self.parse_greeting(greeting)
+
+    def clear(self):
+        # Forgets all rooms and devices, e.g. when connected to another cube
+        self.devices = []
+        self.rooms = []
+        self.device_index = {}
+        self.room_index = {}
+        self.room_devices = {}
+        self.l_records = {}
+        self.topology_digest = None
+        self.aggregates.invalidate()
 
     def update(self):
         return self.send_command('l:\r\n')
@@ -143,34 +306,77 @@ class MaxCube(MaxDevice):
     def send_command(self, command):
         logger.debug('Sending command: ' + command)
         if self.connection.send(command):
-            logger.debug('Command response: ' + self.connection.response)
-            response = self.connection.response
-            self.parse_response(response)
-            if self.command_result > 0:
-                logger.error('Command failed: Result=%s, Duty Cycle=%s, Memory Slots=%s' % (self.command_result, self.duty_cycle, self.memory_slots))
-                return False
-            return True
+            self.resync()
+            return self.handle_command_response(self.connection_response())
         else:
             logger.error('Command failed: Connection error')
             return False
 
+    def handle_command_response(self, response):
+        logger.debug('Command response: %s', response)
+        self.command_result = None
+        self.parse_response(response)
+        self.publish_changes()
+        if self.command_result is not None and self.command_result > 0:
+            logger.error('Command failed: Result=%s, Duty Cycle=%s, Memory Slots=%s' % (self.command_result, self.duty_cycle, self.memory_slots))
+            return False
+        return True
+
+    def subscribe(self, listener):
+        # listener receives one list of MaxChangeEvent per connect, update or
+        # command: it is either called with the list or, if it has a put()
+        # method (e.g. queue.Queue), the list is put on it.
+        self.listeners.append(listener)
+        return listener
+
+    def unsubscribe(self, listener):
+        self.listeners.remove(listener)
+
+    def publish_changes(self):
+        if not self.pending_changes:
+            return
+        events = self.pending_changes
+        self.pending_changes = []
+        for listener in list(self.listeners):
+            deliver(listener, events)
+
     def get_devices(self):
         return self.devices
 
     def device_by_rf(self, rf):
-        for device in self.devices:
-            if device.rf_address == rf:
-                return device
-        return None
+        return self.device_index.get(rf)
 
     def devices_by_room(self, room):
-        devices = []
+        return list(self.room_devices.get(room.id, ()))
 
-        for device in self.devices:
-            if device.room_id == room.id:
-                devices.append(device)
+    def add_device(self, device):
+        self.devices.append(device)
+        self.device_index[device.rf_address] = device
+        self.room_devices.setdefault(device.room_id, []).append(device)
+        self.aggregates.invalidate(device.room_id)
 
-        return devices
+    def move_device(self, device, room_id):
+        old_value = device.room_id
+        if old_value == room_id:
+            return
+        devices = self.room_devices.get(old_value)
+        if devices and device in devices:
+            devices.remove(device)
+        self.set_room_changed(old_value)
+        device.room_id = room_id
+        self.room_devices.setdefault(room_id, []).append(device)
+        self.set_room_changed(room_id)
+        if self.listeners:
+            self.pending_changes.append(MaxChangeEvent(device, 'room_id', old_value, room_id, time.time()))
+
+    def remove_device(self, device):
+        self.devices.remove(device)
+        self.device_index.pop(device.rf_address, None)
+        self.forget_l_record(device)
+        devices = self.room_devices.get(device.room_id)
+        if devices and device in devices:
+            devices.remove(device)
+        self.aggregates.invalidate(device.room_id)
 
     def group_device_by_room(self, room):
         return self.device_by_rf(room.group_rf_address)
@@ -179,203 +385,188 @@ class MaxCube(MaxDevice):
         return self.rooms
 
     def room_by_id(self, id):
-        for room in self.rooms:
-            if room.id == id:
-                return room
-        return None
+        return self.room_index.get(id)
+
+    def add_room(self, room):
+        self.rooms.append(room)
+        self.room_index[room.id] = room
+        self.aggregates.invalidate(room.id)
+
+    def remove_room(self, room):
+        self.rooms.remove(room)
+        self.room_index.pop(room.id, None)
+        self.aggregates.invalidate(room.id)
 
     def parse_response(self, response):
-        try:
-            lines = str.split(str(response), '\n')
-        except:
-            lines = str.split(response, '\n')
+        # response is a str, bytes or a list of lines as read by the connection.
+        # Everything stays bytes until a field is decoded.
+        if response is None:
+            return
+        if isinstance(response, (list, tuple)):
+            lines = response
+        else:
+            lines = as_bytes(response).split(b'\n')
 
         for line in lines:
-            line = line.strip()
-            if line and len(line) > 8:
-                if line[:1] == 'C':
-                    self.parse_c_message(line.strip())
-                elif line[:1] == 'H':
-                    self.parse_h_message(line.strip())
-                elif line[:1] == 'L':
-                    self.parse_l_message(line.strip())
-                elif line[:1] == 'M':
-                    self.parse_m_message(line.strip())
-                elif line[:1] == 'S':
-                    self.parse_s_message(line.strip())
-                else:
-                    logger.warning(line[:1] + '-Message not handled by parser: ' + message)
+            line = as_bytes(line).strip()
+            if len(line) > 8:
+                if self.metrics is None:
+                    self.parse_message(line)
+                    continue
+                start = time.time()
+                self.parse_message(line)
+                self.metrics.observe_parse(as_text(line[:1]), time.time() - start)
+
+    def parse_message(self, line):
+        kind = line[:1]
+        if kind == b'C':
+            self.parse_c_message(line)
+        elif kind == b'H':
+            self.parse_h_message(line)
+        elif kind == b'L':
+            self.parse_l_message(line)
+        elif kind == b'M':
+            self.parse_m_message(line)
+        elif kind == b'S':
+            self.parse_s_message(line)
+        else:
+            logger.warning('%s-Message not handled by parser: %s', as_text(kind), as_text(line))
 
     def parse_c_message(self, message):
-        logger.debug('Parsing c_message: ' + message)
-        device_rf_address = message[1:].split(',')[0][1:].upper()
-        data = bytearray(base64.b64decode(message[2:].split(',')[1]))
-
-        length = data[0]
-        rf_address = self.to_hex_string(data[1: 3])
-        device_type = data[4]
+        message = as_bytes(message)
+        logger.debug('Parsing c_message: %s', message)
+        comma = message.find(b',')
+        device_rf_address = message[2:comma].decode('ascii').upper()
 
         device = self.device_by_rf(device_rf_address)
 
         if device:
-            self.set_device_room_id(device, data[5])
-            self.set_device_firmware(device, str(data[6] >> 4).zfill(2) + '.' + str(data[6] & 0x0F).zfill(2))
-            self.set_device_serial(device, data[8:17].decode('utf-8'))
-
-        # Thermostat or Wall Thermostat
-        if device and (device.is_thermostat() or device.is_wallthermostat()):
-            self.set_device_comfort_temperature(device, data[18] / 2.0)
-            self.set_device_eco_temperature(device, data[19] / 2.0)
-            self.set_device_max_temperature(device, data[20] / 2.0)
-            self.set_device_min_temperature(device, data[21] / 2.0)
-            self.set_device_programme(device, get_programme(data[29:210]))
-
-        # Thermostat
-        if device and device.is_thermostat():
-            self.set_device_temperature_offset(device, (data[22] / 2.0) - 3.5)
-            self.set_device_window_open_temperature(device, data[23] / 2.0)
-            self.set_device_window_open_duration(device, data[24] * 5)
-            boost_duration = (data[25] & 0xE0) >> 5
-            if boost_duration == 7:
-                self.set_device_boost_duration(device, 60)
-            else:
-                self.set_device_boost_duration(device, boost_duration * 5)
-            self.set_device_boost_valve_position(device, (data[25] & 0x1F) * 5)
-            self.set_device_decalcification(device, DAYS[(data[26] & 0xE0) >> 1] + ' ' + str(data[26] & 0x1F).zfill(2) + ':00')
-            self.set_device_max_valve_setting(device, data[27] & 0xFF * 100 / 255)
-            self.set_device_valve_offset(device, data[28] & 0xFF * 100 / 255)
+            data = binascii.a2b_base64(memoryview(message)[comma + 1:])
+            self.set_device_fields(device, C_DECODERS, data)
+            self.set_device_config(device, data)
 
     def parse_h_message(self, message):
-        logger.debug('Parsing h_message: ' + message)
-        tokens = message[2:].split(',')
-        self.rf_address = tokens[1]
-        self.firmware_version = (tokens[2][0:2]) + '.' + (tokens[2][2:4])
+        message = as_text(message)
+        logger.debug('Parsing h_message: %s', message)
+        for name, value in decode_tokens(H_SCHEMA, message):
+            setattr(self, name, value)
 
     def parse_m_message(self, message):
-        logger.debug('Parsing m_message: ' + message)
-        data = bytearray(base64.b64decode(message[2:].split(',')[2]))
+        message = as_bytes(message)
+        logger.debug('Parsing m_message: %s', message)
+        index, count, payload = message[2:].split(b',')[:3]
+        data = bytearray(binascii.a2b_base64(payload))
         num_rooms = data[2]
 
+        # Rooms and devices listed by the M messages of this greeting (one
+        # per part), whatever they no longer list was removed from the cube
+        if int(index, 16) == 0 or self.m_listed is None:
+            self.m_listed = (set(), set())
+        room_ids, rf_addresses = self.m_listed
+
         pos = 3
         for _ in range(0, num_rooms):
-            room_id = struct.unpack('bb', data[pos:pos + 2])[0]
-            name_length = struct.unpack('bb', data[pos:pos + 2])[1]
-            pos += 1 + 1
-            name = data[pos:pos + name_length].decode('utf-8')
-            pos += name_length
-            group_rf_address = self.to_hex_string(data[pos: pos + 3])
-            pos += 3
+            record, pos = read_record(M_ROOM, data, pos)
+            room_ids.add(record['id'])
 
-            room = self.room_by_id(room_id)
+            room = self.room_by_id(record['id'])
 
             if not room:
                 room = MaxRoom()
+                room.id = record['id']
+                self.add_room(room)
 
-                if room:
-                    room.id = room_id
-                    self.rooms.append(room)
-
-            if room:
-                room.name = name
-                room.group_rf_address = group_rf_address
+            room.name = record['name']
+            room.group_rf_address = record['group_rf_address']
 
         num_devices = data[pos]
         pos += 1
 
-        for device_idx in range(0, num_devices):
-            device_type = data[pos]
-            device_rf_address = self.to_hex_string(data[pos + 1: pos + 1 + 3])
-            device_serial = data[pos + 4: pos + 14].decode('utf-8')
-            device_name_length = data[pos + 14]
-            device_name = data[pos + 15: pos + 15 + device_name_length].decode('utf-8')
-            room_id = data[pos + 15 + device_name_length]
+        for _ in range(0, num_devices):
+            record, pos = read_record(M_DEVICE, data, pos)
+            device_type = record['type']
+            device_rf_address = record['rf_address']
+            room_id = record['room_id']
+            rf_addresses.add(device_rf_address)
 
             device = self.device_by_rf(device_rf_address)
 
             if not device:
-                if device_type == MAX_THERMOSTAT or device_type == MAX_THERMOSTAT_PLUS:
-                    device = MaxThermostat()
-
-                if device_type == MAX_WINDOW_SHUTTER:
-                    device = MaxWindowShutter()
-
-                if device_type == MAX_WALL_THERMOSTAT:
-                    device = MaxWallThermostat()
+                device = self.create_device(device_type)
 
                 if device:
-                    self.devices.append(device)
+                    device.rf_address = device_rf_address
+                    device.room_id = room_id
+                    self.add_device(device)
 
             if device:
-                device.type = device_type
-                device.rf_address = device_rf_address
-                device.room_id = room_id
-                device.name = device_name
-                device.serial = device_serial
+                self.set_device_type(device, device_type)
+                self.set_device_room_id(device, room_id)
+                self.set_device_name(device, record['name'])
+                self.set_device_serial(device, record['serial'])
+
+        if int(index, 16) + 1 < int(count, 16):
+            return
+        self.m_listed = None
+        for device in [device for device in self.devices if device.rf_address not in rf_addresses]:
+            logger.info('Device %s was removed from the cube' % device.rf_address)
+            self.remove_device(device)
+        for room in [room for room in self.rooms if room.id not in room_ids]:
+            logger.info('Room %s was removed from the cube' % room.id)
+            self.remove_room(room)
 
-            pos += 1 + 3 + 10 + device_name_length + 2
+    def create_device(self, device_type):
+        if device_type == MAX_THERMOSTAT or device_type == MAX_THERMOSTAT_PLUS:
+            return MaxThermostat()
+
+        if device_type == MAX_WINDOW_SHUTTER:
+            return MaxWindowShutter()
+
+        if device_type == MAX_WALL_THERMOSTAT:
+            return MaxWallThermostat()
+
+        return None
 
     def parse_l_message(self, message):
-        logger.debug('Parsing l_message: ' + message)
-        data = bytearray(base64.b64decode(message[2:]))
+        logger.debug('Parsing l_message: %s', message)
+        data = binascii.a2b_base64(memoryview(as_bytes(message))[2:])
+        view = memoryview(data)
         pos = 0
+        now = time.time()
 
         while pos < len(data):
             length = data[pos]
-            device_rf_address = self.to_hex_string(data[pos + 1: pos + 4])
-            flags = data[pos + 5: pos + 7]
-            bits1, bits2 = struct.unpack('BB', flags)
+            device_rf_address = '%02X%02X%02X' % (data[pos + 1], data[pos + 2], data[pos + 3])
 
             device = self.device_by_rf(device_rf_address)
 
             if device:
-                self.set_device_initialized(device, (bits1 & 0x02) >> 1)
-                self.set_device_battery(device, bits2 >> 7)
-
-            # Thermostat or Wall Thermostat
-            if device and (device.is_thermostat() or device.is_wallthermostat()):
-                self.set_device_target_temperature(device, (data[pos + 8] & 0x7F) / 2.0)
-                self.set_device_locked(device, (bits2 & 0x20) >> 5)
-                self.set_device_mode(device, bits2 & 0x03)
-                if device.mode == MAX_DEVICE_MODE_VACATION:
-                    if (data[pos + 11] & 0x01) == 0:
-                        minutes_until = '00'
-                    else:
-                        minutes_until = '30'
-                    self.set_device_vacation_until(device, '20' + str(data[pos + 10] & 0x1F).zfill(2)
-                                                  + '-' + str(((data[pos + 9] & 0xE0) >> 4) + ((data[pos + 10] & 0x40) >> 6)).zfill(2)
-                                                  + '- ' + str(data[pos + 9] & 0x1F).zfill(2)
-                                                  + ' ' + str((data[pos + 11] & 0xFF) >> 1).zfill(2)
-                                                  + ':' + minutes_until)
+                # Decoded from a view into the message, copied only if changed
+                record = view[pos:pos + length + 1]
+                if self.l_records.get(device_rf_address) == record:
+                    self.l_records_skipped += 1
                 else:
-                    self.set_device_vacation_until(device, None)
-
-            # Thermostat
-            if device and device.is_thermostat():
-                if device.mode == MAX_DEVICE_MODE_MANUAL or device.mode == MAX_DEVICE_MODE_AUTOMATIC:
-                    actual_temperature = ((data[pos + 9] & 0xFF) * 256 + (data[pos + 10] & 0xFF)) / 10.0
-                    if actual_temperature != 0:
-                        self.set_device_actual_temperature(device, actual_temperature)
-                else:
-                    self.set_device_actual_temperature(device, None)
-                self.set_device_valve_position(device, data[pos + 7])
-
-            # Wall Thermostat
-            if device and device.is_wallthermostat():
-                self.set_device_actual_temperature(device, (((data[pos + 8] & 0x80) << 1) + data[pos + 12]) / 10.0)
-
-            # Window Shutter
-            if device and device.is_windowshutter():
-                self.set_device_is_open(device, (bits2 & 0x02) >> 1)
+                    self.l_records[device_rf_address] = record.tobytes()
+                    self.l_records_decoded += 1
+                    self.set_device_fields(device, L_DECODERS, record)
+                if self.history is not None:
+                    self.history.record(device, now)
 
             # Advance our pointer to the next submessage
             pos += length + 1
 
+    def forget_l_record(self, device):
+        # Forces the next L message to decode this device again, e.g. after its
+        # state was changed locally by a command.
+        self.l_records.pop(device.rf_address, None)
+
     def parse_s_message(self, message):
-        logger.debug('Parsing s_message: ' + message)
-        tokens = message[2:].split(',')
-        self.duty_cycle = int(tokens[0], 16)
-        self.command_result = int(tokens[1])
-        self.memory_slots = int(tokens[2], 16)
+        message = as_text(message)
+        logger.debug('Parsing s_message: %s', message)
+        for name, value in decode_tokens(S_SCHEMA, message):
+            setattr(self, name, value)
+        if self.metrics is not None:
+            self.metrics.observe_status(self.duty_cycle, self.memory_slots)
 
     def set_target_temperature(self, thermostat, temperature):
         if not thermostat.is_thermostat() and not thermostat.is_wallthermostat():
@@ -398,55 +589,141 @@ class MaxCube(MaxDevice):
             logger.error('%s is no (wall-)thermostat!', thermostat.rf_address)
             return True
 
+        command = self.temperature_mode_command(thermostat, temperature, mode)
+        if self.send_command(command):
+            self.apply_temperature_mode(thermostat, temperature, mode)
+            self.publish_changes()
+            return True
+        return False
+
+    def apply_temperature_mode(self, thermostat, temperature, mode):
+        self.set_device_target_temperature(thermostat, int(temperature * 2) / 2.0)
+        self.set_device_mode(thermostat, mode)
+        self.forget_l_record(thermostat)
+
+    def set_temperature_modes(self, changes, max_in_flight=8):
+        # Sends a list of (thermostat, temperature, mode) changes over the open
+        # connection without waiting for each S reply before writing the next
+        # command, keeping at most ``max_in_flight`` unanswered. The cube
+        # answers in order, so replies are matched to commands first in first
+        # out. Returns [(thermostat, success)] in the order of ``changes``.
+        results = [[thermostat, False] for thermostat, _, _ in changes]
+        pending = deque(self.temperature_mode_commands(changes))
+        in_flight = deque()
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < max_in_flight:
+                    item = pending.popleft()
+                    if not in_flight and not self.connection.alive():
+                        # e.g. the cube closed the connection while it was idle
+                        self.connection.reconnect()
+                    try:
+                        self.connection.write(item[1])
+                    except Exception:
+                        logger.warning('Cube connection failed. Trying to reconnect.')
+                        self.fail_in_flight(in_flight)
+                        self.connection.reconnect()
+                        self.connection.write(item[1])
+                    in_flight.append(item)
+                self.connection.read(b'S')
+                if not self.take_temperature_mode_reply(self.connection_response(), in_flight, results):
+                    self.connection.reconnect()
+                self.resync()
+        except Exception:
+            logger.error('Command failed: Connection error')
+        self.publish_changes()
+        return [tuple(result) for result in results]
+
+    def temperature_mode_commands(self, changes):
+        # (index, command, thermostat, temperature, mode) for every valid change
+        commands = []
+        for index, (thermostat, temperature, mode) in enumerate(changes):
+            if not thermostat.is_thermostat() and not thermostat.is_wallthermostat():
+                logger.error('%s is no (wall-)thermostat!', thermostat.rf_address)
+                continue
+            command = self.temperature_mode_command(thermostat, temperature, mode)
+            commands.append((index, command, thermostat, temperature, mode))
+        return commands
+
+    def take_temperature_mode_reply(self, response, in_flight, results):
+        # Settles the oldest command in flight with its S reply. Without a reply
+        # (timeout or closed connection) the fate of every command in flight is
+        # unknown, so they are all reported as failed and False is returned.
+        self.command_result = None
+        self.parse_response(response)
+        if self.command_result is None:
+            logger.error('Command failed: No reply from cube')
+            self.fail_in_flight(in_flight)
+            return False
+        index, _, thermostat, temperature, mode = in_flight.popleft()
+        if self.command_result > 0:
+            logger.error('Command failed: Result=%s, Duty Cycle=%s, Memory Slots=%s' % (self.command_result, self.duty_cycle, self.memory_slots))
+        else:
+            self.apply_temperature_mode(thermostat, temperature, mode)
+            results[index][1] = True
+        return True
+
+    def fail_in_flight(self, in_flight):
+        for _, _, thermostat, _, _ in in_flight:
+            logger.warning('No reply for command to %s' % thermostat.rf_address)
+        in_flight.clear()
+
+    def temperature_mode_command(self, thermostat, temperature, mode):
         rf_address = thermostat.rf_address
         room = str(thermostat.room_id).zfill(2)
         target_temperature = int(temperature * 2) + (mode << 6)
 
         byte_cmd = '000440000000' + rf_address + room + to_hex(target_temperature)
         logger.debug('Request: ' + byte_cmd)
-        command = 's:' + base64.b64encode(bytearray.fromhex(byte_cmd)).decode('utf-8') + '\r\n'
-        if self.send_command(command):
-            self.set_device_target_temperature(thermostat, int(temperature * 2) / 2.0)
-            self.set_device_mode(thermostat, mode)
-            return True
-        return False
+        return 's:' + base64.b64encode(bytearray.fromhex(byte_cmd)).decode('utf-8') + '\r\n'
 
     def set_programme(self, thermostat, day, metadata):
+        command = self.programme_command(thermostat, day, metadata)
+        if command:
+            return self.send_command(command)
+        else:
+            return True
+
+    def programme_command(self, thermostat, day, metadata):
+        # Returns None when the programme of every addressed device is unchanged
         made_changes = False
-        heat_time_tuples = [
-            (x["temp"], x["until"]) for x in metadata]
-        # pad heat_time_tuples so that there are always seven
-        for _ in range(7 - len(heat_time_tuples)):
-            heat_time_tuples.append((0, "00:00"))
-        command = ""
+        command = None
         if thermostat.is_room():
-            rf_flag = RF_FLAG_IS_ROOM
 #            devices = self.cube.devices_by_room(thermostat)
             devices = [self.device_by_rf(thermostat.group_rf_address)]
         else:
-            rf_flag = RF_FLAG_IS_DEVICE
             devices = [thermostat]
-        command += UNKNOWN + rf_flag + CMD_SET_PROG + RF_NULL_ADDRESS
         for device in devices:
             # compare with current programme
             if device.programme[day] != metadata:
-                command += device.rf_address
-                command += to_hex(device.room_id)
-                command += to_hex(n_from_day_of_week(day))
-                for heat, time in heat_time_tuples:
-                    command += temp_and_time(heat, time)
+                command = self.programme_frame(device, day, metadata, thermostat.is_room())
                 device.programme[day] = metadata
                 logger.debug('Setting program for %s: %s' % (day, metadata))
                 made_changes = True
             else:
                 logger.debug('Skipping program for %s (unchanged)' % (day))
+        if not made_changes:
+            return None
+        return command
+
+    def programme_frame(self, device, day, metadata, room=False):
+        # s: command setting the programme of one day on a device, or with room
+        # set on every thermostat in the room of the device
+        heat_time_tuples = [
+            (x["temp"], x["until"]) for x in metadata]
+        # pad heat_time_tuples so that there are always seven
+        for _ in range(7 - len(heat_time_tuples)):
+            heat_time_tuples.append((0, "00:00"))
+        rf_flag = RF_FLAG_IS_ROOM if room else RF_FLAG_IS_DEVICE
+        command = UNKNOWN + rf_flag + CMD_SET_PROG + RF_NULL_ADDRESS
+        command += device.rf_address
+        command += to_hex(device.room_id)
+        command += to_hex(n_from_day_of_week(day))
+        for heat, time in heat_time_tuples:
+            command += temp_and_time(heat, time)
         logger.debug('Request: ' + command)
-        command = 's:' + base64.b64encode(
+        return 's:' + base64.b64encode(
             bytearray.fromhex(command)).decode('utf-8') + '\r\n'
-        if made_changes:
-            return self.send_command(command)
-        else:
-            return True
 
     def devices_as_json(self):
         devices = []
@@ -455,271 +732,139 @@ class MaxCube(MaxDevice):
         return json.dumps(devices, indent=2)
 
     def set_programmes_from_config(self, config_file):
-        config = json.load(config_file)
-        for device_config in config:
-            device = self.device_by_rf(device_config['rf_address'])
-            programme = device_config['programme']
-            if not programme:
-                # e.g. a wall thermostat
-                continue
-            for day, metadata in programme.items():
-                if not self.set_programme(device, day, metadata):
-                    return False
-        return True
+        # Sends only the days that differ, one frame per room where all its
+        # thermostats get the same programme. Returns False at the first
+        # failed frame; sync.run() picks up from there.
+        sync = ProgrammeSync.from_config(self, json.load(config_file))
+        return sync.run(self.send_command)
 
     @classmethod
     def to_hex_string(cls, address):
         return ''.join('{:02X}'.format(x) for x in address)
 
+    def set_device_fields(self, device, decoders, data):
+        decoder = decoders.get(device.type)
+        if decoder is None:
+            return
+        try:
+            values = decoder.decode(data)
+        except (struct.error, IndexError):
+            logger.warning('Message for device %s too short to decode (%d bytes)' % (device.rf_address, len(data)))
+            return
+        for name, value in values:
+            if name == 'room_id':
+                self.set_device_room_id(device, value)
+            else:
+                self.set_device_field(device, name, value)
+
+    def set_device_field(self, device, name, value):
+        old_value = getattr(device, name)
+        if old_value != value:
+            setattr(device, name, value)
+            self.set_room_changed(device.room_id)
+            if self.listeners:
+                self.pending_changes.append(MaxChangeEvent(device, name, old_value, value, time.time()))
+
+    def set_device_config(self, device, data):
+        # Keeps the C message for the ConfigFields of the device, which decode
+        # it when first read. One 'config' change event stands for all of them.
+        decoder = CONFIG_DECODERS.get(device.type)
+        if decoder is None:
+            return
+        old_value = device.config
+        value = bytes(data)
+        if old_value != value:
+            device.set_config(value, decoder)
+            self.set_room_changed(device.room_id)
+            if self.listeners:
+                self.pending_changes.append(MaxChangeEvent(device, 'config', old_value, value, time.time()))
+
+    def set_room_changed(self, room_id):
+        self.aggregates.invalidate(room_id)
+        room = self.room_by_id(room_id)
+        if room:
+            room.set_changed()
+
     def set_device_room_id(self, device, value):
-        if device.room_id != value:
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed before id update')
-            self.room_id = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed after id update')
-        
+        self.move_device(device, value)
+
     def set_device_rf_address(self, device, value):
         device.rf_address = value
 
     def set_device_type(self, device, value):
-        device.type = value
-
-    def set_device_room_id(self, device, value):
-        device.room_id = value
+        self.set_device_field(device, 'type', value)
 
     def set_device_firmware(self, device, value):
-        device.firmware = value
+        self.set_device_field(device, 'firmware', value)
 
     def set_device_serial(self, device, value):
-        device.serial = value
+        self.set_device_field(device, 'serial', value)
 
     def set_device_name(self, device, value):
-        device.name = value
+        self.set_device_field(device, 'name', value)
 
     def set_device_initialized(self, device, value):
-        if device.initialized != value:
-            device.initialized = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on initialized update')
+        self.set_device_field(device, 'initialized', value)
 
     def set_device_battery(self, device, value):
-        if device.battery != value:
-            device.battery = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on battery update')
+        self.set_device_field(device, 'battery', value)
 
     def set_device_comfort_temperature(self, device, value):
-        if device.comfort_temperature != value:
-            device.comfort_temperature = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on comfort temperature update')
-        
+        self.set_device_field(device, 'comfort_temperature', value)
+
     def set_device_eco_temperature(self, device, value):
-        if device.eco_temperature != value:
-            device.eco_temperature = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on eco temperature update')
+        self.set_device_field(device, 'eco_temperature', value)
 
     def set_device_max_temperature(self, device, value):
-        if device.max_temperature != value:
-            device.max_temperature = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on max temperature update')
+        self.set_device_field(device, 'max_temperature', value)
 
     def set_device_min_temperature(self, device, value):
-        if device.min_temperature != value:
-            device.min_temperature = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on min temperature update')
+        self.set_device_field(device, 'min_temperature', value)
 
     def set_device_programme(self, device, value):
-        if device.programme != value:
-            device.programme = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on program update')
+        self.set_device_field(device, 'programme', value)
 
     def set_device_target_temperature(self, device, value):
-        if device.target_temperature != value:
-            device.target_temperature = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on target temperature update')
+        self.set_device_field(device, 'target_temperature', value)
 
     def set_device_actual_temperature(self, device, value):
-        if device.actual_temperature != value:
-            device.actual_temperature = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on actual temperature update')
+        self.set_device_field(device, 'actual_temperature', value)
 
     def set_device_locked(self, device, value):
-        if device.locked != value:
-            device.locked = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on locked update')
+        self.set_device_field(device, 'locked', value)
 
     def set_device_mode(self, device, value):
-        if device.mode != value:
-            device.mode = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on mode update')
+        self.set_device_field(device, 'mode', value)
 
     def set_device_vacation_until(self, device, value):
-        if device.vacation_until != value:
-            device.vacation_until = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on vacation until update')
+        self.set_device_field(device, 'vacation_until', value)
 
     def set_device_temperature_offset(self, device, value):
-        if device.temperature_offset != value:
-            device.temperature_offset = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on temperature offset update')
+        self.set_device_field(device, 'temperature_offset', value)
 
     def set_device_window_open_temperature(self, device, value):
-        if device.window_open_duration != value:
-            device.window_open_duration = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on window open temperature update')
+        self.set_device_field(device, 'window_open_temperature', value)
 
     def set_device_window_open_duration(self, device, value):
-        if device.window_open_temperature != value:
-            device.window_open_temperature = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on window open duration update')
+        self.set_device_field(device, 'window_open_duration', value)
 
     def set_device_boost_duration(self, device, value):
-        if device.boost_duration != value:
-            device.boost_duration = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on boost duration update')
+        self.set_device_field(device, 'boost_duration', value)
 
     def set_device_boost_valve_position(self, device, value):
-        if device.boost_valve_position != value:
-            device.boost_valve_position = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on boost valve position update')
+        self.set_device_field(device, 'boost_valve_position', value)
 
     def set_device_decalcification(self, device, value):
-        if device.decalcification != value:
-            device.decalcification = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on decalcification update')
+        self.set_device_field(device, 'decalcification', value)
 
     def set_device_max_valve_setting(self, device, value):
-        if device.max_valve_setting != value:
-            device.max_valve_setting = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on max valve setting update')
+        self.set_device_field(device, 'max_valve_setting', value)
 
     def set_device_valve_offset(self, device, value):
-        if device.valve_offset != value:
-            device.valve_offset = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on valve offset update')
+        self.set_device_field(device, 'valve_offset', value)
 
     def set_device_valve_position(self, device, value):
-        if device.valve_position != value:
-            device.valve_position = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on valve position update')
+        self.set_device_field(device, 'valve_position', value)
 
     def set_device_is_open(self, device, value):
-        if device.is_open != value:
-            device.is_open = value
-            try:
-                self.room_by_id(device.room_id).set_changed()
-            except:
-                logger.error('Error while marking room ' + str(device.room_id) + ' changed on window open state update')
-
-def get_programme(bits):
-    n = 26
-    programme = {}
-    days = [bits[i:i + n] for i in range(0, len(bits), n)]
-    for j, day in enumerate(days):
-        n = 2
-        settings = [day[i:i + n] for i in range(0, len(day), n)]
-        day_programme = []
-        for setting in settings:
-            word = format(setting[0], "08b") + format(setting[1], "08b")
-            temp = int(word[:7], 2) / 2.0
-            time_mins = int(word[7:], 2) * 5
-            mins = time_mins % 60
-            hours = int((time_mins - mins) / 60)
-            time = "{:02d}:{:02d}".format(hours, mins)
-            day_programme.append({"temp": temp, "until": time})
-            if time == "24:00":
-                # This appears to flag the end of useable set points
-                break
-        programme[day_of_week_from_n(j)] = day_programme
-    return programme
-
-
-def n_from_day_of_week(day):
-    return DAYS.index(day)
-
-
-def day_of_week_from_n(day):
-    return DAYS[day]
-
-
-def temp_and_time(temp, time):
-    temp = float(temp)
-    assert temp <= 32, "Temp must be 32 or lower"
-    assert temp % 0.5 == 0, "Temp must be increments of 0.5"
-    temp = int(temp * 2)
-    hours, mins = [int(x) for x in time.split(":")]
-    assert mins % 5 == 0, "Time must be a multiple of 5 mins"
-    mins = hours * 60 + mins
-    bits = format(temp, "07b") + format(int(mins/5), "09b")
-    return to_hex(int(bits, 2))
-
-
-def to_hex(value):
-    "Return value as hex word"
-    return format(value, "02x")
+        self.set_device_field(device, 'is_open', value)
@@ -1,4 +1,6 @@
 import json
+import logging
+import struct
 
 
 MAX_CUBE = 0
@@ -16,8 +18,34 @@ MAX_DEVICE_MODE_BOOST = 3
 MAX_DEVICE_BATTERY_OK = 0
 MAX_DEVICE_BATTERY_LOW = 1
 
+logger = logging.getLogger(__name__)
+
+
+class ConfigField(object):
+    # Device attribute decoded from the raw C message (device.config) on first
+    # access instead of on every C message, for the large and rarely read part
+    # of the configuration such as the weekly programme.
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, device, owner):
+        if device is None:
+            return self
+        return device.config_fields().get(self.name)
+
+    def __set__(self, device, value):
+        device.config_fields()[self.name] = value
+
 
 class MaxDevice(object):
+    # Each device class declares only its own attributes in __slots__; FIELDS
+    # is the full, ordered list for the type and is what to_dict() walks.
+    __slots__ = ('rf_address', 'type', 'room_id', 'firmware', 'serial', 'name', 'initialized',
+                 'battery', 'config', 'config_decoder', 'config_values')
+    FIELDS = __slots__[:-3]
+
     def __init__(self):
         self.rf_address = None
         self.type = None
@@ -27,6 +55,10 @@ class MaxDevice(object):
         self.name = None
         self.initialized = None
         self.battery = None
+        # Raw C message, the decoder of its ConfigFields and their values once decoded
+        self.config = None
+        self.config_decoder = None
+        self.config_values = None
 
     def is_thermostat(self):
         return self.type in (MAX_THERMOSTAT, MAX_THERMOSTAT_PLUS)
@@ -40,16 +72,24 @@ class MaxDevice(object):
     def is_room(self):
         return False
 
+    def set_config(self, config, decoder):
+        self.config = config
+        self.config_decoder = decoder
+        self.config_values = None
+
+    def config_fields(self):
+        if self.config_values is None:
+            self.config_values = {}
+            if self.config is not None and self.config_decoder is not None:
+                try:
+                    self.config_values.update(self.config_decoder.decode(self.config))
+                except (struct.error, IndexError):
+                    logger.warning('Configuration of device %s too short to decode (%d bytes)'
+                                   % (self.rf_address, len(self.config)))
+        return self.config_values
+
     def to_dict(self):
         data = {}
-        
-        keys = ['rf_address', 'type', 'room_id', 'firmware', 'serial', 'name', 'initialized',
-                'battery', 'comfort_temperature', 'eco_temperature', 'max_temperature',
-                'min_temperature', 'target_temperature', 'actual_temperature',
-                'locked', 'mode', 'vacation_until', 'temperature_offset', 'window_open_temperature',
-                'window_open_duration', 'boost_duration', 'boost_valve_position', 'decalcification', 
-                'max_valve_setting', 'valve_offset', 'valve_position', 'programme']
-        for key in keys:
-            data[key] = getattr(self, key, None)
-        data['rf_address'] = self.rf_address
+        for key in self.FIELDS:
+            data[key] = getattr(self, key)
         return data
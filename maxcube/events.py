@@ -0,0 +1,18 @@
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+MaxChangeEvent = collections.namedtuple(
+    'MaxChangeEvent', ['device', 'field', 'old_value', 'new_value', 'timestamp'])
+
+
+def deliver(listener, events):
+    # A listener is either a callable taking the batch or a queue-like object
+    try:
+        if hasattr(listener, 'put'):
+            listener.put(events)
+        else:
+            listener(events)
+    except Exception:
+        logger.exception('Change listener %r failed' % (listener,))
@@ -0,0 +1,213 @@
+import base64
+import random
+
+from maxcube.device import \
+    MAX_CUBE, \
+    MAX_THERMOSTAT, \
+    MAX_THERMOSTAT_PLUS, \
+    MAX_WALL_THERMOSTAT, \
+    MAX_WINDOW_SHUTTER, \
+    MAX_PUSH_BUTTON, \
+    MAX_DEVICE_MODE_AUTOMATIC, \
+    MAX_DEVICE_MODE_MANUAL, \
+    MAX_DEVICE_MODE_VACATION, \
+    MAX_DEVICE_MODE_BOOST
+from maxcube.programme import programme_bytes
+
+# Device types a generated room is filled with, in order
+ROOM_LAYOUT = [MAX_THERMOSTAT, MAX_WINDOW_SHUTTER, MAX_WALL_THERMOSTAT, MAX_THERMOSTAT_PLUS,
+               MAX_PUSH_BUTTON]
+DEVICE_NAMES = {
+    MAX_THERMOSTAT: 'Thermostat',
+    MAX_THERMOSTAT_PLUS: 'ThermostatPlus',
+    MAX_WALL_THERMOSTAT: 'WallThermostat',
+    MAX_WINDOW_SHUTTER: 'WindowShutter',
+    MAX_PUSH_BUTTON: 'PushButton',
+}
+# A record count in the M message is a single byte
+MAX_M_ENTRIES = 255
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday']
+WEEKEND = ['saturday', 'sunday']
+
+
+def b64(data):
+    return base64.b64encode(bytes(bytearray(data))).decode('utf-8')
+
+
+def rf_bytes(rf_address):
+    return bytearray.fromhex(rf_address)
+
+
+class SyntheticDevice(object):
+    __slots__ = ('type', 'rf_address', 'serial', 'name', 'room_id', 'battery', 'locked', 'mode',
+                 'target_temperature', 'actual_temperature', 'valve_position', 'is_open',
+                 'comfort_temperature', 'eco_temperature', 'programme')
+
+    def __init__(self, device_type, rf_address, serial, name, room_id):
+        self.type = device_type
+        self.rf_address = rf_address
+        self.serial = serial
+        self.name = name
+        self.room_id = room_id
+        self.battery = 0
+        self.locked = 0
+        self.mode = MAX_DEVICE_MODE_AUTOMATIC
+        self.target_temperature = 17.0
+        self.actual_temperature = 20.0
+        self.valve_position = 0
+        self.is_open = 0
+        self.comfort_temperature = 21.0
+        self.eco_temperature = 17.0
+        self.programme = None
+
+    def has_temperature(self):
+        return self.type in (MAX_THERMOSTAT, MAX_THERMOSTAT_PLUS, MAX_WALL_THERMOSTAT)
+
+
+class SyntheticCube(object):
+    # Builds valid H, M, C, L and S messages for a generated installation of
+    # any size. The device state is plain attributes on SyntheticDevice and can
+    # be changed between calls. Installations with more than 255 rooms or
+    # devices (more than a real cube can hold) are spread over several M
+    # messages, which MaxCube merges.
+    def __init__(self, devices=4, devices_per_room=4, seed=0, rf_address='0b6475', serial='KEQ0566338'):
+        self.random = random.Random(seed)
+        self.rf_address = rf_address
+        self.serial = serial
+        self.duty_cycle = 0
+        self.memory_slots = 0x32
+        self.rooms = []
+        self.devices = []
+        for index in range(devices):
+            room_id = index // devices_per_room + 1
+            if len(self.rooms) < room_id:
+                self.rooms.append((room_id, 'Room %d' % room_id, None))
+            device_type = ROOM_LAYOUT[index % devices_per_room % len(ROOM_LAYOUT)]
+            device = SyntheticDevice(device_type, '%06X' % (0x100000 + index), 'KEQ%07d' % index,
+                                     '%s %d' % (DEVICE_NAMES[device_type], index), room_id)
+            self.randomize(device)
+            self.devices.append(device)
+        self.rooms = [(room_id, name, self.room_group(room_id)) for room_id, name, _ in self.rooms]
+
+    def room_group(self, room_id):
+        for device in self.devices:
+            if device.room_id == room_id and device.has_temperature():
+                return device.rf_address
+        return '000000'
+
+    def randomize(self, device):
+        device.mode = self.random.choice([MAX_DEVICE_MODE_AUTOMATIC, MAX_DEVICE_MODE_MANUAL])
+        device.target_temperature = self.random.randint(10, 50) / 2.0
+        device.actual_temperature = self.random.randint(150, 250) / 10.0
+        device.valve_position = self.random.randint(0, 100)
+        device.is_open = self.random.randint(0, 1)
+        if device.has_temperature():
+            wake = self.random.randint(60, 90) * 5
+            home = self.random.randint(200, 230) * 5
+            device.programme = {}
+            for day in WEEKDAYS + WEEKEND:
+                device.programme[day] = [
+                    {'temp': device.eco_temperature, 'until': '%02d:%02d' % (wake // 60, wake % 60)},
+                    {'temp': device.comfort_temperature, 'until': '%02d:%02d' % (home // 60, home % 60)},
+                    {'temp': device.eco_temperature, 'until': '24:00'},
+                ]
+
+    def change(self, fraction=0.1):
+        # Randomizes the live state of ``fraction`` of the devices
+        count = int(len(self.devices) * fraction)
+        for device in self.random.sample(self.devices, count):
+            device.actual_temperature = self.random.randint(150, 250) / 10.0
+            device.valve_position = self.random.randint(0, 100)
+            device.is_open = 1 - device.is_open
+
+    def device_by_rf(self, rf_address):
+        rf_address = rf_address.upper()
+        for device in self.devices:
+            if device.rf_address == rf_address:
+                return device
+        return None
+
+    def h_message(self):
+        return 'H:%s,%s,0113,00000000,74b7b6f7,%02x,%02x,0f0c19,1527,03,0000' % (
+            self.serial, self.rf_address, self.duty_cycle, self.memory_slots)
+
+    def m_messages(self):
+        messages = []
+        step = MAX_M_ENTRIES
+        parts = max((len(self.devices) + step - 1) // step, (len(self.rooms) + step - 1) // step, 1)
+        for part in range(parts):
+            rooms = self.rooms[part * step:(part + 1) * step]
+            devices = self.devices[part * step:(part + 1) * step]
+            data = bytearray([0x56, 0x02, len(rooms)])
+            for room_id, name, group_rf_address in rooms:
+                name = name.encode('utf-8')
+                data += bytearray([room_id, len(name)]) + name + rf_bytes(group_rf_address)
+            data.append(len(devices))
+            for device in devices:
+                name = device.name.encode('utf-8')
+                data.append(device.type)
+                data += rf_bytes(device.rf_address) + device.serial.encode('utf-8')
+                data += bytearray([len(name)]) + name + bytearray([device.room_id])
+            data.append(0x01)
+            messages.append('M:%02x,%02x,%s' % (part, parts, b64(data)))
+        return messages
+
+    def c_message(self, device):
+        data = bytearray([0, 0, 0, 0, device.type, device.room_id, 0x10, 0xFF])
+        data[1:4] = rf_bytes(device.rf_address)
+        data += device.serial.encode('utf-8')
+        if device.has_temperature():
+            data += bytearray([int(device.comfort_temperature * 2), int(device.eco_temperature * 2),
+                               61, 9])
+        if device.type in (MAX_THERMOSTAT, MAX_THERMOSTAT_PLUS):
+            # offset, window open temperature/duration, boost, decalcification, max valve, valve offset
+            data += bytearray([7, 24, 3, 0x30, 0x0C, 0xFF, 0x00])
+        if device.has_temperature():
+            data += programme_bytes(device.programme)
+        if device.type == MAX_WALL_THERMOSTAT:
+            data += bytearray([0x07, 0x18, 0x30])
+        data[0] = len(data) - 1
+        return 'C:%s,%s' % (device.rf_address.lower(), b64(data))
+
+    def c_messages(self):
+        return [self.c_message(device) for device in self.devices]
+
+    def l_record(self, device):
+        flags = 0x18 | (device.battery << 7)
+        if device.type == MAX_WINDOW_SHUTTER:
+            flags = 0x10 | (device.battery << 7) | (device.is_open << 1)
+            return rf_bytes(device.rf_address), bytearray([0x00, 0x12, flags])
+        flags |= (device.locked << 5) | device.mode
+        target = int(device.target_temperature * 2)
+        actual = int(round(device.actual_temperature * 10))
+        if device.mode == MAX_DEVICE_MODE_VACATION:
+            until = bytearray([0x9C, 0x2B, 0x2A])
+        else:
+            until = bytearray([actual >> 8, actual & 0xFF, 0x00])
+        if device.type == MAX_WALL_THERMOSTAT:
+            target |= (actual & 0x100) >> 1
+            return rf_bytes(device.rf_address), \
+                bytearray([0x00, 0x12, flags, 0x00, target]) + until + bytearray([actual & 0xFF])
+        if device.type in (MAX_THERMOSTAT, MAX_THERMOSTAT_PLUS):
+            return rf_bytes(device.rf_address), \
+                bytearray([0x00, 0x12, flags, device.valve_position, target]) + until
+        return rf_bytes(device.rf_address), bytearray([0x00, 0x12, flags])
+
+    def l_message(self):
+        data = bytearray()
+        for device in self.devices:
+            rf_address, payload = self.l_record(device)
+            data += bytearray([len(payload) + 3]) + rf_address + payload
+        return 'L:' + b64(data)
+
+    def s_message(self, command_result=0):
+        return 'S:%02x,%d,%02x' % (self.duty_cycle, command_result, self.memory_slots)
+
+    def greeting(self):
+        cube_c = bytearray([0x11]) + rf_bytes(self.rf_address) + bytearray([MAX_CUBE, 0x00, 0x13, 0xFF])
+        cube_c += self.serial.encode('utf-8')
+        lines = [self.h_message()] + self.m_messages()
+        lines.append('C:%s,%s' % (self.rf_address, b64(cube_c)))
+        lines += self.c_messages()
+        lines.append(self.l_message())
+        return '\r\n'.join(lines) + '\r\n'
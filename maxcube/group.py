@@ -0,0 +1,147 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class MaxCubeHealth(object):
+    __slots__ = ('name', 'online', 'busy', 'last_attempt', 'last_success', 'last_duration',
+                 'last_error', 'consecutive_failures', 'skipped_cycles')
+
+    def __init__(self, name):
+        self.name = name
+        self.online = False
+        self.busy = False
+        self.last_attempt = None
+        self.last_success = None
+        self.last_duration = None
+        self.last_error = None
+        self.consecutive_failures = 0
+        self.skipped_cycles = 0
+
+    def to_dict(self):
+        data = {}
+        for key in self.__slots__:
+            data[key] = getattr(self, key)
+        return data
+
+
+class MaxCubeGroup(object):
+    # Owns several cubes (e.g. one per building) and refreshes them in
+    # parallel, one worker thread per cube. A cube whose previous refresh is
+    # still running is skipped, so a slow or dead cube never holds up the
+    # others. Cubes created with auto_init=False are initialized on their
+    # first refresh.
+    def __init__(self, cubes=None):
+        self.cubes = OrderedDict()
+        self.health = OrderedDict()
+        self.futures = {}
+        self.executor = None
+        self.lock = threading.Lock()
+        if hasattr(cubes, 'items'):
+            cubes = cubes.items()
+        for name, cube in cubes or ():
+            self.add(name, cube)
+
+    def add(self, name, cube):
+        if name in self.cubes:
+            raise ValueError('Cube %s already in group' % name)
+        self.cubes[name] = cube
+        self.health[name] = MaxCubeHealth(name)
+        if self.executor is not None:
+            # Grow the pool so every cube keeps a worker of its own
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def remove(self, name):
+        del self.cubes[name]
+        del self.health[name]
+        self.futures.pop(name, None)
+
+    def update(self, timeout=None):
+        # Starts a refresh of every idle cube and waits at most ``timeout``
+        # seconds. Returns the names of the cubes refreshed successfully.
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=max(len(self.cubes), 1))
+        started = []
+        for name, cube in self.cubes.items():
+            future = self.futures.get(name)
+            if future is not None and not future.done():
+                with self.lock:
+                    self.health[name].skipped_cycles += 1
+                logger.warning('Cube %s still busy with its previous refresh, skipping' % name)
+                continue
+            with self.lock:
+                self.health[name].busy = True
+            self.futures[name] = self.executor.submit(self.update_cube, name, cube)
+            started.append(name)
+        done, _ = wait([self.futures[name] for name in started], timeout=timeout)
+        return [name for name in started if self.futures[name] in done and self.futures[name].result()]
+
+    def update_cube(self, name, cube):
+        start = time.time()
+        try:
+            if cube.rf_address is None:
+                cube.init()
+                success = True
+            else:
+                success = cube.update()
+            error = None if success else 'Command failed'
+        except Exception as e:
+            success = False
+            error = str(e) or e.__class__.__name__
+            logger.warning('Refresh of cube %s failed: %s' % (name, error))
+        with self.lock:
+            health = self.health.get(name)
+            if health is not None:
+                health.busy = False
+                health.online = success
+                health.last_attempt = start
+                health.last_duration = time.time() - start
+                health.last_error = error
+                if success:
+                    health.last_success = start
+                    health.consecutive_failures = 0
+                else:
+                    health.consecutive_failures += 1
+        return success
+
+    def get_health(self):
+        with self.lock:
+            return OrderedDict((name, health.to_dict()) for name, health in self.health.items())
+
+    def devices(self):
+        # Merged view of all devices, keyed by (cube name, RF address)
+        devices = OrderedDict()
+        for name, cube in self.cubes.items():
+            for device in cube.get_devices():
+                devices[(name, device.rf_address)] = device
+        return devices
+
+    def rooms(self):
+        # Merged view of all rooms, keyed by (cube name, room id)
+        rooms = OrderedDict()
+        for name, cube in self.cubes.items():
+            for room in cube.get_rooms():
+                rooms[(name, room.id)] = room
+        return rooms
+
+    def device_by_rf(self, name, rf):
+        cube = self.cubes.get(name)
+        if cube is None:
+            return None
+        return cube.device_by_rf(rf)
+
+    def room_by_id(self, name, id):
+        cube = self.cubes.get(name)
+        if cube is None:
+            return None
+        return cube.room_by_id(id)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
@@ -0,0 +1,151 @@
+import logging
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('actual_temperature', 'target_temperature', 'valve_position')
+NAN = float('nan')
+
+
+def new_buffer(typecode, capacity):
+    # typecode of the array module ('d' or 'f'); numpy uses the same codes
+    if numpy is not None:
+        return numpy.full(capacity, NAN, dtype=typecode)
+    return array(typecode, [NAN]) * capacity
+
+
+class DeviceHistory(object):
+    # Fixed-capacity ring buffer of the samples of one device: a float64
+    # array of timestamps and a float32 array per metric (NaN for unknown).
+    # Once full, each new sample overwrites the oldest one.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = new_buffer('d', capacity)
+        self.values = dict((metric, new_buffer('f', capacity)) for metric in METRICS)
+        self.size = 0
+        self.position = 0
+        self.last = None
+
+    def __len__(self):
+        return self.size
+
+    def nbytes(self):
+        buffers = [self.times] + list(self.values.values())
+        if numpy is not None:
+            return sum(buffer.nbytes for buffer in buffers)
+        return sum(len(buffer) * buffer.itemsize for buffer in buffers)
+
+    def append(self, timestamp, sample):
+        self.times[self.position] = timestamp
+        for metric in METRICS:
+            value = sample[metric]
+            self.values[metric][self.position] = NAN if value is None else value
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+        self.last = (timestamp, sample)
+
+    def ordered(self, buffer):
+        # The samples of a buffer oldest first
+        if self.size < self.capacity:
+            return buffer[:self.size]
+        if numpy is not None:
+            return numpy.concatenate((buffer[self.position:], buffer[:self.position]))
+        return buffer[self.position:] + buffer[:self.position]
+
+    def series(self, metric, start=None, end=None):
+        # (times, values) of the samples with start <= time < end
+        times = self.ordered(self.times)
+        values = self.ordered(self.values[metric])
+        if numpy is not None:
+            first = 0 if start is None else numpy.searchsorted(times, start, 'left')
+            last = len(times) if end is None else numpy.searchsorted(times, end, 'left')
+        else:
+            first = 0 if start is None else bisect_left(times, start)
+            last = len(times) if end is None else bisect_left(times, end)
+        return times[first:last], values[first:last]
+
+
+class MaxCubeHistory(object):
+    # Optional trend store of MaxCube (history=): after every L message the
+    # actual and target temperature and the valve position of each
+    # (wall-)thermostat are sampled into a DeviceHistory. A device is sampled
+    # when a value changed or at least ``interval`` seconds after its last
+    # sample, so memory stays at capacity samples per device however long the
+    # process runs. Uses numpy when available, the array module otherwise.
+    def __init__(self, capacity=1440, interval=60):
+        self.capacity = capacity
+        self.interval = interval
+        self.devices = {}
+
+    def __contains__(self, rf_address):
+        return rf_address in self.devices
+
+    def nbytes(self):
+        return sum(history.nbytes() for history in self.devices.values())
+
+    def record(self, device, timestamp):
+        if not device.is_thermostat() and not device.is_wallthermostat():
+            return False
+        sample = dict((metric, getattr(device, metric, None)) for metric in METRICS)
+        history = self.devices.get(device.rf_address)
+        if history is None:
+            history = self.devices[device.rf_address] = DeviceHistory(self.capacity)
+        elif history.last[1] == sample and timestamp - history.last[0] < self.interval:
+            return False
+        history.append(timestamp, sample)
+        return True
+
+    def series(self, rf_address, metric, start=None, end=None):
+        history = self.devices.get(rf_address)
+        if history is None:
+            return [], []
+        return history.series(metric, start, end)
+
+    def downsample(self, rf_address, metric, bucket, start=None, end=None):
+        # [(bucket start, min, mean, max)] over buckets of ``bucket`` seconds
+        # aligned to the epoch; unknown values are left out and empty buckets
+        # are not returned
+        times, values = self.series(rf_address, metric, start, end)
+        if numpy is not None:
+            return self.downsample_arrays(times, values, bucket)
+        result = []
+        current = None
+        for timestamp, value in zip(times, values):
+            if math.isnan(value):
+                continue
+            index = math.floor(timestamp / bucket)
+            if current is None or index != current[0]:
+                if current is not None:
+                    result.append(self.bucket_row(current, bucket))
+                current = [index, value, 0.0, value, 0]
+            current[1] = min(current[1], value)
+            current[2] += value
+            current[3] = max(current[3], value)
+            current[4] += 1
+        if current is not None:
+            result.append(self.bucket_row(current, bucket))
+        return result
+
+    def bucket_row(self, current, bucket):
+        index, minimum, total, maximum, count = current
+        return (index * bucket, minimum, total / count, maximum)
+
+    def downsample_arrays(self, times, values, bucket):
+        known = ~numpy.isnan(values)
+        times, values = times[known], values[known].astype('d')
+        if not len(values):
+            return []
+        indexes = numpy.floor(times / bucket)
+        starts = numpy.flatnonzero(numpy.concatenate(([True], indexes[1:] != indexes[:-1])))
+        counts = numpy.diff(numpy.append(starts, len(values)))
+        minimums = numpy.minimum.reduceat(values, starts)
+        means = numpy.add.reduceat(values, starts) / counts
+        maximums = numpy.maximum.reduceat(values, starts)
+        return list(zip((indexes[starts] * bucket).tolist(), minimums.tolist(), means.tolist(), maximums.tolist()))
@@ -0,0 +1,189 @@
+import bisect
+import logging
+import threading
+import time
+from collections import deque
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (seconds) of the round-trip latency buckets: a healthy cube
+# answers within tens of milliseconds, a busy one within a few seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+# Upper bounds (seconds) of the parse time buckets
+PARSE_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+# Upper bounds of the reply size buckets
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536)
+
+
+class Histogram(object):
+    # Counts observations in fixed buckets, so memory does not grow with the
+    # number of observations
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def cumulative(self):
+        # [(upper bound, observations <= bound)], the last bound being inf
+        total = 0
+        result = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'max': self.max,
+            'buckets': self.cumulative(),
+        }
+
+
+class MaxCubeMetrics(object):
+    # Opt-in instrumentation shared by a MaxCubeConnection and its MaxCube:
+    # pass the same instance as ``metrics`` to both. collect() returns
+    # everything as plain data, prometheus() as Prometheus text format.
+    def __init__(self, trend_size=360, clock=time.time):
+        self.clock = clock
+        self.lock = threading.Lock()
+        # Round-trip latency and reply size per command type ('l', 's', ...)
+        self.latency = {}
+        self.reply_size = {}
+        # Decode time per message type ('H', 'M', 'C', 'L', 'S')
+        self.parse_time = {}
+        self.commands = 0
+        self.failures = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.reconnects = 0
+        # Last (time, value) pairs reported by S messages
+        self.duty_cycle = deque(maxlen=trend_size)
+        self.memory_slots = deque(maxlen=trend_size)
+
+    def histogram(self, histograms, key, buckets):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram(buckets)
+        return histogram
+
+    def observe_command(self, command, seconds, sent, received, success=True):
+        kind = command[:1]
+        with self.lock:
+            self.commands += 1
+            if not success:
+                self.failures += 1
+            self.bytes_out += sent
+            self.bytes_in += received
+            if success:
+                self.histogram(self.latency, kind, LATENCY_BUCKETS).observe(seconds)
+                self.histogram(self.reply_size, kind, SIZE_BUCKETS).observe(received)
+
+    def observe_bytes(self, sent=0, received=0):
+        # Traffic outside of a single round-trip, e.g. a greeting or pipelined writes
+        with self.lock:
+            self.bytes_out += sent
+            self.bytes_in += received
+
+    def observe_parse(self, kind, seconds):
+        with self.lock:
+            self.histogram(self.parse_time, kind, PARSE_BUCKETS).observe(seconds)
+
+    def observe_reconnect(self):
+        with self.lock:
+            self.reconnects += 1
+
+    def observe_status(self, duty_cycle, memory_slots):
+        now = self.clock()
+        with self.lock:
+            if duty_cycle is not None:
+                self.duty_cycle.append((now, duty_cycle))
+            if memory_slots is not None:
+                self.memory_slots.append((now, memory_slots))
+
+    def collect(self):
+        with self.lock:
+            return {
+                'commands': self.commands,
+                'failures': self.failures,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'reconnects': self.reconnects,
+                'latency': dict((kind, histogram.as_dict()) for kind, histogram in self.latency.items()),
+                'reply_size': dict((kind, histogram.as_dict()) for kind, histogram in self.reply_size.items()),
+                'parse_time': dict((kind, histogram.as_dict()) for kind, histogram in self.parse_time.items()),
+                'duty_cycle': list(self.duty_cycle),
+                'memory_slots': list(self.memory_slots),
+            }
+
+    def prometheus(self):
+        data = self.collect()
+        lines = []
+        for name, help_text in (('commands', 'Commands sent to the cube'),
+                                ('failures', 'Commands without a successful reply'),
+                                ('bytes_in', 'Bytes received from the cube'),
+                                ('bytes_out', 'Bytes sent to the cube'),
+                                ('reconnects', 'Reconnects after a connection failure')):
+            lines.append('# HELP maxcube_%s_total %s' % (name, help_text))
+            lines.append('# TYPE maxcube_%s_total counter' % name)
+            lines.append('maxcube_%s_total %s' % (name, data[name]))
+        for name, label, help_text in (('latency', 'command', 'Command round-trip time in seconds'),
+                                       ('reply_size', 'command', 'Reply size in bytes'),
+                                       ('parse_time', 'message', 'Message decode time in seconds')):
+            lines.append('# HELP maxcube_%s %s' % (name, help_text))
+            lines.append('# TYPE maxcube_%s histogram' % name)
+            for kind in sorted(data[name]):
+                histogram = data[name][kind]
+                for bound, count in histogram['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('maxcube_%s_bucket{%s="%s",le="%s"} %d' % (name, label, kind, le, count))
+                lines.append('maxcube_%s_sum{%s="%s"} %r' % (name, label, kind, histogram['sum']))
+                lines.append('maxcube_%s_count{%s="%s"} %d' % (name, label, kind, histogram['count']))
+        for name, help_text in (('duty_cycle', 'Duty cycle in percent reported by the cube'),
+                                ('memory_slots', 'Free command memory slots reported by the cube')):
+            if data[name]:
+                lines.append('# HELP maxcube_%s %s' % (name, help_text))
+                lines.append('# TYPE maxcube_%s gauge' % name)
+                lines.append('maxcube_%s %s' % (name, data[name][-1][1]))
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.metrics.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def start_exporter(metrics, host='127.0.0.1', port=9466):
+    # Serves metrics.prometheus() to a local scrape from a daemon thread.
+    # Returns the server; server.shutdown() stops it.
+    server = HTTPServer((host, port), MetricsHandler)
+    server.metrics = metrics
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving cube metrics on %s:%d' % server.server_address[:2])
+    return server
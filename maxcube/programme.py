@@ -0,0 +1,75 @@
+DAYS = ['saturday', 'sunday', 'monday', 'tuesday', 'wednesday', 'thursday',
+        'friday', 'saturday', 'sunday']
+
+
+# A set-point is a 16 bit word: temperature in half degrees (7 bits) followed
+# by the time it lasts until in 5 minute slots (9 bits). Every possible value
+# of either part is decoded once here, so the same strings and floats are
+# shared by all programmes.
+TEMPERATURES = [value / 2.0 for value in range(128)]
+TIMES = ["{:02d}:{:02d}".format(slot * 5 // 60, slot * 5 % 60) for slot in range(512)]
+# Encoding side, for the valid values only: anything else takes the checked path
+TEMPERATURE_BITS = dict((value / 2.0, value << 9) for value in range(65))
+TIME_SLOTS = dict((TIMES[slot], slot) for slot in range(289))
+END_OF_DAY = TIME_SLOTS["24:00"]
+
+
+def get_programme(bits):
+    programme = {}
+    for j in range((len(bits) + 25) // 26):
+        day_programme = []
+        for i in range(j * 26, min(j * 26 + 26, len(bits)), 2):
+            word = (bits[i] << 8) | bits[i + 1]
+            slot = word & 0x1FF
+            day_programme.append({"temp": TEMPERATURES[word >> 9], "until": TIMES[slot]})
+            if slot == END_OF_DAY:
+                # This appears to flag the end of useable set points
+                break
+        programme[day_of_week_from_n(j)] = day_programme
+    return programme
+
+
+def n_from_day_of_week(day):
+    return DAYS.index(day)
+
+
+def day_of_week_from_n(day):
+    return DAYS[day]
+
+
+def temp_and_time(temp, time):
+    return to_hex(set_point(temp, time))
+
+
+def set_point(temp, time):
+    bits = TEMPERATURE_BITS.get(temp)
+    slot = TIME_SLOTS.get(time)
+    if bits is None or slot is None:
+        temp = float(temp)
+        assert temp <= 32, "Temp must be 32 or lower"
+        assert temp % 0.5 == 0, "Temp must be increments of 0.5"
+        bits = int(temp * 2) << 9
+        hours, mins = [int(x) for x in time.split(":")]
+        assert mins % 5 == 0, "Time must be a multiple of 5 mins"
+        slot = (hours * 60 + mins) // 5
+    return bits | slot
+
+
+def to_hex(value):
+    "Return value as hex word"
+    return format(value, "02x")
+
+
+def programme_bytes(programme):
+    "Return programme (as returned by get_programme) as the 182 byte C message block"
+    data = bytearray()
+    for n in range(7):
+        day = bytearray()
+        for setting in programme.get(day_of_week_from_n(n), [])[:13]:
+            word = set_point(setting['temp'], setting['until'])
+            day += bytearray([word >> 8, word & 0xFF])
+        while len(day) < 26:
+            # Unused set points repeat the last one, as the cube does
+            day += day[-2:] if day else bytearray([0x41, 0x20])
+        data += day
+    return bytes(data)
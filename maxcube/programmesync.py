@@ -0,0 +1,114 @@
+import logging
+
+from maxcube.programme import DAYS
+
+logger = logging.getLogger(__name__)
+
+
+class ProgrammeFrame(object):
+    __slots__ = ('device', 'devices', 'day', 'metadata', 'room', 'command')
+
+    def __init__(self, device, devices, day, metadata, room, command):
+        self.device = device
+        self.devices = devices
+        self.day = day
+        self.metadata = metadata
+        self.room = room
+        self.command = command
+
+
+class ProgrammeSync(object):
+    # Brings the weekly programmes of a cube to a desired configuration
+    # ({rf_address: {day: [{'temp', 'until'}, ...]}}) with as few s: frames
+    # as the protocol allows: a frame carries one day, days already set are
+    # skipped, and a day shared by every thermostat of a room goes out as a
+    # single room frame. Frames are sent in order (room by room, day by day)
+    # and a device's programme is only updated once its frame was accepted,
+    # so after a failure run() resumes with the frame that failed.
+    def __init__(self, cube, desired):
+        self.cube = cube
+        self.desired = desired
+        self.frames = self.plan()
+        self.position = 0
+
+    @classmethod
+    def from_config(cls, cube, config):
+        # config as written by devices_as_json: [{'rf_address', 'programme'}, ...]
+        desired = {}
+        for device_config in config:
+            programme = device_config.get('programme')
+            if not programme:
+                # e.g. a wall thermostat
+                continue
+            device = cube.device_by_rf(device_config['rf_address'])
+            if device is None:
+                logger.warning('Unknown device %s in programme config' % device_config['rf_address'])
+                continue
+            desired[device.rf_address] = programme
+        return cls(cube, desired)
+
+    @property
+    def done(self):
+        return self.position >= len(self.frames)
+
+    def remaining(self):
+        return self.frames[self.position:]
+
+    def current(self, device, day):
+        # None while the programme is unknown, e.g. before the C message
+        return device.programme.get(day) if device.programme else None
+
+    def target(self, device, day):
+        return self.desired.get(device.rf_address, {}).get(day, self.current(device, day))
+
+    def plan(self):
+        frames = []
+        room_ids = set(room.id for room in self.cube.rooms)
+        groups = [(True, self.cube.devices_by_room(room)) for room in self.cube.rooms]
+        # Thermostats outside any known room only ever get device frames
+        groups.append((False, [device for device in self.cube.devices if device.room_id not in room_ids]))
+        for in_room, devices in groups:
+            # A room frame reaches every thermostat of the room, also those
+            # whose programme is unknown, so it is only used when all of them
+            # are known and to get the same day. A thermostat whose programme
+            # is unknown gets a device frame for every day it is given.
+            reached = [device for device in devices if device.is_thermostat() or device.is_wallthermostat()]
+            known = all(device.programme for device in reached)
+            for day in DAYS[:7]:
+                changed = [device for device in reached
+                           if self.target(device, day) is not None
+                           and self.target(device, day) != self.current(device, day)]
+                if not changed:
+                    continue
+                metadata = self.target(changed[0], day)
+                if in_room and known and len(changed) > 1 \
+                        and all(self.target(device, day) == metadata for device in reached):
+                    command = self.cube.programme_frame(changed[0], day, metadata, room=True)
+                    frames.append(ProgrammeFrame(changed[0], reached, day, metadata, True, command))
+                    continue
+                for device in changed:
+                    metadata = self.target(device, day)
+                    command = self.cube.programme_frame(device, day, metadata)
+                    frames.append(ProgrammeFrame(device, [device], day, metadata, False, command))
+        return frames
+
+    def next_frame(self):
+        return self.frames[self.position]
+
+    def frame_sent(self):
+        frame = self.frames[self.position]
+        for device in frame.devices:
+            if not device.programme:
+                device.programme = {}
+            device.programme[frame.day] = frame.metadata
+        logger.debug('Programme for %s set on %d device(s)' % (frame.day, len(frame.devices)))
+        self.position += 1
+
+    def run(self, send):
+        # send(command) returns True once the cube accepted the frame
+        while not self.done:
+            if not send(self.next_frame().command):
+                logger.error('Programme sync stopped at frame %d of %d' % (self.position + 1, len(self.frames)))
+                return False
+            self.frame_sent()
+        return True
@@ -0,0 +1,138 @@
+import json
+import logging
+
+from maxcube.device import MAX_DEVICE_MODE_BOOST
+
+logger = logging.getLogger(__name__)
+
+# Mode published for a room in day comfort ("I'm at home"), next to the
+# cube's own modes 0 to 3
+MAX_DEVICE_MODE_HOME = 4
+OFF_TEMPERATURE = 4.5
+
+
+class MaxCubePublisher(object):
+    # Publishes the room and cube figures of a MaxCube (cube.aggregates) as
+    # JSON, e.g. over MQTT with publish=client.publish. The payload of each
+    # room is kept as a dict and as its serialized text; a room is only
+    # built again once the cube flagged it changed, and only serialized and
+    # sent again if its payload differs from the last one sent.
+    #
+    # deltas: also publish every changed field on <prefix>/room/<id>/<field>,
+    #         its value as the plain string of the full payload
+    # group: publish the rooms of one round as a single message on
+    #        <prefix>/rooms ({room id: payload}) instead of one per room
+    # refresh_qos: QoS of the periodic full republish (publish_all)
+    def __init__(self, cube, publish, prefix='eq3/maxcube', qos=1, refresh_qos=0, deltas=False, group=False):
+        self.cube = cube
+        self.publish = publish
+        self.prefix = prefix
+        self.qos = qos
+        self.refresh_qos = refresh_qos
+        self.deltas = deltas
+        self.group = group
+        # room id -> [payload, serialized payload]
+        self.rooms = {}
+        self.totals = None
+        self.messages = 0
+
+    def room_payload(self, room):
+        # Values are strings, as maxcubed always published them
+        aggregate = self.cube.aggregates.room(room.id)
+        payload = {'room_id': str(room.id), 'room_name': room.name}
+        if aggregate is None:
+            return payload
+        if aggregate.has_thermostat:
+            mode = aggregate.mode
+            if room.day_comfort and mode != MAX_DEVICE_MODE_BOOST:
+                mode = MAX_DEVICE_MODE_HOME
+            payload['mode'] = str(mode)
+            target_temperature = aggregate.target_temperature
+            payload['target_temperature'] = 'OFF' if target_temperature == OFF_TEMPERATURE else str(target_temperature)
+            if aggregate.actual_temperature is not None:
+                payload['actual_temperature'] = str(aggregate.actual_temperature)
+            if aggregate.battery is not None:
+                payload['battery'] = str(aggregate.battery)
+            if aggregate.valve_position is not None:
+                payload['valve_pos'] = str(aggregate.valve_position)
+        if aggregate.is_open is not None:
+            payload['is_open'] = str(aggregate.is_open)
+        return payload
+
+    def cube_payload(self):
+        totals = self.cube.aggregates.totals()
+        payload = {
+            'open_valves': str(totals['open_valves']),
+            'max_valve_pos': str(totals['max_valve_position']),
+            'mean_valve_pos': str(totals['mean_valve_position']),
+        }
+        if totals['duty_cycle'] is not None:
+            payload['duty_cycle'] = totals['duty_cycle']
+        if totals['memory_slots'] is not None:
+            payload['memory_slots'] = totals['memory_slots']
+        return payload
+
+    def publish_changes(self):
+        # Publishes the rooms that changed since the last call and, if any
+        # did, the cube figures. Returns the number of messages sent.
+        changed = []
+        sent = 0
+        for room in self.cube.rooms:
+            if not room.get_changed() and room.id in self.rooms:
+                continue
+            payload = self.room_payload(room)
+            cached = self.rooms.get(room.id)
+            if cached is not None and cached[0] == payload:
+                continue
+            old_payload = cached[0] if cached is not None else {}
+            self.rooms[room.id] = [payload, json.dumps(payload)]
+            changed.append(room.id)
+            if self.deltas:
+                sent += self.publish_deltas(room.id, old_payload, payload)
+        sent += self.publish_rooms(changed, self.qos)
+        if changed:
+            sent += self.publish_cube(self.qos, force=False)
+        return sent
+
+    def publish_all(self):
+        for room in self.cube.rooms:
+            if room.get_changed() or room.id not in self.rooms:
+                payload = self.room_payload(room)
+                self.rooms[room.id] = [payload, json.dumps(payload)]
+        for room_id in list(self.rooms):
+            if self.cube.room_by_id(room_id) is None:
+                del self.rooms[room_id]
+        return self.publish_rooms(sorted(self.rooms), self.refresh_qos) + self.publish_cube(self.refresh_qos, force=True)
+
+    def publish_rooms(self, room_ids, qos):
+        if not room_ids:
+            return 0
+        if self.group:
+            rooms = dict((str(room_id), self.rooms[room_id][0]) for room_id in room_ids)
+            self.send(self.prefix + '/rooms', json.dumps(rooms), qos)
+            return 1
+        for room_id in room_ids:
+            self.send('%s/room/%s' % (self.prefix, room_id), self.rooms[room_id][1], qos)
+        return len(room_ids)
+
+    def publish_deltas(self, room_id, old_payload, payload):
+        sent = 0
+        for name, value in payload.items():
+            if old_payload.get(name) != value:
+                # The plain string, as in the full payload
+                self.send('%s/room/%s/%s' % (self.prefix, room_id, name), value, self.qos)
+                sent += 1
+        return sent
+
+    def publish_cube(self, qos, force):
+        payload = self.cube_payload()
+        if not force and self.totals is not None and self.totals[0] == payload:
+            return 0
+        self.totals = [payload, json.dumps(payload)]
+        self.send(self.prefix + '/global', self.totals[1], qos)
+        return 1
+
+    def send(self, topic, text, qos):
+        self.messages += 1
+        logger.debug('Publishing %s: %s' % (topic, text))
+        self.publish(topic, text, qos)
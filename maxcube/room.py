@@ -1,4 +1,6 @@
 class MaxRoom(object):
+    __slots__ = ('id', 'name', 'group_rf_address', 'has_changed', 'day_comfort')
+
     def __init__(self):
         self.id = None
         self.name = None
@@ -0,0 +1,194 @@
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class MaxCommand(object):
+    __slots__ = ('command', 'priority', 'sequence', 'key', 'callback', 'attempts', 'submitted',
+                 'cancelled', 'success')
+
+    def __init__(self, command, priority, sequence, key=None, callback=None, submitted=None):
+        self.command = command
+        self.priority = priority
+        self.sequence = sequence
+        self.key = key
+        self.callback = callback
+        self.attempts = 0
+        self.submitted = submitted
+        self.cancelled = False
+        self.success = None
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class MaxCommandScheduler(object):
+    # Queues s: commands for a cube by priority (lowest value first, then in
+    # submission order) and sends them from run_pending(), which the caller
+    # invokes from the thread that owns the cube, e.g. its poll loop.
+    #
+    # Sending is paced by the duty cycle and memory slots the cube reported in
+    # its last S message: above duty_cycle_limit only PRIORITY_HIGH commands
+    # go out, and with no free memory slot nothing does. A command the cube
+    # rejects (or that fails on the connection) stays queued and the whole
+    # queue pauses with exponential backoff, as the RF budget is cube-wide.
+    # A command submitted with a key replaces a queued one with the same key.
+    def __init__(self, cube, duty_cycle_limit=80, min_memory_slots=1, retry_delay=10,
+                 max_retry_delay=600, max_attempts=None, clock=time.time):
+        self.cube = cube
+        self.duty_cycle_limit = duty_cycle_limit
+        self.min_memory_slots = min_memory_slots
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self.clock = clock
+        self.queue = []
+        self.keys = {}
+        self.sequence = 0
+        self.failures = 0
+        self.resume_at = 0
+        self.holding = False
+        self.sent = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(1 for entry in self.queue if not entry.cancelled)
+
+    def submit(self, command, priority=PRIORITY_NORMAL, key=None, callback=None):
+        # callback(entry, success) is called once the command is settled
+        with self.lock:
+            previous = self.keys.get(key) if key is not None else None
+            if previous is not None:
+                previous.cancelled = True
+                priority = min(priority, previous.priority)
+                sequence = previous.sequence
+            else:
+                self.sequence += 1
+                sequence = self.sequence
+            entry = MaxCommand(command, priority, sequence, key, callback, self.clock())
+            if key is not None:
+                self.keys[key] = entry
+            heapq.heappush(self.queue, entry)
+            return entry
+
+    def set_temperature_mode(self, thermostat, temperature, mode, priority=PRIORITY_NORMAL, callback=None):
+        if not thermostat.is_thermostat() and not thermostat.is_wallthermostat():
+            logger.error('%s is no (wall-)thermostat!', thermostat.rf_address)
+            return None
+
+        def applied(entry, success):
+            if success:
+                self.cube.apply_temperature_mode(thermostat, temperature, mode)
+                self.cube.publish_changes()
+            if callback is not None:
+                callback(entry, success)
+
+        command = self.cube.temperature_mode_command(thermostat, temperature, mode)
+        return self.submit(command, priority, ('temperature_mode', thermostat.rf_address), applied)
+
+    def set_programme(self, thermostat, day, metadata, priority=PRIORITY_LOW, callback=None):
+        # Returns None when the programme is unchanged. The programme of the
+        # model is only updated once the cube accepted the frame.
+        if thermostat.is_room():
+            device = self.cube.device_by_rf(thermostat.group_rf_address)
+            devices = [device for device in self.cube.devices_by_room(thermostat)
+                       if device.is_thermostat() or device.is_wallthermostat()]
+        else:
+            device = thermostat
+            devices = [thermostat]
+        if device is None or device.programme[day] == metadata:
+            logger.debug('Skipping program for %s (unchanged)' % (day))
+            return None
+
+        def applied(entry, success):
+            if success:
+                for target in devices:
+                    if target.programme is not None:
+                        target.programme[day] = metadata
+            if callback is not None:
+                callback(entry, success)
+
+        command = self.cube.programme_frame(device, day, metadata, thermostat.is_room())
+        return self.submit(command, priority, ('programme', thermostat.rf_address, day), applied)
+
+    def allowed(self, entry):
+        if self.cube.memory_slots is not None and self.cube.memory_slots < self.min_memory_slots:
+            return False
+        if self.cube.duty_cycle is not None and self.cube.duty_cycle >= self.duty_cycle_limit:
+            return entry.priority <= PRIORITY_HIGH
+        return True
+
+    def next_entry(self, force=False):
+        # Returns the first command allowed to go out now (or the first queued
+        # one if forced), None if there is none
+        with self.lock:
+            while self.queue and self.queue[0].cancelled:
+                heapq.heappop(self.queue)
+            if not self.queue or force or self.allowed(self.queue[0]):
+                return self.queue[0] if self.queue else None
+            for entry in sorted(self.queue):
+                if not entry.cancelled and self.allowed(entry):
+                    return entry
+            return None
+
+    def run_pending(self):
+        # Sends every command that may go out now. Returns the number of
+        # seconds after which run_pending() should be called again, or None
+        # when the queue is empty.
+        while True:
+            now = self.clock()
+            if now < self.resume_at:
+                return self.resume_at - now
+            # The duty cycle and memory slots only change with the S reply to a
+            # command, so after holding back for retry_delay the next command
+            # goes out anyway to refresh them.
+            entry = self.next_entry(force=self.holding)
+            if entry is None:
+                with self.lock:
+                    if not self.queue:
+                        return None
+                self.holding = True
+                self.resume_at = now + self.retry_delay
+                return self.retry_delay
+            self.holding = False
+            entry.attempts += 1
+            success = self.cube.send_command(entry.command)
+            self.sent += 1
+            if success:
+                self.failures = 0
+                self.settle(entry, True)
+                continue
+            self.rejected += 1
+            self.failures += 1
+            delay = min(self.retry_delay * 2 ** (self.failures - 1), self.max_retry_delay)
+            self.resume_at = self.clock() + delay
+            if entry.cancelled:
+                # Replaced while it was being sent, the replacement goes out instead
+                self.settle(entry, False)
+            elif self.max_attempts is not None and entry.attempts >= self.max_attempts:
+                logger.error('Giving up on command after %d attempts: %s' % (entry.attempts, entry.command.strip()))
+                self.settle(entry, False)
+            else:
+                logger.warning('Command rejected (duty cycle=%s, memory slots=%s), retrying in %ds'
+                               % (self.cube.duty_cycle, self.cube.memory_slots, delay))
+
+    def settle(self, entry, success):
+        with self.lock:
+            # Settled entries are dropped from the heap once they reach the top.
+            # An entry replaced while it was being sent is settled all the same,
+            # its replacement stays queued under the key.
+            entry.cancelled = True
+            entry.success = success
+            if entry.key is not None and self.keys.get(entry.key) is entry:
+                del self.keys[entry.key]
+        if entry.callback is not None:
+            entry.callback(entry, success)
@@ -0,0 +1,278 @@
+import struct
+
+from maxcube.device import \
+    MAX_CUBE, \
+    MAX_THERMOSTAT, \
+    MAX_THERMOSTAT_PLUS, \
+    MAX_WALL_THERMOSTAT, \
+    MAX_WINDOW_SHUTTER, \
+    MAX_PUSH_BUTTON, \
+    MAX_DEVICE_MODE_AUTOMATIC, \
+    MAX_DEVICE_MODE_MANUAL, \
+    MAX_DEVICE_MODE_VACATION
+from maxcube.programme import DAYS, get_programme
+
+# Returned by a field decoder when the target attribute must be left untouched
+KEEP = object()
+
+
+class Field(object):
+    # A device attribute decoded from the byte at ``offset`` (or ``length`` bytes
+    # from it): ((byte & mask) >> shift) * scale + bias, optionally run through
+    # ``convert``. A field without offset is computed by ``convert`` from the
+    # whole record and the fields decoded before it.
+    __slots__ = ('name', 'offset', 'mask', 'shift', 'scale', 'bias', 'length', 'convert')
+
+    def __init__(self, name, offset=None, mask=0xFF, shift=0, scale=1, bias=0, length=1, convert=None):
+        self.name = name
+        self.offset = offset
+        self.mask = mask
+        self.shift = shift
+        self.scale = scale
+        self.bias = bias
+        self.length = length
+        self.convert = convert
+
+
+def firmware(value):
+    return str(value >> 4).zfill(2) + '.' + str(value & 0x0F).zfill(2)
+
+
+def text(value):
+    return value.decode('utf-8')
+
+
+def boost_duration(value):
+    if value == 7:
+        return 60
+    return value * 5
+
+
+def percent(value):
+    return value * 100 / 255.0
+
+
+def decalcification(value):
+    return DAYS[value >> 5] + ' ' + str(value & 0x1F).zfill(2) + ':00'
+
+
+def thermostat_actual_temperature(data, values):
+    if values['mode'] in (MAX_DEVICE_MODE_MANUAL, MAX_DEVICE_MODE_AUTOMATIC):
+        actual_temperature = (data[9] * 256 + data[10]) / 10.0
+        if actual_temperature == 0:
+            return KEEP
+        return actual_temperature
+    return None
+
+
+def wall_thermostat_actual_temperature(data, values):
+    return (((data[8] & 0x80) << 1) + data[12]) / 10.0
+
+
+def vacation_until(data, values):
+    if values['mode'] != MAX_DEVICE_MODE_VACATION:
+        return None
+    if (data[11] & 0x01) == 0:
+        minutes_until = '00'
+    else:
+        minutes_until = '30'
+    return '20' + str(data[10] & 0x1F).zfill(2) \
+        + '-' + str(((data[9] & 0xE0) >> 4) + ((data[10] & 0x40) >> 6)).zfill(2) \
+        + '- ' + str(data[9] & 0x1F).zfill(2) \
+        + ' ' + str(data[11] >> 1).zfill(2) \
+        + ':' + minutes_until
+
+
+# C message (device configuration), offsets into the decoded payload
+C_DEVICE = (
+    Field('room_id', 5),
+    Field('firmware', 6, convert=firmware),
+    Field('serial', 8, length=10, convert=text),
+)
+C_WALL_THERMOSTAT = C_DEVICE + (
+    Field('comfort_temperature', 18, scale=0.5),
+    Field('eco_temperature', 19, scale=0.5),
+    Field('max_temperature', 20, scale=0.5),
+    Field('min_temperature', 21, scale=0.5),
+)
+C_THERMOSTAT = C_WALL_THERMOSTAT
+# Decoded on first access only (see maxcube.device.ConfigField)
+C_WALL_THERMOSTAT_CONFIG = (
+    Field('programme', 22, length=182, convert=get_programme),
+)
+C_THERMOSTAT_CONFIG = (
+    Field('temperature_offset', 22, scale=0.5, bias=-3.5),
+    Field('window_open_temperature', 23, scale=0.5),
+    Field('window_open_duration', 24, scale=5),
+    Field('boost_duration', 25, mask=0xE0, shift=5, convert=boost_duration),
+    Field('boost_valve_position', 25, mask=0x1F, scale=5),
+    Field('decalcification', 26, convert=decalcification),
+    Field('max_valve_setting', 27, convert=percent),
+    Field('valve_offset', 28, convert=percent),
+    Field('programme', 29, length=182, convert=get_programme),
+)
+
+# L message (live state), offsets into one device sub-record
+L_DEVICE = (
+    Field('initialized', 5, mask=0x02, shift=1),
+    Field('battery', 6, shift=7),
+)
+L_WALL_THERMOSTAT = L_DEVICE + (
+    Field('target_temperature', 8, mask=0x7F, scale=0.5),
+    Field('locked', 6, mask=0x20, shift=5),
+    Field('mode', 6, mask=0x03),
+    Field('vacation_until', convert=vacation_until),
+    Field('actual_temperature', convert=wall_thermostat_actual_temperature),
+)
+L_THERMOSTAT = L_DEVICE + (
+    Field('target_temperature', 8, mask=0x7F, scale=0.5),
+    Field('locked', 6, mask=0x20, shift=5),
+    Field('mode', 6, mask=0x03),
+    Field('vacation_until', convert=vacation_until),
+    Field('actual_temperature', convert=thermostat_actual_temperature),
+    Field('valve_position', 7),
+)
+L_WINDOW_SHUTTER = L_DEVICE + (
+    Field('is_open', 6, mask=0x02, shift=1),
+)
+
+C_SCHEMA = {
+    MAX_CUBE: C_DEVICE,
+    MAX_THERMOSTAT: C_THERMOSTAT,
+    MAX_THERMOSTAT_PLUS: C_THERMOSTAT,
+    MAX_WALL_THERMOSTAT: C_WALL_THERMOSTAT,
+    MAX_WINDOW_SHUTTER: C_DEVICE,
+    MAX_PUSH_BUTTON: C_DEVICE,
+}
+CONFIG_SCHEMA = {
+    MAX_THERMOSTAT: C_THERMOSTAT_CONFIG,
+    MAX_THERMOSTAT_PLUS: C_THERMOSTAT_CONFIG,
+    MAX_WALL_THERMOSTAT: C_WALL_THERMOSTAT_CONFIG,
+}
+L_SCHEMA = {
+    MAX_CUBE: L_DEVICE,
+    MAX_THERMOSTAT: L_THERMOSTAT,
+    MAX_THERMOSTAT_PLUS: L_THERMOSTAT,
+    MAX_WALL_THERMOSTAT: L_WALL_THERMOSTAT,
+    MAX_WINDOW_SHUTTER: L_WINDOW_SHUTTER,
+    MAX_PUSH_BUTTON: L_DEVICE,
+}
+
+# H and S messages are comma separated: (attribute, token index, convert)
+H_SCHEMA = (
+    ('serial', 0, str),
+    ('rf_address', 1, str),
+    ('firmware_version', 2, lambda token: token[0:2] + '.' + token[2:4]),
+)
+S_SCHEMA = (
+    ('duty_cycle', 0, lambda token: int(token, 16)),
+    ('command_result', 1, int),
+    ('memory_slots', 2, lambda token: int(token, 16)),
+)
+
+# M message records: a room or device entry is a sequence of
+# (attribute, kind) where kind is 'B' (byte), 'rf' (3 byte address),
+# 'str' (length prefixed text) or an 'Ns' fixed width text.
+M_ROOM = (
+    ('id', 'B'),
+    ('name', 'str'),
+    ('group_rf_address', 'rf'),
+)
+M_DEVICE = (
+    ('type', 'B'),
+    ('rf_address', 'rf'),
+    ('serial', '10s'),
+    ('name', 'str'),
+    ('room_id', 'B'),
+)
+
+
+class Decoder(object):
+    # Compiled form of a C or L field list: one struct.Struct unpacks every
+    # byte the fields read, then each field is a tuple of plain operations.
+    def __init__(self, fields):
+        offsets = sorted(set(field.offset for field in fields if field.offset is not None))
+        layout = '<'
+        index = {}
+        position = 0
+        for offset in offsets:
+            length = max(field.length for field in fields if field.offset == offset)
+            if offset < position:
+                raise ValueError('Overlapping fields at offset %d' % offset)
+            layout += 'x' * (offset - position)
+            layout += 'B' if length == 1 else '%ds' % length
+            index[offset] = len(index)
+            position = offset + length
+        self.struct = struct.Struct(layout)
+        self.size = self.struct.size
+        self.fields = tuple(
+            (field.name, index.get(field.offset), field.mask, field.shift, field.scale, field.bias,
+             field.length, field.convert)
+            for field in fields)
+
+    def decode(self, data, offset=0):
+        # Returns the decoded attributes as a list of (name, value) in schema order
+        raw = self.struct.unpack_from(data, offset)
+        record = data[offset:] if offset else data
+        values = {}
+        result = []
+        for name, index, mask, shift, scale, bias, length, convert in self.fields:
+            if index is None:
+                value = convert(record, values)
+            elif length > 1:
+                value = convert(raw[index])
+            else:
+                value = (raw[index] & mask) >> shift
+                if convert is not None:
+                    value = convert(value)
+                elif scale != 1 or bias:
+                    value = value * scale + bias
+            values[name] = value
+            if value is not KEEP:
+                result.append((name, value))
+        return result
+
+
+def as_bytes(message):
+    if isinstance(message, bytes):
+        return message
+    if isinstance(message, (bytearray, memoryview)):
+        return bytes(message)
+    return message.encode('utf-8')
+
+
+def as_text(message):
+    if isinstance(message, bytes):
+        return message.decode('utf-8')
+    return message
+
+
+def decode_tokens(schema, message):
+    tokens = message[2:].split(',')
+    return [(name, convert(tokens[index])) for name, index, convert in schema]
+
+
+def read_record(layout, data, pos):
+    # Returns (attributes, position after the record) for one M record
+    record = {}
+    for name, kind in layout:
+        if kind == 'B':
+            record[name] = data[pos]
+            pos += 1
+        elif kind == 'rf':
+            record[name] = ''.join('{:02X}'.format(x) for x in data[pos:pos + 3])
+            pos += 3
+        elif kind == 'str':
+            length = data[pos]
+            record[name] = bytes(data[pos + 1:pos + 1 + length]).decode('utf-8')
+            pos += 1 + length
+        else:
+            length = int(kind[:-1])
+            record[name] = bytes(data[pos:pos + length]).decode('utf-8')
+            pos += length
+    return record, pos
+
+
+C_DECODERS = dict((device_type, Decoder(fields)) for device_type, fields in C_SCHEMA.items())
+CONFIG_DECODERS = dict((device_type, Decoder(fields)) for device_type, fields in CONFIG_SCHEMA.items())
+L_DECODERS = dict((device_type, Decoder(fields)) for device_type, fields in L_SCHEMA.items())
@@ -0,0 +1,231 @@
+import argparse
+import base64
+import logging
+import random
+import socket
+import threading
+import time
+
+try:
+    import queue
+    import socketserver
+except ImportError:
+    import Queue as queue
+    import SocketServer as socketserver
+
+from maxcube.generator import SyntheticCube
+from maxcube.programme import DAYS, get_programme
+
+logger = logging.getLogger(__name__)
+
+CMD_SET_TEMPERATURE_MODE = 0x40
+CMD_SET_PROGRAMME = 0x10
+RF_FLAG_IS_ROOM = 0x04
+
+
+class MaxCubeHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        self.server.simulator.register(self.request)
+
+    def finish(self):
+        self.server.simulator.unregister(self.request)
+
+    def handle(self):
+        simulator = self.server.simulator
+        connected = time.time()
+        commands = queue.Queue()
+        reader = threading.Thread(target=self.read_commands, args=(commands,))
+        reader.daemon = True
+        reader.start()
+        try:
+            if not simulator.write(self.request, simulator.greeting(), connected):
+                return
+            while True:
+                received, line = commands.get()
+                if line is None:
+                    break
+                reply = simulator.handle_command(line.decode('utf-8').strip())
+                if reply is None:
+                    break
+                if not simulator.write(self.request, reply, received):
+                    break
+        except socket.error:
+            logger.debug('Client connection closed')
+
+    def read_commands(self, commands):
+        # Time stamps each command on arrival, so the reply latency behaves like
+        # a network round trip and pipelined commands overlap.
+        stream = self.request.makefile('rb')
+        try:
+            for line in iter(stream.readline, b''):
+                commands.put((time.time(), line))
+        except (socket.error, ValueError):
+            logger.debug('Client connection closed')
+        finally:
+            stream.close()
+            commands.put((time.time(), None))
+
+
+class MaxCubeServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class MaxCubeSimulator(object):
+    # Fake cube speaking the H/M/C/L/S line protocol on a local TCP port. The
+    # installation is a maxcube.generator.SyntheticCube whose state s: commands
+    # change. Reply latency, RF duty cycle exhaustion, dropped connections and
+    # partial writes can be configured. Run standalone with
+    #   python -m maxcube.simulator --port 62910 --devices 20 --latency 0.05
+    def __init__(self, synthetic=None, host='127.0.0.1', port=0, latency=0, duty_cycle_cost=0,
+                 duty_cycle_recovery=1, drop_rate=0, chunk_size=0, chunk_delay=0.01, seed=0):
+        self.synthetic = synthetic or SyntheticCube()
+        self.latency = latency
+        # Percent of the RF budget each s: command uses, and how much
+        # recovers per second; commands are rejected once it reaches 100.
+        self.duty_cycle_cost = duty_cycle_cost
+        self.duty_cycle_recovery = duty_cycle_recovery
+        self.duty_cycle = 0.0
+        self.duty_cycle_time = time.time()
+        self.drop_rate = drop_rate
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.random = random.Random(seed)
+        self.commands = []
+        self.connections = []
+        self.lock = threading.Lock()
+        self.server = MaxCubeServer((host, port), MaxCubeHandler)
+        self.server.simulator = self
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.drop_connections()
+
+    def register(self, connection):
+        with self.lock:
+            self.connections.append(connection)
+
+    def unregister(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+
+    def drop_connections(self):
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def greeting(self):
+        with self.lock:
+            self.synthetic.duty_cycle = int(self.current_duty_cycle())
+            return self.synthetic.greeting()
+
+    def current_duty_cycle(self):
+        now = time.time()
+        self.duty_cycle = max(self.duty_cycle - (now - self.duty_cycle_time) * self.duty_cycle_recovery, 0)
+        self.duty_cycle_time = now
+        return self.duty_cycle
+
+    def write(self, connection, reply, received):
+        # Returns False once the connection was dropped on purpose
+        delay = received + self.latency - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        if self.drop_rate and self.random.random() < self.drop_rate:
+            logger.info('Dropping connection')
+            connection.shutdown(socket.SHUT_RDWR)
+            return False
+        data = reply.encode('utf-8')
+        if not self.chunk_size:
+            connection.sendall(data)
+            return True
+        for pos in range(0, len(data), self.chunk_size):
+            connection.sendall(data[pos:pos + self.chunk_size])
+            time.sleep(self.chunk_delay)
+        return True
+
+    def handle_command(self, command):
+        # Returns the reply to send, or None to close the connection
+        with self.lock:
+            self.commands.append(command)
+            if command.startswith('l:'):
+                return self.synthetic.l_message() + '\r\n'
+            if command.startswith('s:'):
+                result = self.apply_command(bytearray(base64.b64decode(command[2:])))
+                self.synthetic.duty_cycle = int(self.duty_cycle)
+                return self.synthetic.s_message(result) + '\r\n'
+            if command.startswith('q:'):
+                return None
+            logger.warning('Command not handled by simulator: %s' % command)
+            return ''
+
+    def apply_command(self, data):
+        if self.current_duty_cycle() + self.duty_cycle_cost > 100:
+            return 1
+        self.duty_cycle += self.duty_cycle_cost
+        rf_address = ''.join('{:02X}'.format(x) for x in data[6:9])
+        room_id = data[9]
+        target = self.synthetic.device_by_rf(rf_address)
+        if target is None:
+            return 1
+        if data[1] & RF_FLAG_IS_ROOM:
+            devices = [device for device in self.synthetic.devices
+                       if device.room_id == room_id and device.has_temperature()]
+        else:
+            devices = [target]
+        if data[2] == CMD_SET_TEMPERATURE_MODE:
+            for device in devices:
+                device.target_temperature = (data[10] & 0x3F) / 2.0
+                device.mode = data[10] >> 6
+            return 0
+        if data[2] == CMD_SET_PROGRAMME:
+            day = DAYS[data[10]]
+            settings = bytes(data[11:11 + (len(data) - 11) // 2 * 2])
+            programme = get_programme(settings)[DAYS[0]]
+            for device in devices:
+                device.programme[day] = programme
+            return 0
+        return 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a simulated MAX! Cube')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=62910)
+    parser.add_argument('--devices', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0, help='seconds before each reply')
+    parser.add_argument('--duty-cycle-cost', type=float, default=0, help='percent per s: command')
+    parser.add_argument('--duty-cycle-recovery', type=float, default=1, help='percent per second')
+    parser.add_argument('--drop-rate', type=float, default=0, help='probability to drop per reply')
+    parser.add_argument('--chunk-size', type=int, default=0, help='split replies into chunks')
+    parser.add_argument('--change', type=float, default=0, help='fraction of devices changed per second')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    simulator = MaxCubeSimulator(SyntheticCube(devices=args.devices), args.host, args.port, args.latency,
+                                 args.duty_cycle_cost, args.duty_cycle_recovery, args.drop_rate,
+                                 args.chunk_size).start()
+    logger.info('Simulated cube listening on %s:%d' % simulator.address)
+    try:
+        while True:
+            time.sleep(1)
+            if args.change:
+                with simulator.lock:
+                    simulator.synthetic.change(args.change)
+    except KeyboardInterrupt:
+        simulator.stop()
@@ -0,0 +1,139 @@
+import base64
+import hashlib
+import json
+import logging
+import os
+
+from maxcube.room import MaxRoom
+from maxcube.schema import C_SCHEMA, CONFIG_DECODERS, M_DEVICE, M_ROOM, as_bytes, as_text
+
+logger = logging.getLogger(__name__)
+
+VERSION = 1
+
+
+def greeting_digest(lines):
+    # Identifies the topology and configuration sent by the cube
+    digest = hashlib.sha1()
+    for line in lines:
+        line = as_bytes(line).strip()
+        if line[:1] in (b'M', b'C'):
+            digest.update(line)
+            digest.update(b'\n')
+    return digest.hexdigest()
+
+
+class MaxCubeSnapshot(object):
+    # On-disk copy of the rooms, devices and C message configuration of a
+    # cube. restore() fills a cube from it before connecting, and on connect
+    # the M and C messages of the greeting are only decoded again when they
+    # differ from the ones the snapshot was taken from (compared by digest,
+    # for the same cube serial and RF address).
+    def __init__(self, path):
+        self.path = path
+        self.serial = None
+        self.rf_address = None
+        self.digest = None
+        # Digest of the greeting parsed in full and not saved yet
+        self.pending_digest = None
+        # True while the cube holds exactly the rooms and devices of the snapshot
+        self.current = False
+
+    def restore(self, cube):
+        try:
+            with open(self.path) as snapshot_file:
+                data = json.load(snapshot_file)
+        except (IOError, OSError, ValueError) as e:
+            logger.info('No usable cube snapshot at %s: %s' % (self.path, e))
+            return False
+        if data.get('version') != VERSION:
+            logger.info('Ignoring cube snapshot %s of version %s' % (self.path, data.get('version')))
+            return False
+        cube.clear()
+        cube.serial = self.serial = data['serial']
+        cube.rf_address = self.rf_address = data['rf_address']
+        cube.firmware_version = data['firmware_version']
+        self.digest = data['digest']
+        for room_data in data['rooms']:
+            room = MaxRoom()
+            for name, _ in M_ROOM:
+                setattr(room, name, room_data[name])
+            cube.add_room(room)
+        for device_data in data['devices']:
+            device = cube.create_device(device_data['type'])
+            if device is None:
+                continue
+            for name in self.device_fields(device_data['type']):
+                setattr(device, name, device_data.get(name))
+            cube.add_device(device)
+            if device_data.get('config'):
+                device.set_config(base64.b64decode(device_data['config']),
+                                  CONFIG_DECODERS.get(device.type))
+        self.current = True
+        logger.info('Restored %d rooms and %d devices from %s'
+                    % (len(cube.rooms), len(cube.devices), self.path))
+        return True
+
+    def filter(self, cube, response):
+        # Returns the part of the greeting that still needs to be parsed
+        if response is None:
+            return response
+        if not isinstance(response, (list, tuple)):
+            response = as_bytes(response).split(b'\n')
+        lines = [as_text(line).strip() for line in response]
+        tokens = [line[2:].split(',') for line in lines if line[:2] == 'H:']
+        if not tokens or len(tokens[0]) < 2:
+            return response
+        serial, rf_address = tokens[0][0], tokens[0][1]
+        if self.serial is not None and (serial, rf_address) != (self.serial, self.rf_address):
+            logger.info('Snapshot %s is of cube %s, connected to %s' % (self.path, self.serial, serial))
+            cube.clear()
+            self.current = False
+        digest = greeting_digest(lines)
+        if self.current and digest == self.digest:
+            return '\n'.join(line for line in lines if line[:1] not in ('M', 'C'))
+        # Parsed in full: the M message replaces the restored rooms and
+        # devices, dropping those the cube no longer lists
+        self.serial, self.rf_address = serial, rf_address
+        self.current = False
+        self.pending_digest = digest
+        return response
+
+    def save(self, cube):
+        # Writes the snapshot if the greeting was parsed in full
+        if self.pending_digest is None:
+            return
+        data = {
+            'version': VERSION,
+            'serial': cube.serial,
+            'rf_address': cube.rf_address,
+            'firmware_version': cube.firmware_version,
+            'digest': self.pending_digest,
+            'rooms': [dict((name, getattr(room, name)) for name, _ in M_ROOM) for room in cube.rooms],
+            'devices': [self.device_data(device) for device in cube.devices],
+        }
+        path = self.path + '.tmp'
+        try:
+            with open(path, 'w') as snapshot_file:
+                json.dump(data, snapshot_file)
+            getattr(os, 'replace', os.rename)(path, self.path)
+        except (IOError, OSError) as e:
+            logger.warning('Could not save cube snapshot to %s: %s' % (self.path, e))
+            return
+        self.digest = self.pending_digest
+        self.pending_digest = None
+        self.current = True
+        logger.info('Saved cube snapshot to %s' % self.path)
+
+    def device_fields(self, device_type):
+        names = [name for name, _ in M_DEVICE]
+        for field in C_SCHEMA.get(device_type, ()):
+            if field.name not in names:
+                names.append(field.name)
+        return names
+
+    def device_data(self, device):
+        data = dict((name, getattr(device, name)) for name in self.device_fields(device.type))
+        if device.config is not None:
+            data['config'] = base64.b64encode(device.config).decode('utf-8')
+        return data
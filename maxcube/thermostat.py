@@ -1,15 +1,23 @@
+from maxcube.device import ConfigField
 from maxcube.wallthermostat import MaxWallThermostat
 
 
 class MaxThermostat(MaxWallThermostat):
+    __slots__ = ('valve_position',)
+    CONFIG_FIELDS = ('temperature_offset', 'window_open_temperature', 'window_open_duration',
+                     'boost_duration', 'boost_valve_position', 'decalcification', 'max_valve_setting',
+                     'valve_offset')
+    FIELDS = MaxWallThermostat.FIELDS + CONFIG_FIELDS + __slots__
+
+    temperature_offset = ConfigField('temperature_offset')
+    window_open_temperature = ConfigField('window_open_temperature')
+    window_open_duration = ConfigField('window_open_duration')
+    boost_duration = ConfigField('boost_duration')
+    boost_valve_position = ConfigField('boost_valve_position')
+    decalcification = ConfigField('decalcification')
+    max_valve_setting = ConfigField('max_valve_setting')
+    valve_offset = ConfigField('valve_offset')
+
     def __init__(self):
         super(MaxThermostat, self).__init__()
-        self.temperature_offset = None
-        self.window_open_temperature = None
-        self.window_open_duration = None
-        self.boost_duration = None
-        self.boost_valve_position = None
-        self.decalcification = None
-        self.max_valve_setting = None
-        self.valve_offset = None
         self.valve_position = None
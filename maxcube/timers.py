@@ -0,0 +1,72 @@
+import datetime
+import logging
+import sched
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def next_time_of_day(hhmm, now=None):
+    # Next local time (epoch seconds, strictly after now) the clock shows
+    # hhmm, given as an int such as 700 for 07:00
+    now = time.time() if now is None else now
+    current = datetime.datetime.fromtimestamp(now)
+    candidate = current.replace(hour=hhmm // 100, minute=hhmm % 100, second=0, microsecond=0)
+    if time.mktime(candidate.timetuple()) <= now:
+        candidate += datetime.timedelta(days=1)
+    return time.mktime(candidate.timetuple())
+
+
+class MaxTimers(object):
+    # Runs actions at their due times from one thread on top of sched, which
+    # sleeps until the next one is due instead of polling. every() repeats
+    # at a fixed rate (a run that took too long skips the missed ones),
+    # daily() at a local time of day, once() a single time (also from other
+    # threads; it runs with the next wake-up at the latest). An action that
+    # raises is logged and stays scheduled.
+    def __init__(self, clock=time.time, sleep=time.sleep):
+        self.clock = clock
+        self.scheduler = sched.scheduler(clock, sleep)
+        self.events = {}
+
+    def every(self, interval, action, first=0):
+        self.schedule(action, self.clock() + first, lambda due: self.next_interval(due, interval))
+
+    def daily(self, hhmm, action):
+        self.schedule(action, next_time_of_day(hhmm, self.clock()), lambda due: next_time_of_day(hhmm, due))
+
+    def once(self, action, delay=0):
+        self.scheduler.enter(delay, 0, self.call, (action,))
+
+    def schedule(self, action, due, following):
+        self.events[action] = self.scheduler.enterabs(due, 0, self.fire, (action, due, following))
+
+    def next_interval(self, due, interval):
+        now = self.clock()
+        due += interval
+        if due <= now:
+            due += ((now - due) // interval + 1) * interval
+        return due
+
+    def call(self, action):
+        try:
+            action()
+        except Exception:
+            logger.exception('Timer action %r failed' % (action,))
+
+    def fire(self, action, due, following):
+        self.call(action)
+        if action in self.events:
+            self.schedule(action, following(due), following)
+
+    def cancel(self, action):
+        event = self.events.pop(action, None)
+        if event is not None:
+            try:
+                self.scheduler.cancel(event)
+            except ValueError:
+                # Running right now, fire() will not schedule it again
+                pass
+
+    def run(self):
+        self.scheduler.run()
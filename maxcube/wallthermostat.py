@@ -1,14 +1,20 @@
-from maxcube.device import MaxDevice
+from maxcube.device import MaxDevice, ConfigField
 
 
 class MaxWallThermostat(MaxDevice):
+    __slots__ = ('comfort_temperature', 'eco_temperature', 'max_temperature', 'min_temperature',
+                 'target_temperature', 'actual_temperature', 'locked', 'mode', 'vacation_until')
+    CONFIG_FIELDS = ('programme',)
+    FIELDS = MaxDevice.FIELDS + __slots__ + CONFIG_FIELDS
+
+    programme = ConfigField('programme')
+
     def __init__(self):
         super(MaxWallThermostat, self).__init__()
         self.comfort_temperature = None
         self.eco_temperature = None
         self.max_temperature = None
         self.min_temperature = None
-        self.programme = None
         self.target_temperature = None
         self.actual_temperature = None
         self.locked = None
@@ -2,6 +2,9 @@ from maxcube.device import MaxDevice
 
 
 class MaxWindowShutter(MaxDevice):
+    __slots__ = ('is_open',)
+    FIELDS = MaxDevice.FIELDS + __slots__
+
     def __init__(self):
         super(MaxWindowShutter, self).__init__()
         self.is_open = None
@@ -1,7 +1,39 @@
+import sys
 import unittest
 import tests.test_cube
+import tests.test_connection
+import tests.test_group
+import tests.test_generator
+import tests.test_simulator
+import tests.test_scheduler
+import tests.test_programmesync
+import tests.test_programme
+import tests.test_snapshot
+import tests.test_metrics
+import tests.test_history
+import tests.test_aggregate
+import tests.test_publisher
+import tests.test_commandworker
+import tests.test_timers
 
 def maxcube_suite():
     loader = unittest.TestLoader()
     suite = loader.loadTestsFromModule(test_cube)
-    return suite
\ No newline at end of file
+    suite.addTests(loader.loadTestsFromModule(test_connection))
+    suite.addTests(loader.loadTestsFromModule(test_group))
+    suite.addTests(loader.loadTestsFromModule(test_generator))
+    suite.addTests(loader.loadTestsFromModule(test_simulator))
+    suite.addTests(loader.loadTestsFromModule(test_scheduler))
+    suite.addTests(loader.loadTestsFromModule(test_programmesync))
+    suite.addTests(loader.loadTestsFromModule(test_programme))
+    suite.addTests(loader.loadTestsFromModule(test_snapshot))
+    suite.addTests(loader.loadTestsFromModule(test_metrics))
+    suite.addTests(loader.loadTestsFromModule(test_history))
+    suite.addTests(loader.loadTestsFromModule(test_aggregate))
+    suite.addTests(loader.loadTestsFromModule(test_publisher))
+    suite.addTests(loader.loadTestsFromModule(test_commandworker))
+    suite.addTests(loader.loadTestsFromModule(test_timers))
+    if sys.version_info >= (3, 6):
+        import tests.test_asynccube
+        suite.addTests(loader.loadTestsFromModule(tests.test_asynccube))
+    return suite
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+from maxcube.connection import MaxCubeConnection
+from maxcube.cube import MaxCube
+from maxcube.device import MAX_DEVICE_MODE_BOOST
+from maxcube.generator import SyntheticCube
+from maxcube.publisher import MaxCubePublisher
+from maxcube.simulator import MaxCubeSimulator
+from maxcube.snapshot import MaxCubeSnapshot
+
+
+class TestMaxCubeAggregates(unittest.TestCase):
+    """ Test the incrementally maintained room and cube figures. """
+
+    def setUp(self):
+        self.simulator = MaxCubeSimulator(SyntheticCube(devices=8)).start()
+        self.connection = MaxCubeConnection(*self.simulator.address)
+        self.cube = MaxCube(self.connection)
+        self.synthetic = self.simulator.synthetic
+
+    def tearDown(self):
+        self.connection.disconnect()
+        self.simulator.stop()
+
+    def valves(self):
+        return [device.valve_position for device in self.cube.devices if device.is_thermostat()]
+
+    def test_room(self):
+        room = self.cube.rooms[0]
+        aggregate = self.cube.aggregates.room(room.id)
+        thermostats = [device for device in self.cube.devices_by_room(room)
+                       if device.is_thermostat() or device.is_wallthermostat()]
+        self.assertTrue(aggregate.has_thermostat)
+        self.assertEqual(max(device.target_temperature for device in thermostats), aggregate.target_temperature)
+        self.assertEqual(min(device.actual_temperature for device in thermostats), aggregate.actual_temperature)
+        self.assertEqual(max(device.valve_position for device in thermostats if device.is_thermostat()),
+                         aggregate.valve_position)
+
+    def test_totals(self):
+        valves = self.valves()
+        totals = self.cube.aggregates.totals()
+        self.assertEqual(len([valve for valve in valves if valve > 0]), totals['open_valves'])
+        self.assertEqual(max(valves), totals['max_valve_position'])
+        self.assertEqual(sum(valves) / len(valves), totals['mean_valve_position'])
+
+    def test_only_changed_room_is_computed_again(self):
+        self.cube.aggregates.totals()
+        untouched = self.cube.aggregates.room(2)
+        self.synthetic.device_by_rf('100000').valve_position = 97
+        self.cube.update()
+        self.assertEqual(set([1]), self.cube.aggregates.dirty)
+        self.assertEqual(97, self.cube.aggregates.totals()['max_valve_position'])
+        self.assertEqual(97, self.cube.aggregates.room(1).valve_position)
+        self.assertIs(untouched, self.cube.aggregates.room(2))
+        self.assertEqual(sum(self.valves()) / len(self.valves()), self.cube.aggregates.mean_valve_position)
+
+    def test_boost_wins(self):
+        device = self.cube.device_by_rf('100000')
+        self.cube.set_device_mode(device, MAX_DEVICE_MODE_BOOST)
+        self.assertEqual(MAX_DEVICE_MODE_BOOST, self.cube.aggregates.room(device.room_id).mode)
+
+    def test_moved_device(self):
+        device = self.cube.device_by_rf('100000')
+        self.cube.set_device_valve_position(device, 99)
+        self.cube.set_device_room_id(device, 2)
+        self.assertEqual(99, self.cube.aggregates.room(2).valve_position)
+        self.assertNotEqual(99, self.cube.aggregates.room(1).valve_position)
+
+    def test_clear(self):
+        self.cube.clear()
+        self.assertEqual(None, self.cube.aggregates.room(1))
+        self.assertEqual(0, self.cube.aggregates.totals()['open_valves'])
+
+    def test_restored_before_l_message(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'cube.json')
+            MaxCube(MaxCubeConnection(*self.simulator.address), snapshot=MaxCubeSnapshot(path)).connection.disconnect()
+            cube = MaxCube(None, auto_init=False)
+            self.assertTrue(MaxCubeSnapshot(path).restore(cube))
+        finally:
+            shutil.rmtree(directory)
+        aggregate = cube.aggregates.room(1)
+        self.assertTrue(aggregate.has_thermostat)
+        self.assertEqual(None, aggregate.target_temperature)
+        self.assertEqual(0, cube.aggregates.totals()['open_valves'])
+        messages = []
+        self.assertEqual(3, MaxCubePublisher(cube, lambda *args: messages.append(args)).publish_all())
@@ -0,0 +1,108 @@
+import asyncio
+import unittest
+from maxcube.asyncconnection import AsyncMaxCubeConnection
+from maxcube.asynccube import AsyncMaxCube
+from maxcube.device import \
+    MAX_DEVICE_MODE_AUTOMATIC, \
+    MAX_DEVICE_MODE_MANUAL
+from tests.test_cube import INIT_RESPONSE_2
+
+GREETING = ''.join(line.strip() + '\r\n' for line in INIT_RESPONSE_2.split('\n') if line.strip())
+L_RESPONSE = 'L:DAoIgewSGAQQAAAA5QYMorL3EhALDi66ChIZACoAAAA=\r\n'
+
+
+class FakeCube(object):
+    def __init__(self):
+        self.commands = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        writer.write(GREETING.encode('utf-8'))
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode('utf-8')
+            self.commands.append(command)
+            if command.startswith('l:'):
+                writer.write(L_RESPONSE.encode('utf-8'))
+            elif command.startswith('s:'):
+                writer.write(b'S:00,0,31\r\n')
+            elif command.startswith('q:'):
+                break
+            await writer.drain()
+        writer.close()
+
+
+class TestAsyncMaxCube(unittest.TestCase):
+    """ Test the asyncio Max! Cube against a local fake cube. """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.fake = FakeCube()
+        port = self.run_async(self.fake.start())
+        self.cube = AsyncMaxCube(AsyncMaxCubeConnection('127.0.0.1', port))
+
+    def tearDown(self):
+        self.run_async(self.cube.connection.disconnect())
+        self.run_async(self.fake.stop())
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(asyncio.wait_for(coroutine, 1))
+
+    def test_init(self):
+        self.run_async(self.cube.init())
+        self.assertEqual('015d2a', self.cube.rf_address)
+        self.assertEqual('01.13', self.cube.firmware_version)
+        self.assertEqual(3, len(self.cube.devices))
+        self.assertEqual(['l:\r\n'], self.fake.commands)
+
+    def test_iter_connect(self):
+        async def kinds():
+            return [kind async for kind in self.cube.iter_connect()]
+        self.assertEqual(b'H', self.run_async(kinds())[0])
+        self.assertEqual(3, len(self.cube.devices))
+        self.assertEqual([], self.fake.commands)
+
+    def test_update(self):
+        self.run_async(self.cube.init())
+        device = self.cube.device_by_rf('0E2EBA')
+        self.assertEqual(MAX_DEVICE_MODE_MANUAL, device.mode)
+        self.assertEqual(21.0, device.target_temperature)
+
+    def test_set_temperature_mode(self):
+        self.run_async(self.cube.init())
+        device = self.cube.device_by_rf('0A0881')
+        result = self.run_async(self.cube.set_temperature_mode(device, 24.5, MAX_DEVICE_MODE_AUTOMATIC))
+        self.assertEqual(True, result)
+        self.assertEqual('s:AARAAAAACgiBAjE=\r\n', self.fake.commands[-1])
+        self.assertEqual(24.5, device.target_temperature)
+        self.assertEqual(MAX_DEVICE_MODE_AUTOMATIC, device.mode)
+
+    def test_set_programme(self):
+        self.run_async(self.cube.init())
+        device = self.cube.device_by_rf('0A0881')
+        programme = [{'temp': 20.5, 'until': '13:30'}, {'temp': 18, 'until': '24:00'}]
+        self.assertEqual(True, self.run_async(self.cube.set_programme(device, 'saturday', programme)))
+        self.assertEqual(True, self.fake.commands[-1].startswith('s:'))
+        self.assertEqual(programme, device.programme['saturday'])
+
+    def test_set_temperature_modes(self):
+        self.run_async(self.cube.init())
+        first = self.cube.device_by_rf('0E2EBA')
+        second = self.cube.device_by_rf('0A0881')
+        results = self.run_async(self.cube.set_temperature_modes(
+            [(first, 19.0, MAX_DEVICE_MODE_MANUAL), (second, 24.5, MAX_DEVICE_MODE_AUTOMATIC)]))
+        self.assertEqual([(first, True), (second, True)], results)
+        self.assertEqual('s:AARAAAAACgiBAjE=\r\n', self.fake.commands[-1])
+        self.assertEqual(19.0, first.target_temperature)
+        self.assertEqual(24.5, second.target_temperature)
@@ -0,0 +1,118 @@
+import os
+import socket
+import threading
+import time
+import unittest
+from maxcube.commandworker import MaxCommandWorker
+
+
+class TestMaxCommandWorker(unittest.TestCase):
+    """ Test the debouncing command worker. """
+
+    def setUp(self):
+        self.handled = []
+        self.results = []
+        self.done = threading.Event()
+
+    def handler(self, key, value):
+        self.handled.append((key, value))
+        result = self.results.pop(0) if self.results else True
+        self.done.set()
+        return result
+
+    def test_coalesces_per_key(self):
+        worker = MaxCommandWorker(self.handler, debounce=60)
+        for value in (19.5, 20.0, 20.5):
+            worker.submit(('room 1', 'temperature'), value)
+        worker.submit(('room 1', 'mode'), 1)
+        worker.submit(('room 2', 'temperature'), 18.0)
+        self.assertEqual(3, len(worker))
+        self.assertTrue(worker.flush())
+        self.assertEqual([(('room 1', 'temperature'), 20.5), (('room 1', 'mode'), 1),
+                          (('room 2', 'temperature'), 18.0)], self.handled)
+        self.assertEqual(0, len(worker))
+
+    def test_debounce(self):
+        worker = MaxCommandWorker(self.handler, debounce=0.1).start()
+        try:
+            start = time.time()
+            worker.submit('key', 1)
+            time.sleep(0.05)
+            worker.submit('key', 2)
+            self.assertTrue(self.done.wait(1))
+            elapsed = time.time() - start
+        finally:
+            worker.stop(1)
+        self.assertEqual([('key', 2)], self.handled)
+        self.assertGreaterEqual(elapsed, 0.15)
+        self.assertLess(elapsed, 0.5)
+
+    def test_submit_returns_while_handling(self):
+        release = threading.Event()
+
+        def slow_handler(key, value):
+            release.wait(1)
+            return self.handler(key, value)
+
+        worker = MaxCommandWorker(slow_handler, debounce=0).start()
+        try:
+            worker.submit('first', 1)
+            time.sleep(0.05)
+            start = time.time()
+            worker.submit('second', 2)
+            self.assertLess(time.time() - start, 0.05)
+            release.set()
+            deadline = time.time() + 1
+            while len(self.handled) < 2 and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            worker.stop(1)
+        self.assertEqual([('first', 1), ('second', 2)], self.handled)
+
+    def test_failure_is_retried(self):
+        now = [0.0]
+        worker = MaxCommandWorker(self.handler, debounce=2, retry_delay=5, clock=lambda: now[0])
+        worker.submit('a', 1)
+        worker.submit('b', 2)
+        self.results = [False]
+        self.assertFalse(worker.flush())
+        self.assertEqual(2, len(worker))
+        self.assertEqual(5, worker.next_delay())
+        now[0] = 4
+        worker.submit('b', 3)
+        now[0] = 5
+        # b was submitted again, so it is debounced from then on
+        self.assertEqual([('a', 1)], worker.take_due())
+        self.assertEqual(1, worker.failed)
+
+    def test_exception_counts_as_failure(self):
+        def failing(key, value):
+            raise IOError('cube gone')
+
+        worker = MaxCommandWorker(failing)
+        worker.submit('a', 1)
+        self.assertFalse(worker.flush())
+        self.assertEqual(1, len(worker))
+
+    def test_connection_error_counts_as_failure(self):
+        def failing(key, value):
+            raise socket.timeout('timed out')
+
+        worker = MaxCommandWorker(failing)
+        worker.submit('a', 1)
+        self.assertFalse(worker.flush())
+        self.assertEqual(1, len(worker))
+
+    def test_other_exception_is_dropped(self):
+        def handler(key, value):
+            if key == 'a':
+                open(os.path.join(os.path.dirname(__file__), 'missing_prog.json'))
+            return self.handler(key, value)
+
+        worker = MaxCommandWorker(handler)
+        worker.submit('a', 1)
+        worker.submit('b', 2)
+        self.assertTrue(worker.flush())
+        self.assertEqual([('b', 2)], self.handled)
+        self.assertEqual(0, len(worker))
+        self.assertEqual(1, worker.dropped)
@@ -0,0 +1,108 @@
+import socket
+import time
+import unittest
+from maxcube.connection import MaxCubeConnection, ReconnectBackoff, expected_reply
+
+
+class TestMaxCubeConnection(unittest.TestCase):
+    """ Test the framed reader of the Max! Cube connection. """
+
+    def setUp(self):
+        self.connection = MaxCubeConnection('localhost', 62910, buffer_size=16)
+        self.connection.socket, self.cube = socket.socketpair()
+        self.connection.socket.settimeout(2)
+
+    def tearDown(self):
+        self.connection.close()
+        self.cube.close()
+
+    def test_expected_reply(self):
+        self.assertEqual(b'L', expected_reply('l:\r\n'))
+        self.assertEqual(b'S', expected_reply('s:AARAAAAABrxTATE=\r\n'))
+        self.assertEqual(None, expected_reply('q:\r\n'))
+
+    def test_read_returns_on_complete_reply(self):
+        self.cube.sendall(b'H:KEQ0566338,0b6475,0113\r\nM:00,01,VgIEAQ==\r\nL:Cwa8U/EaGBsqAOwA\r\n')
+        start = time.time()
+        self.connection.read(b'L')
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual('H:KEQ0566338,0b6475,0113\r\nM:00,01,VgIEAQ==\r\nL:Cwa8U/EaGBsqAOwA\r\n',
+                         self.connection.response)
+
+    def test_read_keeps_lines_as_bytes(self):
+        self.cube.sendall(b'H:KEQ0566338,0b6475,0113\r\nL:Cwa8U/EaGBsqAOwA\r\n')
+        self.connection.read(b'L')
+        self.assertEqual([b'H:KEQ0566338,0b6475,0113\r\n', b'L:Cwa8U/EaGBsqAOwA\r\n'], self.connection.lines)
+        self.assertEqual(None, self.connection.text)
+        self.assertEqual('H:KEQ0566338,0b6475,0113\r\nL:Cwa8U/EaGBsqAOwA\r\n', self.connection.response)
+
+    def test_iter_lines_yields_before_reply_is_complete(self):
+        self.cube.sendall(b'H:KEQ0566338,0b6475,0113\r\n')
+        lines = self.connection.iter_lines(b'L')
+        self.assertEqual(b'H:KEQ0566338,0b6475,0113\r\n', next(lines))
+        self.cube.sendall(b'L:Cwa8U/EaGBsqAOwA\r\n')
+        self.assertEqual(b'L:Cwa8U/EaGBsqAOwA\r\n', next(lines))
+        self.assertEqual([], list(lines))
+        self.assertEqual('H:KEQ0566338,0b6475,0113\r\nL:Cwa8U/EaGBsqAOwA\r\n', self.connection.response)
+
+    def test_read_keeps_bytes_of_next_reply(self):
+        self.cube.sendall(b'S:00,0,31\r\nS:01,1,30\r\n')
+        self.connection.read(b'S')
+        self.assertEqual('S:00,0,31\r\n', self.connection.response)
+        self.connection.read(b'S')
+        self.assertEqual('S:01,1,30\r\n', self.connection.response)
+
+    def test_send(self):
+        self.cube.sendall(b'L:Cwa8U/EaGBsqAOwA\r\n')
+        self.assertEqual(True, self.connection.send('l:\r\n'))
+        self.assertEqual(b'l:\r\n', self.cube.recv(16))
+        self.assertEqual('L:Cwa8U/EaGBsqAOwA\r\n', self.connection.response)
+
+    def test_send_fails_without_reply(self):
+        self.connection.backoff.retry_at = time.time() + 60
+        self.cube.close()
+        self.assertEqual(False, self.connection.send('l:\r\n'))
+        self.assertEqual(None, self.connection.socket)
+        self.assertEqual(0, self.connection.reconnects)
+
+    def test_send_fails_on_cut_off_reply(self):
+        self.connection.backoff.retry_at = time.time() + 60
+        self.connection.socket.settimeout(0.1)
+        self.cube.sendall(b'L:Cwa8U/Ea')
+        self.assertEqual(False, self.connection.send('l:\r\n'))
+        self.assertEqual(None, self.connection.socket)
+
+    def test_alive(self):
+        self.assertEqual(True, self.connection.alive())
+        self.cube.close()
+        self.assertEqual(False, self.connection.alive())
+
+    def test_alive_with_bytes_left_over(self):
+        self.cube.sendall(b'S:00,0,31\r\nS:0')
+        self.connection.read(b'S')
+        self.cube.close()
+        self.assertEqual(False, self.connection.alive())
+
+    def test_send_discards_bytes_left_over(self):
+        self.cube.sendall(b'S:00,0,31\r\nL:Cw')
+        self.connection.read(b'S')
+        self.cube.sendall(b'L:CwrsiAkSGA4ArgA=\r\n')
+        self.assertEqual(True, self.connection.send('l:\r\n'))
+        self.assertEqual('L:CwrsiAkSGA4ArgA=\r\n', self.connection.response)
+
+    def test_backoff(self):
+        now = [100.0]
+        backoff = ReconnectBackoff(initial=1, maximum=10, clock=lambda: now[0], random=lambda: 1.0)
+        self.assertEqual([1, 2, 4, 8, 10, 10], [backoff.failed() for _ in range(6)])
+        self.assertEqual(False, backoff.ready())
+        now[0] += 10
+        self.assertEqual(True, backoff.ready())
+        backoff.succeeded()
+        backoff.random = lambda: 0.0
+        self.assertEqual(0.5, backoff.failed())
+
+    def test_read_partial_line_on_close(self):
+        self.cube.sendall(b'L:Cwa8U/EaGBsqAOwA')
+        self.cube.close()
+        self.connection.read(b'L')
+        self.assertEqual('L:Cwa8U/EaGBsqAOwA', self.connection.response)
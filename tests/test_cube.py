@@ -1,4 +1,8 @@
 import unittest
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from maxcube.connection import MaxCubeConnection
 from maxcube.cube import MaxCube
 from maxcube.device import \
@@ -130,6 +134,44 @@ class TestMaxCube(unittest.TestCase):
         self.assertEqual(17.9, device.actual_temperature)
         self.assertEqual(16.5, device.target_temperature)
 
+    def test_parse_l_message_skips_unchanged_records(self):
+        decoded = self.cube.l_records_decoded
+        skipped = self.cube.l_records_skipped
+        self.cube.parse_l_message('L:Cwa8U/ESGAAiAAAACwa8WgkSGAAiAAAACwa8XAkSGAUiAAAACwirggMSGAUiAAAA')
+        self.cube.parse_l_message('L:Cwa8U/ESGQkhALMACwa8WgkSGAAiAAAACwa8XAkSGAUiAAAACwirggMSGAUiAAAA')
+        self.assertEqual(decoded + 5, self.cube.l_records_decoded)
+        self.assertEqual(skipped + 3, self.cube.l_records_skipped)
+        device = self.cube.devices[0]
+        self.assertEqual(MAX_DEVICE_MODE_MANUAL, device.mode)
+        self.assertEqual(16.5, device.target_temperature)
+
+    def test_subscribe(self):
+        batches = []
+        self.cube.subscribe(batches.append)
+        self.cube.parse_l_message('L:Cwa8U/ESGQkhALMACwa8WgkSGAsqAOcACwa8XAkSGAsqAOcACwirggMaGAAiAAAA')
+        self.assertEqual([], batches)
+        self.cube.publish_changes()
+        self.assertEqual(1, len(batches))
+        changes = dict((event.field, event) for event in batches[0])
+        self.assertEqual(5, len(batches[0]))
+        self.assertEqual(set(['target_temperature', 'actual_temperature', 'mode', 'valve_position']), set(changes))
+        self.assertEqual(self.cube.devices[0], changes['mode'].device)
+        self.assertEqual(MAX_DEVICE_MODE_AUTOMATIC, changes['mode'].old_value)
+        self.assertEqual(MAX_DEVICE_MODE_MANUAL, changes['mode'].new_value)
+        self.cube.publish_changes()
+        self.assertEqual(1, len(batches))
+
+    def test_subscribe_queue(self):
+        changes = queue.Queue()
+        self.cube.subscribe(changes)
+        self.cube.parse_l_message('L:Cwa8U/ESGQkhALMACwa8WgkSGAsqAOcACwa8XAkSGAsqAOcACwirggMaGAAiAAAA')
+        self.cube.publish_changes()
+        self.assertEqual(5, len(changes.get_nowait()))
+        self.cube.unsubscribe(changes)
+        self.cube.parse_l_message('L:Cwa8U/EaGBsqAOwACwa8WgkSGCMqAOcACwa8XAkSGAsqAOcACwirggMaGAAiAAAA')
+        self.cube.publish_changes()
+        self.assertEqual(True, changes.empty())
+
     def test_resolve_device_mode(self):
         self.assertEqual(MAX_DEVICE_MODE_AUTOMATIC, self.cube.resolve_device_mode(24))
         self.assertEqual(MAX_DEVICE_MODE_MANUAL, self.cube.resolve_device_mode(25))
@@ -184,6 +226,62 @@ class TestMaxCubeExtended(unittest.TestCase):
         device = self.cube.devices[2]
         self.assertEqual(1, device.initialized)
 
+    def test_parse_c_message_thermostat_settings(self):
+        device = self.cube.devices[0]
+        self.assertEqual('KEQ1086437', device.serial)
+        self.assertEqual(0.0, device.temperature_offset)
+        self.assertEqual(12.0, device.window_open_temperature)
+        self.assertEqual(15, device.window_open_duration)
+        self.assertEqual(5, device.boost_duration)
+        self.assertEqual(80, device.boost_valve_position)
+        self.assertEqual('saturday 12:00', device.decalcification)
+        self.assertEqual(100.0, device.max_valve_setting)
+        self.assertEqual(0.0, device.valve_offset)
+
+    def test_parse_c_message_wall_thermostat_programme(self):
+        device = self.cube.devices[1]
+        self.assertEqual(
+            device.programme['monday'],
+            [
+                {'temp': 17.0, 'until': '06:00'},
+                {'temp': 21.0, 'until': '09:00'},
+                {'temp': 17.0, 'until': '17:00'},
+                {'temp': 21.0, 'until': '23:00'},
+                {'temp': 17.0, 'until': '24:00'}
+            ]
+        )
+
+    def test_parse_c_message_config_is_lazy(self):
+        device = self.cube.devices[0]
+        message = [line.strip() for line in INIT_RESPONSE_2.split('\n') if line.strip().startswith('C:0e2eba')][0]
+        self.cube.parse_c_message(message)
+        self.assertEqual(None, device.config_values)
+        self.assertEqual(21.5, device.comfort_temperature)
+        self.assertEqual(None, device.config_values)
+        self.assertEqual(12.0, device.window_open_temperature)
+        self.assertEqual(12.0, device.config_values['window_open_temperature'])
+
+    def test_parse_c_message_invalidates_config(self):
+        device = self.cube.devices[1]
+        events = []
+        self.cube.subscribe(events.extend)
+        device.programme['monday'] = []
+        message = [line.strip() for line in INIT_RESPONSE_2.split('\n') if line.strip().startswith('C:0a0881')][0]
+        self.cube.parse_c_message(message)
+        self.assertEqual([], device.programme['monday'])
+        self.cube.parse_c_message(message[:-8] + 'BxgA')
+        self.cube.publish_changes()
+        self.assertEqual(['config'], [event.field for event in events])
+        self.assertEqual(17.0, device.programme['monday'][0]['temp'])
+
+    def test_parse_response_bytes_and_lines(self):
+        for response in (INIT_RESPONSE_2.encode('utf-8'), INIT_RESPONSE_2.encode('utf-8').split(b'\n')):
+            cube = MaxCube(MaxCubeConnectionMock(None), auto_init=False)
+            cube.parse_response(response)
+            self.assertEqual('015d2a', cube.rf_address)
+            self.assertEqual([device.to_dict() for device in self.cube.devices],
+                             [device.to_dict() for device in cube.devices])
+
     def test_parse_h_message(self):
         self.cube.parse_h_message('H:KEQ0566338,0b6444,0113,00000000,335b04d2,33,32,0f0c1d,101c,03,0000')
         self.assertEqual('0b6444', self.cube.rf_address)
@@ -326,6 +424,19 @@ class TestMaxCubeExtended(unittest.TestCase):
         devices = self.cube.devices_by_room(room)
         self.assertEqual(0, len(devices))
 
+    def test_devices_by_room_after_move(self):
+        device = self.cube.device_by_rf('0CA2B2')
+        self.cube.set_device_room_id(device, 2)
+        self.assertEqual(1, len(self.cube.devices_by_room(self.cube.room_by_id(1))))
+        self.assertEqual(2, len(self.cube.devices_by_room(self.cube.room_by_id(2))))
+
+    def test_remove_device(self):
+        device = self.cube.device_by_rf('0CA2B2')
+        self.cube.remove_device(device)
+        self.assertEqual(None, self.cube.device_by_rf('0CA2B2'))
+        self.assertEqual(1, len(self.cube.devices_by_room(self.cube.room_by_id(1))))
+        self.assertEqual(2, len(self.cube.devices))
+
     def test_get_rooms(self):
         rooms = self.cube.get_rooms()
 
@@ -379,3 +490,9 @@ class TestMaxCubeExtended(unittest.TestCase):
                 {'until': '24:00', 'temp': 8}
             ]
         )
+
+    def test_get_window_shutter_as_dict(self):
+        result = self.cube.device_by_rf('0CA2B2').to_dict()
+        self.assertEqual(result['name'], 'Fensterkontakt')
+        self.assertEqual(result['is_open'], False)
+        self.assertEqual('programme' in result, False)
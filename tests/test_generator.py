@@ -0,0 +1,92 @@
+import unittest
+from maxcube.cube import MaxCube
+from maxcube.generator import SyntheticCube
+from maxcube.device import MAX_WINDOW_SHUTTER
+
+
+class TestSyntheticCube(unittest.TestCase):
+    """ Test that generated cube traffic decodes to the generated state. """
+
+    def assertDecoded(self, synthetic, cube):
+        self.assertEqual(len(synthetic.devices), len(cube.devices))
+        self.assertEqual(len(synthetic.rooms), len(cube.rooms))
+        for expected in synthetic.devices:
+            device = cube.device_by_rf(expected.rf_address)
+            self.assertEqual(expected.type, device.type)
+            self.assertEqual(expected.room_id, device.room_id)
+            self.assertEqual(expected.serial, device.serial)
+            self.assertEqual(expected.name, device.name)
+            if expected.has_temperature():
+                self.assertEqual(expected.mode, device.mode)
+                self.assertEqual(expected.target_temperature, device.target_temperature)
+                self.assertAlmostEqual(expected.actual_temperature, device.actual_temperature)
+                self.assertEqual(expected.programme, device.programme)
+            if expected.type == MAX_WINDOW_SHUTTER:
+                self.assertEqual(expected.is_open, device.is_open)
+
+    def test_greeting(self):
+        synthetic = SyntheticCube(devices=10)
+        cube = MaxCube(None, auto_init=False)
+        cube.parse_response(synthetic.greeting())
+        self.assertEqual('0b6475', cube.rf_address)
+        self.assertDecoded(synthetic, cube)
+
+    def test_more_devices_than_one_m_message_holds(self):
+        synthetic = SyntheticCube(devices=300)
+        self.assertEqual(2, len(synthetic.m_messages()))
+        cube = MaxCube(None, auto_init=False)
+        cube.parse_response(synthetic.greeting())
+        self.assertDecoded(synthetic, cube)
+
+    def test_removed_devices_and_rooms(self):
+        synthetic = SyntheticCube(devices=8)
+        cube = MaxCube(None, auto_init=False)
+        cube.parse_response(synthetic.greeting())
+        synthetic.devices = [device for device in synthetic.devices if device.room_id == 1]
+        synthetic.rooms = synthetic.rooms[:1]
+        cube.parse_response(synthetic.greeting())
+        self.assertDecoded(synthetic, cube)
+        self.assertEqual(4, len(cube.devices))
+        self.assertEqual(None, cube.device_by_rf('100004'))
+        self.assertEqual(None, cube.room_by_id(2))
+
+    def test_removed_devices_across_m_messages(self):
+        synthetic = SyntheticCube(devices=300)
+        cube = MaxCube(None, auto_init=False)
+        cube.parse_response(synthetic.greeting())
+        synthetic.devices = synthetic.devices[:250]
+        cube.parse_response(synthetic.greeting())
+        self.assertDecoded(synthetic, cube)
+
+    def test_m_message_changes_are_published(self):
+        synthetic = SyntheticCube(devices=8)
+        cube = MaxCube(None, auto_init=False)
+        cube.parse_response(synthetic.greeting())
+        events = []
+        cube.subscribe(events.extend)
+        synthetic.devices[0].name = 'Renamed'
+        synthetic.devices[1].room_id = 2
+        cube.parse_response(synthetic.greeting())
+        cube.publish_changes()
+        self.assertEqual([('100000', 'name', 'Thermostat 0', 'Renamed'), ('100001', 'room_id', 1, 2)],
+                         [(event.device.rf_address, event.field, event.old_value, event.new_value)
+                          for event in events])
+        self.assertEqual(2, cube.device_by_rf('100001').room_id)
+
+    def test_l_message_after_change(self):
+        synthetic = SyntheticCube(devices=20)
+        cube = MaxCube(None, auto_init=False)
+        cube.parse_response(synthetic.greeting())
+        synthetic.change(0.5)
+        cube.parse_response(synthetic.l_message())
+        self.assertDecoded(synthetic, cube)
+        self.assertEqual(30, cube.l_records_decoded)
+
+    def test_s_message(self):
+        synthetic = SyntheticCube()
+        synthetic.duty_cycle = 0x64
+        cube = MaxCube(None, auto_init=False)
+        cube.parse_response(synthetic.s_message(command_result=1))
+        self.assertEqual(100, cube.duty_cycle)
+        self.assertEqual(1, cube.command_result)
+        self.assertEqual(0x32, cube.memory_slots)
@@ -0,0 +1,69 @@
+import threading
+import time
+import unittest
+from maxcube.cube import MaxCube
+from maxcube.group import MaxCubeGroup
+from tests.test_cube import MaxCubeConnectionMock, INIT_RESPONSE_1, INIT_RESPONSE_2
+
+
+class CubeStub(object):
+    def __init__(self, delay=0, error=None):
+        self.rf_address = '000000'
+        self.delay = delay
+        self.error = error
+        self.updates = 0
+        self.release = threading.Event()
+
+    def update(self):
+        if self.delay:
+            self.release.wait(self.delay)
+        self.updates += 1
+        if self.error:
+            raise self.error
+        return True
+
+
+class TestMaxCubeGroup(unittest.TestCase):
+    """ Test polling several Max! Cubes as a group. """
+
+    def test_merged_view(self):
+        group = MaxCubeGroup()
+        group.add('house', MaxCube(MaxCubeConnectionMock(INIT_RESPONSE_1)))
+        group.add('garage', MaxCube(MaxCubeConnectionMock(INIT_RESPONSE_2)))
+        devices = group.devices()
+        self.assertEqual(7, len(devices))
+        self.assertEqual('Fensterkontakt', devices[('garage', '0CA2B2')].name)
+        self.assertEqual('Kitchen', group.room_by_id('house', 1).name)
+        self.assertEqual('Badezimmer', group.room_by_id('garage', 1).name)
+        self.assertEqual(None, group.device_by_rf('house', '0CA2B2'))
+        self.assertEqual(6, len(group.rooms()))
+
+    def test_slow_cube_does_not_stall_others(self):
+        slow = CubeStub(delay=5)
+        fast = CubeStub()
+        group = MaxCubeGroup([('slow', slow), ('fast', fast)])
+        try:
+            start = time.time()
+            self.assertEqual(['fast'], group.update(timeout=0.2))
+            self.assertEqual(['fast'], group.update(timeout=0.2))
+            self.assertLess(time.time() - start, 2)
+            self.assertEqual(2, fast.updates)
+            health = group.get_health()
+            self.assertEqual(True, health['slow']['busy'])
+            self.assertEqual(1, health['slow']['skipped_cycles'])
+            self.assertEqual(True, health['fast']['online'])
+        finally:
+            slow.release.set()
+            group.close()
+
+    def test_failing_cube_health(self):
+        group = MaxCubeGroup([('dead', CubeStub(error=IOError('Connection refused'))), ('ok', CubeStub())])
+        try:
+            self.assertEqual(['ok'], group.update(timeout=1))
+            group.update(timeout=1)
+            health = group.get_health()['dead']
+            self.assertEqual(False, health['online'])
+            self.assertEqual(2, health['consecutive_failures'])
+            self.assertEqual('Connection refused', health['last_error'])
+        finally:
+            group.close()
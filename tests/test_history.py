@@ -0,0 +1,95 @@
+import unittest
+from maxcube.connection import MaxCubeConnection
+from maxcube.cube import MaxCube
+from maxcube.generator import SyntheticCube
+from maxcube.history import MaxCubeHistory
+from maxcube.simulator import MaxCubeSimulator
+from maxcube.thermostat import MaxThermostat
+from maxcube.windowshutter import MaxWindowShutter
+
+
+def thermostat(rf_address='100000'):
+    device = MaxThermostat()
+    device.rf_address = rf_address
+    device.type = 1
+    device.target_temperature = 21.0
+    device.actual_temperature = 20.5
+    device.valve_position = 0
+    return device
+
+
+class TestMaxCubeHistory(unittest.TestCase):
+    """ Test the per device telemetry ring buffers. """
+
+    def test_interval(self):
+        history = MaxCubeHistory(capacity=10, interval=60)
+        device = thermostat()
+        self.assertTrue(history.record(device, 0))
+        self.assertFalse(history.record(device, 30))
+        device.valve_position = 40
+        self.assertTrue(history.record(device, 40))
+        self.assertTrue(history.record(device, 100))
+        times, values = history.series('100000', 'valve_position')
+        self.assertEqual([0, 40, 100], list(times))
+        self.assertEqual([0, 40, 40], list(values))
+
+    def test_ring_buffer_is_bounded(self):
+        history = MaxCubeHistory(capacity=4, interval=1)
+        device = thermostat()
+        for timestamp in range(10):
+            device.actual_temperature = 18 + timestamp / 2.0
+            history.record(device, timestamp)
+        nbytes = history.nbytes()
+        times, values = history.series('100000', 'actual_temperature')
+        self.assertEqual([6, 7, 8, 9], list(times))
+        self.assertEqual([21.0, 21.5, 22.0, 22.5], list(values))
+        for timestamp in range(10, 100):
+            history.record(device, timestamp)
+        self.assertEqual(nbytes, history.nbytes())
+
+    def test_range_query(self):
+        history = MaxCubeHistory(capacity=8, interval=1)
+        device = thermostat()
+        for timestamp in range(12):
+            history.record(device, timestamp)
+        times, _ = history.series('100000', 'target_temperature', start=5, end=9)
+        self.assertEqual([5, 6, 7, 8], list(times))
+        self.assertEqual(0, len(history.series('100000', 'target_temperature', start=20)[0]))
+        self.assertEqual(([], []), history.series('999999', 'target_temperature'))
+
+    def test_downsample(self):
+        history = MaxCubeHistory(capacity=100, interval=1)
+        device = thermostat()
+        for timestamp in range(20):
+            device.actual_temperature = 18 + timestamp % 10
+            device.valve_position = None if timestamp < 10 else timestamp
+            history.record(device, timestamp)
+        self.assertEqual([(0, 18.0, 22.5, 27.0), (10, 18.0, 22.5, 27.0)],
+                         history.downsample('100000', 'actual_temperature', 10))
+        # Unknown values are left out
+        self.assertEqual([(10, 10.0, 12.0, 14.0)], history.downsample('100000', 'valve_position', 5, end=15))
+
+    def test_only_thermostats(self):
+        shutter = MaxWindowShutter()
+        shutter.rf_address = '100001'
+        shutter.type = 4
+        history = MaxCubeHistory()
+        self.assertFalse(history.record(shutter, 0))
+        self.assertNotIn('100001', history)
+
+    def test_filled_from_l_messages(self):
+        simulator = MaxCubeSimulator(SyntheticCube(devices=8)).start()
+        connection = MaxCubeConnection(*simulator.address)
+        try:
+            cube = MaxCube(connection, history=MaxCubeHistory(interval=0))
+            simulator.synthetic.device_by_rf('100000').valve_position = 42
+            cube.update()
+        finally:
+            connection.disconnect()
+            simulator.stop()
+        # Thermostats and wall thermostats, not the window shutters
+        self.assertEqual(['100000', '100002', '100003', '100004', '100006', '100007'], sorted(cube.history.devices))
+        _, values = cube.history.series('100000', 'valve_position')
+        self.assertEqual(42, values[-1])
+        # Greeting, update on init and the update above
+        self.assertEqual(3, len(values))
@@ -0,0 +1,67 @@
+import unittest
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+from maxcube.connection import MaxCubeConnection
+from maxcube.cube import MaxCube
+from maxcube.device import MAX_DEVICE_MODE_MANUAL
+from maxcube.generator import SyntheticCube
+from maxcube.metrics import Histogram, MaxCubeMetrics, start_exporter
+from maxcube.simulator import MaxCubeSimulator
+
+
+class TestMaxCubeMetrics(unittest.TestCase):
+    """ Test the opt-in instrumentation against the simulated cube. """
+
+    def setUp(self):
+        self.simulator = MaxCubeSimulator(SyntheticCube(devices=8)).start()
+        host, port = self.simulator.address
+        self.metrics = MaxCubeMetrics()
+        self.connection = MaxCubeConnection(host, port, metrics=self.metrics)
+        self.cube = MaxCube(self.connection, metrics=self.metrics)
+
+    def tearDown(self):
+        self.connection.disconnect()
+        self.simulator.stop()
+
+    def test_histogram(self):
+        histogram = Histogram((1, 10))
+        for value in (0.5, 1, 5, 50):
+            histogram.observe(value)
+        self.assertEqual([(1, 2), (10, 3), (float('inf'), 4)], histogram.cumulative())
+        self.assertEqual(4, histogram.count)
+        self.assertEqual(56.5, histogram.sum)
+        self.assertEqual(50, histogram.max)
+
+    def test_collect(self):
+        device = self.cube.device_by_rf('100000')
+        self.assertTrue(self.cube.set_temperature_mode(device, 22.0, MAX_DEVICE_MODE_MANUAL))
+        data = self.metrics.collect()
+        self.assertEqual(2, data['commands'])
+        self.assertEqual(0, data['failures'])
+        self.assertEqual(1, data['latency']['l']['count'])
+        self.assertEqual(1, data['latency']['s']['count'])
+        # One C message for the cube itself and one per device
+        self.assertEqual(9, data['parse_time']['C']['count'])
+        self.assertEqual(2, data['parse_time']['L']['count'])
+        self.assertGreater(data['bytes_in'], data['bytes_out'])
+        self.assertEqual([0], [value for _, value in data['duty_cycle']])
+        self.assertEqual(0, data['reconnects'])
+
+    def test_reconnects(self):
+        self.simulator.drop_connections()
+        self.assertTrue(self.cube.update())
+        self.assertEqual(1, self.metrics.collect()['reconnects'])
+
+    def test_prometheus_exporter(self):
+        self.cube.update()
+        server = start_exporter(self.metrics, port=0)
+        try:
+            text = urlopen('http://%s:%d/metrics' % server.server_address[:2]).read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('maxcube_commands_total 2\n', text)
+        self.assertIn('maxcube_latency_count{command="l"} 2\n', text)
+        self.assertIn('maxcube_parse_time_bucket{message="M",le="+Inf"} 1\n', text)
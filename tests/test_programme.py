@@ -0,0 +1,31 @@
+import unittest
+from maxcube.programme import get_programme, programme_bytes, temp_and_time
+
+
+class TestProgramme(unittest.TestCase):
+    """ Test the weekly programme codec. """
+
+    def test_get_programme(self):
+        data = bytearray.fromhex('4049 4c6e 4079 4c8f 4120') + bytearray(16) + bytearray.fromhex('4120') * 13
+        programme = get_programme(bytes(data))
+        self.assertEqual(['saturday', 'sunday'], sorted(programme.keys()))
+        self.assertEqual([{'temp': 16.0, 'until': '06:05'}, {'temp': 19.0, 'until': '09:10'},
+                          {'temp': 16.0, 'until': '10:05'}, {'temp': 19.0, 'until': '11:55'},
+                          {'temp': 16.0, 'until': '24:00'}], programme['saturday'])
+        self.assertEqual([{'temp': 16.0, 'until': '24:00'}], programme['sunday'])
+
+    def test_temp_and_time(self):
+        self.assertEqual('52a2', temp_and_time(20.5, '13:30'))
+        self.assertEqual('4920', temp_and_time(18, '24:00'))
+        self.assertEqual('4920', temp_and_time('18', '24:00'))
+        self.assertEqual('5a', temp_and_time(0, '07:30'))
+        self.assertRaises(AssertionError, temp_and_time, 32.5, '10:00')
+        self.assertRaises(AssertionError, temp_and_time, 20.2, '10:00')
+        self.assertRaises(AssertionError, temp_and_time, 20, '10:02')
+
+    def test_round_trip(self):
+        programme = {}
+        for n, day in enumerate(['saturday', 'sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday']):
+            programme[day] = [{'temp': 5.0 + n, 'until': '%02d:%02d' % (n + 5, n * 5)},
+                              {'temp': 30.5, 'until': '24:00'}]
+        self.assertEqual(programme, get_programme(programme_bytes(programme)))
@@ -0,0 +1,134 @@
+import copy
+import json
+import unittest
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+from maxcube.connection import MaxCubeConnection
+from maxcube.cube import MaxCube
+from maxcube.generator import SyntheticCube
+from maxcube.programmesync import ProgrammeSync
+from maxcube.simulator import MaxCubeSimulator
+
+HOLIDAY = [{'temp': 18.0, 'until': '08:00'}, {'temp': 21.0, 'until': '22:00'}, {'temp': 17.0, 'until': '24:00'}]
+
+
+class TestProgrammeSync(unittest.TestCase):
+    """ Test the minimal frame programme upload against the simulated cube. """
+
+    def setUp(self):
+        self.simulator = MaxCubeSimulator(SyntheticCube(devices=8)).start()
+        host, port = self.simulator.address
+        self.connection = MaxCubeConnection(host, port)
+        self.cube = MaxCube(self.connection)
+        self.thermostats = [device for device in self.cube.devices
+                            if device.is_thermostat() or device.is_wallthermostat()]
+
+    def tearDown(self):
+        self.connection.disconnect()
+        self.simulator.stop()
+
+    def desired(self, days, devices=None):
+        desired = {}
+        for device in devices or self.thermostats:
+            programme = copy.deepcopy(device.programme)
+            for day in days:
+                programme[day] = HOLIDAY
+            desired[device.rf_address] = programme
+        return desired
+
+    def test_unchanged_sends_nothing(self):
+        sync = ProgrammeSync(self.cube, self.desired([]))
+        self.assertEqual([], sync.frames)
+        self.assertTrue(sync.run(self.cube.send_command))
+
+    def test_room_frames(self):
+        sync = ProgrammeSync(self.cube, self.desired(['saturday', 'sunday']))
+        # One frame per room and day instead of one per thermostat and day
+        self.assertEqual(4, len(sync.frames))
+        self.assertTrue(all(frame.room for frame in sync.frames))
+        self.assertTrue(sync.run(self.cube.send_command))
+        for device in self.thermostats:
+            self.assertEqual(HOLIDAY, device.programme['sunday'])
+            self.assertEqual(HOLIDAY, self.simulator.synthetic.device_by_rf(device.rf_address).programme['sunday'])
+
+    def test_device_frames(self):
+        device = self.thermostats[0]
+        sync = ProgrammeSync(self.cube, self.desired(['monday'], [device]))
+        self.assertEqual(1, len(sync.frames))
+        self.assertFalse(sync.frames[0].room)
+        self.assertTrue(sync.run(self.cube.send_command))
+        self.assertEqual(HOLIDAY, self.simulator.synthetic.device_by_rf(device.rf_address).programme['monday'])
+        other = self.simulator.synthetic.device_by_rf(self.thermostats[1].rf_address)
+        self.assertNotEqual(HOLIDAY, other.programme['monday'])
+
+    def test_resume_after_failure(self):
+        self.simulator.duty_cycle_cost = 60
+        self.simulator.duty_cycle_recovery = 0
+        sync = ProgrammeSync(self.cube, self.desired(['saturday', 'sunday']))
+        self.assertFalse(sync.run(self.cube.send_command))
+        self.assertEqual(1, sync.position)
+        self.assertEqual(3, len(sync.remaining()))
+        self.assertNotEqual(HOLIDAY, self.thermostats[0].programme['sunday'])
+
+        self.simulator.duty_cycle_cost = 0
+        self.assertTrue(sync.run(self.cube.send_command))
+        self.assertTrue(sync.done)
+        self.assertEqual(HOLIDAY, self.thermostats[0].programme['sunday'])
+
+    def test_no_room_frame_over_unknown_programme(self):
+        self.thermostats[0].programme = None
+        sync = ProgrammeSync(self.cube, self.desired(['sunday'], self.thermostats[1:]))
+        # Room 1 has a thermostat with an unknown programme, room 2 does not
+        self.assertEqual([False, False, True], [frame.room for frame in sync.frames])
+        self.assertTrue(sync.run(self.cube.send_command))
+        self.assertEqual(None, self.thermostats[0].programme)
+        synthetic = self.simulator.synthetic.device_by_rf(self.thermostats[0].rf_address)
+        self.assertNotEqual(HOLIDAY, synthetic.programme['sunday'])
+
+    def test_thermostat_without_programme(self):
+        device = self.thermostats[0]
+        device.programme = None
+        sync = ProgrammeSync(self.cube, {device.rf_address: {'friday': HOLIDAY, 'sunday': HOLIDAY}})
+        self.assertEqual([(device, 'sunday', False), (device, 'friday', False)],
+                         [(frame.device, frame.day, frame.room) for frame in sync.frames])
+        self.assertTrue(sync.run(self.cube.send_command))
+        self.assertEqual({'friday': HOLIDAY, 'sunday': HOLIDAY}, device.programme)
+        self.assertEqual(HOLIDAY, self.simulator.synthetic.device_by_rf(device.rf_address).programme['friday'])
+
+    def test_config_for_thermostat_without_programme(self):
+        config = json.loads(self.cube.devices_as_json())
+        self.thermostats[0].programme = None
+        for device_config in config:
+            if device_config.get('programme'):
+                device_config['programme']['friday'] = HOLIDAY
+        self.assertTrue(self.cube.set_programmes_from_config(StringIO(json.dumps(config))))
+        for device in self.thermostats:
+            self.assertEqual(HOLIDAY, self.simulator.synthetic.device_by_rf(device.rf_address).programme['friday'])
+            self.assertEqual(HOLIDAY, device.programme['friday'])
+
+    def test_room_frame_updates_every_reached_device(self):
+        sync = ProgrammeSync(self.cube, self.desired(['sunday']))
+        frame = sync.frames[0]
+        self.assertTrue(frame.room)
+        self.assertEqual([device for device in self.thermostats if device.room_id == frame.device.room_id],
+                         frame.devices)
+
+    def test_thermostat_without_room(self):
+        device = self.thermostats[0]
+        self.cube.move_device(device, 0)
+        sync = ProgrammeSync(self.cube, self.desired(['monday'], [device]))
+        self.assertEqual([device], [frame.device for frame in sync.frames])
+        self.assertFalse(sync.frames[0].room)
+
+    def test_set_programmes_from_config(self):
+        config = json.loads(self.cube.devices_as_json())
+        for device_config in config:
+            if device_config.get('programme'):
+                device_config['programme']['friday'] = HOLIDAY
+        self.assertTrue(self.cube.set_programmes_from_config(StringIO(json.dumps(config))))
+        # One room frame per room
+        self.assertEqual(2, len([command for command in self.simulator.commands if command.startswith('s:')]))
+        for device in self.thermostats:
+            self.assertEqual(HOLIDAY, self.simulator.synthetic.device_by_rf(device.rf_address).programme['friday'])
@@ -0,0 +1,117 @@
+import json
+import unittest
+from maxcube.connection import MaxCubeConnection
+from maxcube.cube import MaxCube
+from maxcube.generator import SyntheticCube
+from maxcube.publisher import MaxCubePublisher, MAX_DEVICE_MODE_HOME
+from maxcube.simulator import MaxCubeSimulator
+
+
+class TestMaxCubePublisher(unittest.TestCase):
+    """ Test the cached JSON room payloads. """
+
+    def setUp(self):
+        self.simulator = MaxCubeSimulator(SyntheticCube(devices=8)).start()
+        self.connection = MaxCubeConnection(*self.simulator.address)
+        self.cube = MaxCube(self.connection)
+        self.messages = []
+
+    def tearDown(self):
+        self.connection.disconnect()
+        self.simulator.stop()
+
+    def publish(self, topic, payload, qos):
+        self.messages.append((topic, json.loads(payload), qos))
+
+    def publisher(self, **kwargs):
+        publisher = MaxCubePublisher(self.cube, self.publish, **kwargs)
+        publisher.publish_changes()
+        del self.messages[:]
+        return publisher
+
+    def change_valve(self, rf_address, valve_position):
+        self.simulator.synthetic.device_by_rf(rf_address).valve_position = valve_position
+        self.cube.update()
+
+    def test_first_round_publishes_everything(self):
+        publisher = MaxCubePublisher(self.cube, self.publish)
+        self.assertEqual(3, publisher.publish_changes())
+        self.assertEqual(['eq3/maxcube/room/1', 'eq3/maxcube/room/2', 'eq3/maxcube/global'],
+                         [topic for topic, _, _ in self.messages])
+        payload = self.messages[0][1]
+        self.assertEqual('1', payload['room_id'])
+        self.assertEqual(str(self.cube.aggregates.room(1).valve_position), payload['valve_pos'])
+
+    def test_only_changed_rooms(self):
+        publisher = self.publisher()
+        self.assertEqual(0, publisher.publish_changes())
+        self.change_valve('100000', 97)
+        self.assertEqual(2, publisher.publish_changes())
+        self.assertEqual([('eq3/maxcube/room/1', '97', 1), ('eq3/maxcube/global', '97', 1)],
+                         [(topic, payload.get('valve_pos', payload.get('max_valve_pos')), qos)
+                          for topic, payload, qos in self.messages])
+
+    def test_unchanged_payload_is_not_sent(self):
+        publisher = self.publisher()
+        self.cube.room_by_id(2).set_changed()
+        self.assertEqual(0, publisher.publish_changes())
+
+    def test_deltas(self):
+        texts = []
+        publisher = MaxCubePublisher(self.cube, lambda topic, text, qos: texts.append((topic, text, qos)),
+                                     deltas=True)
+        publisher.publish_changes()
+        self.assertIn(('eq3/maxcube/room/1/room_name', 'Room 1', 1), texts)
+        del texts[:]
+        self.change_valve('100000', 97)
+        publisher.publish_changes()
+        self.assertEqual(('eq3/maxcube/room/1/valve_pos', '97', 1), texts[0])
+        self.assertEqual('97', json.loads(texts[1][1])['valve_pos'])
+
+    def test_group(self):
+        publisher = self.publisher(group=True)
+        self.change_valve('100000', 97)
+        self.change_valve('100004', 98)
+        self.assertEqual(2, publisher.publish_changes())
+        topic, payload, _ = self.messages[0]
+        self.assertEqual('eq3/maxcube/rooms', topic)
+        self.assertEqual(['1', '2'], sorted(payload))
+        self.assertEqual('98', payload['2']['valve_pos'])
+
+    def test_publish_all(self):
+        publisher = self.publisher(refresh_qos=0)
+        self.assertEqual(3, publisher.publish_all())
+        self.assertEqual([0, 0, 0], [qos for _, _, qos in self.messages])
+
+    def test_day_comfort(self):
+        publisher = self.publisher()
+        room = self.cube.room_by_id(1)
+        room.day_comfort = True
+        room.set_changed()
+        publisher.publish_changes()
+        self.assertEqual(str(MAX_DEVICE_MODE_HOME), self.messages[0][1]['mode'])
+
+    def test_wire_format(self):
+        publisher = MaxCubePublisher(self.cube, self.publish)
+        aggregate = self.cube.aggregates.room(1)
+        self.simulator.synthetic.device_by_rf('100001').is_open = False
+        self.cube.update()
+        publisher.publish_changes()
+        payload = self.messages[0][1]
+        self.assertEqual(['room_id', 'room_name', 'mode', 'target_temperature', 'actual_temperature',
+                          'battery', 'valve_pos', 'is_open'], list(payload))
+        self.assertEqual(str(aggregate.mode), payload['mode'])
+        self.assertEqual(str(aggregate.target_temperature), payload['target_temperature'])
+        self.assertEqual('0', payload['is_open'])
+        cube_payload = self.messages[-1][1]
+        self.assertEqual(str(self.cube.aggregates.open_valves), cube_payload['open_valves'])
+        self.assertEqual(str(self.cube.aggregates.mean_valve_position), cube_payload['mean_valve_pos'])
+
+    def test_off_temperature(self):
+        publisher = self.publisher()
+        for device in self.simulator.synthetic.devices:
+            if device.room_id == 1 and device.has_temperature():
+                device.target_temperature = 4.5
+        self.cube.update()
+        publisher.publish_changes()
+        self.assertEqual('OFF', self.messages[0][1]['target_temperature'])
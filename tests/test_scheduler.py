@@ -0,0 +1,138 @@
+import unittest
+from maxcube.connection import MaxCubeConnection
+from maxcube.cube import MaxCube
+from maxcube.device import MAX_DEVICE_MODE_MANUAL
+from maxcube.generator import SyntheticCube
+from maxcube.scheduler import MaxCommandScheduler, PRIORITY_HIGH, PRIORITY_LOW
+from maxcube.simulator import MaxCubeSimulator
+
+
+class TestMaxCommandScheduler(unittest.TestCase):
+    """ Test the duty cycle aware command scheduler against the simulated cube. """
+
+    def setUp(self):
+        self.simulator = MaxCubeSimulator(SyntheticCube(devices=8), duty_cycle_cost=30,
+                                          duty_cycle_recovery=0).start()
+        host, port = self.simulator.address
+        self.connection = MaxCubeConnection(host, port)
+        self.cube = MaxCube(self.connection)
+        self.now = 1000.0
+        self.scheduler = MaxCommandScheduler(self.cube, duty_cycle_limit=50, retry_delay=10,
+                                             clock=lambda: self.now)
+        self.thermostats = [device for device in self.cube.devices if device.is_thermostat()]
+
+    def tearDown(self):
+        self.connection.disconnect()
+        self.simulator.stop()
+
+    def synthetic(self, device):
+        return self.simulator.synthetic.device_by_rf(device.rf_address)
+
+    def test_priority_order(self):
+        self.simulator.duty_cycle_cost = 0
+        low = self.scheduler.set_temperature_mode(self.thermostats[0], 20.0, MAX_DEVICE_MODE_MANUAL,
+                                                  priority=PRIORITY_LOW)
+        high = self.scheduler.set_temperature_mode(self.thermostats[1], 21.0, MAX_DEVICE_MODE_MANUAL,
+                                                   priority=PRIORITY_HIGH)
+        self.assertEqual(2, len(self.scheduler))
+        self.assertEqual(None, self.scheduler.run_pending())
+        self.assertEqual([high.command.strip(), low.command.strip()], self.simulator.commands[-2:])
+        self.assertEqual(True, low.success)
+        self.assertEqual(20.0, self.thermostats[0].target_temperature)
+
+    def test_same_key_replaces_queued_command(self):
+        self.scheduler.set_temperature_mode(self.thermostats[0], 20.0, MAX_DEVICE_MODE_MANUAL)
+        self.scheduler.set_temperature_mode(self.thermostats[0], 22.0, MAX_DEVICE_MODE_MANUAL)
+        self.assertEqual(1, len(self.scheduler))
+        self.scheduler.run_pending()
+        self.assertEqual(1, self.scheduler.sent)
+        self.assertEqual(22.0, self.synthetic(self.thermostats[0]).target_temperature)
+
+    def test_paced_by_duty_cycle(self):
+        results = []
+        for thermostat in self.thermostats:
+            self.scheduler.set_temperature_mode(thermostat, 23.0, MAX_DEVICE_MODE_MANUAL,
+                                                callback=lambda entry, success: results.append(success))
+        # 30% per command: the second one reaches the limit, the rest wait
+        self.assertEqual(10, self.scheduler.run_pending())
+        self.assertEqual([True, True], results)
+        self.assertEqual(60, self.cube.duty_cycle)
+        self.assertEqual(len(self.thermostats) - 2, len(self.scheduler))
+
+        # A high priority command still goes out above the limit
+        self.scheduler.set_temperature_mode(self.thermostats[-1], 24.0, MAX_DEVICE_MODE_MANUAL,
+                                            priority=PRIORITY_HIGH)
+        self.scheduler.resume_at = 0
+        self.scheduler.run_pending()
+        self.assertEqual(24.0, self.synthetic(self.thermostats[-1]).target_temperature)
+
+    def test_rejected_command_is_retried(self):
+        self.scheduler.duty_cycle_limit = 100
+        entries = [self.scheduler.set_temperature_mode(thermostat, 10.5, MAX_DEVICE_MODE_MANUAL)
+                   for thermostat in self.thermostats[:4]]
+        self.assertEqual(10, self.scheduler.run_pending())
+        self.assertEqual(1, self.scheduler.rejected)
+        self.assertEqual(1, self.cube.command_result)
+        self.assertEqual([True, True, True, None], [entry.success for entry in entries])
+        self.assertEqual(1, entries[3].attempts)
+
+        self.now += 5
+        self.assertEqual(5, self.scheduler.run_pending())
+        self.simulator.duty_cycle = 0
+        self.now += 5
+        self.assertEqual(None, self.scheduler.run_pending())
+        self.assertEqual(0, len(self.scheduler))
+        self.assertEqual(True, entries[3].success)
+        self.assertEqual(2, entries[3].attempts)
+        self.assertEqual(10.5, self.thermostats[3].target_temperature)
+
+    def test_gives_up_after_max_attempts(self):
+        self.scheduler.duty_cycle_limit = 100
+        self.scheduler.max_attempts = 1
+        self.simulator.duty_cycle = 100
+        entry = self.scheduler.set_temperature_mode(self.thermostats[0], 23.0, MAX_DEVICE_MODE_MANUAL)
+        self.scheduler.run_pending()
+        self.assertEqual(False, entry.success)
+        self.assertEqual(0, len(self.scheduler))
+
+    def test_programme_applied_once_accepted(self):
+        self.scheduler.duty_cycle_limit = 101
+        self.simulator.duty_cycle = 100
+        device = self.thermostats[0]
+        before = list(device.programme['saturday'])
+        programme = [{'temp': 20.5, 'until': '13:30'}, {'temp': 18.0, 'until': '24:00'}]
+        entry = self.scheduler.set_programme(device, 'saturday', programme)
+        self.assertEqual(before, device.programme['saturday'])
+
+        self.scheduler.run_pending()
+        self.assertEqual(None, entry.success)
+        self.assertEqual(before, device.programme['saturday'])
+
+        self.simulator.duty_cycle = 0
+        self.now += 10
+        self.assertEqual(None, self.scheduler.run_pending())
+        self.assertEqual(True, entry.success)
+        self.assertEqual(programme, device.programme['saturday'])
+        self.assertEqual(programme, self.synthetic(device).programme['saturday'])
+        self.assertEqual(None, self.scheduler.set_programme(device, 'saturday', programme))
+
+    def test_replaced_while_sent_still_calls_back(self):
+        self.simulator.duty_cycle_cost = 0
+        results = []
+        thermostat = self.thermostats[0]
+        send_command = self.cube.send_command
+
+        def send_and_replace(command):
+            self.cube.send_command = send_command
+            self.scheduler.set_temperature_mode(thermostat, 22.0, MAX_DEVICE_MODE_MANUAL,
+                                                callback=lambda entry, success: results.append(('second', success)))
+            return send_command(command)
+
+        self.cube.send_command = send_and_replace
+        first = self.scheduler.set_temperature_mode(thermostat, 20.0, MAX_DEVICE_MODE_MANUAL,
+                                                    callback=lambda entry, success: results.append(('first', success)))
+        self.assertEqual(None, self.scheduler.run_pending())
+        self.assertEqual([('first', True), ('second', True)], results)
+        self.assertEqual(True, first.success)
+        self.assertEqual(22.0, thermostat.target_temperature)
+        self.assertEqual(0, len(self.scheduler))
@@ -0,0 +1,164 @@
+import time
+import unittest
+from maxcube.connection import MaxCubeConnection
+from maxcube.cube import MaxCube
+from maxcube.device import MAX_DEVICE_MODE_MANUAL
+from maxcube.generator import SyntheticCube
+from maxcube.simulator import MaxCubeSimulator
+
+
+class TestMaxCubeSimulator(unittest.TestCase):
+    """ Test MaxCube end to end against the simulated cube. """
+
+    def start(self, **kwargs):
+        self.simulator = MaxCubeSimulator(SyntheticCube(devices=8), **kwargs).start()
+        host, port = self.simulator.address
+        self.connection = MaxCubeConnection(host, port)
+        self.cube = MaxCube(self.connection)
+
+    def tearDown(self):
+        self.connection.disconnect()
+        self.simulator.stop()
+
+    def test_init(self):
+        self.start()
+        self.assertEqual('KEQ0566338', self.cube.serial)
+        self.assertEqual(8, len(self.cube.devices))
+        self.assertEqual(2, len(self.cube.rooms))
+        device = self.cube.device_by_rf('100000')
+        self.assertEqual(self.simulator.synthetic.devices[0].target_temperature, device.target_temperature)
+
+    def test_iter_connect(self):
+        self.start()
+        self.cube.clear()
+        devices = {}
+        for kind in self.cube.iter_connect():
+            devices.setdefault(kind, len(self.cube.devices))
+        self.assertEqual([b'C', b'H', b'L', b'M'], sorted(devices))
+        # All devices are known before the first C message is decoded
+        self.assertEqual(8, devices[b'C'])
+        self.assertEqual(self.simulator.synthetic.devices[0].target_temperature,
+                         self.cube.device_by_rf('100000').target_temperature)
+
+    def test_connect_again_skips_known_topology(self):
+        self.start()
+        self.assertNotEqual(None, self.cube.topology_digest)
+        device = self.cube.device_by_rf('100000')
+        self.simulator.synthetic.devices[0].target_temperature = 25.5
+        self.cube.connect()
+        self.assertIs(device, self.cube.device_by_rf('100000'))
+        self.assertEqual(25.5, device.target_temperature)
+
+    def test_update_latency(self):
+        self.start(latency=0.05)
+        start = time.time()
+        self.assertTrue(self.cube.update())
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_set_temperature_mode(self):
+        self.start()
+        device = self.cube.device_by_rf('100000')
+        self.assertTrue(self.cube.set_temperature_mode(device, 22.5, MAX_DEVICE_MODE_MANUAL))
+        synthetic = self.simulator.synthetic.device_by_rf('100000')
+        self.assertEqual(22.5, synthetic.target_temperature)
+        self.assertEqual(MAX_DEVICE_MODE_MANUAL, synthetic.mode)
+        self.cube.update()
+        self.assertEqual(22.5, device.target_temperature)
+
+    def test_set_programme(self):
+        self.start()
+        device = self.cube.device_by_rf('100000')
+        programme = [{'temp': 20.5, 'until': '08:00'}, {'temp': 18.0, 'until': '24:00'}]
+        self.assertTrue(self.cube.set_programme(device, 'monday', programme))
+        self.assertEqual(programme, self.simulator.synthetic.device_by_rf('100000').programme['monday'])
+
+    def test_set_temperature_modes(self):
+        self.start(latency=0.05)
+        thermostats = [device for device in self.cube.devices if device.is_thermostat()]
+        window = self.cube.device_by_rf('100001')
+        changes = [(thermostat, 23.0, MAX_DEVICE_MODE_MANUAL) for thermostat in thermostats]
+        changes.insert(1, (window, 23.0, MAX_DEVICE_MODE_MANUAL))
+        start = time.time()
+        results = self.cube.set_temperature_modes(changes, max_in_flight=4)
+        # Pipelined: well below one round trip per command
+        self.assertLess(time.time() - start, 0.05 * len(thermostats))
+        self.assertEqual([(device, device is not window) for device, _, _ in changes], results)
+        for thermostat in thermostats:
+            self.assertEqual(23.0, thermostat.target_temperature)
+            self.assertEqual(23.0, self.simulator.synthetic.device_by_rf(thermostat.rf_address).target_temperature)
+
+    def test_set_temperature_modes_partial_failure(self):
+        self.start(duty_cycle_cost=40, duty_cycle_recovery=0)
+        thermostats = [device for device in self.cube.devices if device.is_thermostat()]
+        changes = [(thermostat, 23.0, MAX_DEVICE_MODE_MANUAL) for thermostat in thermostats]
+        results = self.cube.set_temperature_modes(changes)
+        self.assertEqual([True, True] + [False] * (len(thermostats) - 2), [success for _, success in results])
+        self.assertEqual(23.0, thermostats[1].target_temperature)
+        self.assertNotEqual(23.0, self.simulator.synthetic.device_by_rf(thermostats[2].rf_address).target_temperature)
+
+    def test_set_temperature_modes_dropped_connection(self):
+        self.start()
+        self.simulator.drop_rate = 1
+        thermostat = self.cube.device_by_rf('100000')
+        results = self.cube.set_temperature_modes([(thermostat, 23.0, MAX_DEVICE_MODE_MANUAL)])
+        self.assertEqual([(thermostat, False)], results)
+
+    def test_set_temperature_modes_after_idle_close(self):
+        self.start()
+        thermostats = [device for device in self.cube.devices if device.is_thermostat()]
+        self.simulator.drop_connections()
+        results = self.cube.set_temperature_modes([(thermostat, 23.0, MAX_DEVICE_MODE_MANUAL)
+                                                   for thermostat in thermostats])
+        self.assertEqual([(thermostat, True) for thermostat in thermostats], results)
+        self.assertEqual(1, self.connection.reconnects)
+        for thermostat in thermostats:
+            self.assertEqual(23.0, self.simulator.synthetic.device_by_rf(thermostat.rf_address).target_temperature)
+
+    def test_duty_cycle_exhausted(self):
+        self.start(duty_cycle_cost=60, duty_cycle_recovery=0)
+        device = self.cube.device_by_rf('100000')
+        self.assertTrue(self.cube.set_temperature_mode(device, 21.0, MAX_DEVICE_MODE_MANUAL))
+        self.assertFalse(self.cube.set_temperature_mode(device, 23.0, MAX_DEVICE_MODE_MANUAL))
+        self.assertEqual(1, self.cube.command_result)
+        self.assertEqual(60, self.cube.duty_cycle)
+        self.assertEqual(21.0, self.simulator.synthetic.device_by_rf('100000').target_temperature)
+
+    def test_partial_writes(self):
+        self.start(chunk_size=7, chunk_delay=0.001)
+        self.assertEqual(8, len(self.cube.devices))
+        self.assertTrue(self.cube.update())
+
+    def test_dropped_connection_reconnects(self):
+        self.start()
+        self.simulator.drop_connections()
+        self.simulator.synthetic.device_by_rf('100000').valve_position = 42
+        time.sleep(0.1)
+        for _ in range(3):
+            self.cube.update()
+        self.assertEqual(42, self.cube.device_by_rf('100000').valve_position)
+
+    def test_reconnect_keeps_topology(self):
+        self.start()
+        device = self.cube.device_by_rf('100000')
+        self.simulator.drop_connections()
+        self.simulator.synthetic.device_by_rf('100000').valve_position = 42
+        time.sleep(0.1)
+        self.assertTrue(self.cube.update())
+        self.assertEqual(1, self.connection.reconnects)
+        self.assertEqual(42, device.valve_position)
+        self.assertIs(device, self.cube.device_by_rf('100000'))
+        # One l: on init and one after reconnecting
+        self.assertEqual(2, len([command for command in self.simulator.commands if command.startswith('l:')]))
+
+    def test_reconnect_backs_off(self):
+        self.start()
+        self.connection.backoff.random = lambda: 1.0
+        self.simulator.stop()
+        self.simulator.drop_connections()
+        time.sleep(0.1)
+        self.assertFalse(self.cube.update())
+        self.assertEqual(1, self.connection.reconnects)
+        # Still backing off: no new connection attempt
+        self.assertFalse(self.cube.update())
+        self.assertEqual(1, self.connection.reconnects)
+        self.assertGreater(self.connection.backoff.remaining(), 0.5)
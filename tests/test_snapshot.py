@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+from maxcube.connection import MaxCubeConnection
+from maxcube.cube import MaxCube
+from maxcube.generator import SyntheticCube
+from maxcube.simulator import MaxCubeSimulator
+from maxcube.snapshot import MaxCubeSnapshot
+
+
+class TestMaxCubeSnapshot(unittest.TestCase):
+    """ Test the warm start snapshot against the simulated cube. """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cube.json')
+        self.synthetic = SyntheticCube(devices=8)
+        self.simulator = MaxCubeSimulator(self.synthetic).start()
+        self.connections = []
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.disconnect()
+        self.simulator.stop()
+        shutil.rmtree(self.directory)
+
+    def new_cube(self):
+        snapshot = MaxCubeSnapshot(self.path)
+        connection = MaxCubeConnection(*self.simulator.address)
+        self.connections.append(connection)
+        return MaxCube(connection, snapshot=snapshot), snapshot
+
+    def test_saved_on_first_start(self):
+        cube, snapshot = self.new_cube()
+        self.assertTrue(os.path.exists(self.path))
+        self.assertTrue(snapshot.current)
+        self.assertEqual(8, len(cube.devices))
+
+    def test_restore_without_connecting(self):
+        self.new_cube()
+        cube = MaxCube(None, auto_init=False)
+        self.assertTrue(MaxCubeSnapshot(self.path).restore(cube))
+        self.assertEqual('0b6475', cube.rf_address)
+        self.assertEqual(2, len(cube.rooms))
+        self.assertEqual(8, len(cube.devices))
+        device = cube.device_by_rf('100000')
+        self.assertEqual('Thermostat 0', device.name)
+        self.assertEqual(21.0, device.comfort_temperature)
+        self.assertEqual(self.synthetic.devices[0].programme, device.programme)
+        self.assertEqual(4, len(cube.devices_by_room(cube.room_by_id(2))))
+
+    def test_unchanged_greeting_skips_m_and_c(self):
+        self.new_cube()
+        snapshot = MaxCubeSnapshot(self.path)
+        cube = MaxCube(None, auto_init=False)
+        snapshot.restore(cube)
+        remaining = snapshot.filter(cube, self.synthetic.greeting())
+        self.assertEqual(['H', 'L'], sorted(line[:1] for line in remaining.split('\n') if line))
+
+        cube, snapshot = self.new_cube()
+        self.assertTrue(snapshot.current)
+        self.assertEqual(self.synthetic.devices[0].target_temperature,
+                         cube.device_by_rf('100000').target_temperature)
+
+    def test_changed_configuration_is_parsed_and_saved(self):
+        self.new_cube()
+        self.synthetic.devices[0].name = 'Renamed'
+        self.synthetic.devices[0].comfort_temperature = 22.5
+        cube, snapshot = self.new_cube()
+        self.assertEqual('Renamed', cube.device_by_rf('100000').name)
+        self.assertEqual(22.5, cube.device_by_rf('100000').comfort_temperature)
+
+        cube = MaxCube(None, auto_init=False)
+        MaxCubeSnapshot(self.path).restore(cube)
+        self.assertEqual('Renamed', cube.device_by_rf('100000').name)
+
+    def test_removed_devices_are_dropped(self):
+        self.new_cube()
+        self.synthetic.devices = self.synthetic.devices[:4]
+        cube, snapshot = self.new_cube()
+        self.assertEqual(4, len(cube.devices))
+        self.assertEqual(None, cube.device_by_rf('100004'))
+        self.assertEqual([], cube.devices_by_room(cube.room_by_id(2)))
+
+        cube = MaxCube(None, auto_init=False)
+        MaxCubeSnapshot(self.path).restore(cube)
+        self.assertEqual(4, len(cube.devices))
+
+    def test_init_again_keeps_restored_devices(self):
+        self.new_cube()
+        cube, snapshot = self.new_cube()
+        device = cube.device_by_rf('100000')
+        cube.init()
+        self.assertIs(device, cube.device_by_rf('100000'))
+        self.assertEqual(8, len(cube.devices))
+
+    def test_iter_connect_streams_with_snapshot(self):
+        self.new_cube()
+        snapshot = MaxCubeSnapshot(self.path)
+        connection = MaxCubeConnection(*self.simulator.address)
+        self.connections.append(connection)
+        cube = MaxCube(connection, auto_init=False, snapshot=snapshot)
+        snapshot.restore(cube)
+        device = cube.device_by_rf('100000')
+        kinds = list(cube.iter_connect())
+        self.assertEqual([b'H', b'M'], kinds[:2])
+        self.assertEqual(b'L', kinds[-1])
+        self.assertIs(device, cube.device_by_rf('100000'))
+        self.assertEqual(self.synthetic.devices[0].target_temperature, device.target_temperature)
+
+    def test_other_cube_discards_snapshot(self):
+        self.new_cube()
+        self.synthetic.serial = 'KEQ9999999'
+        self.synthetic.devices = self.synthetic.devices[:4]
+        cube, snapshot = self.new_cube()
+        self.assertEqual('KEQ9999999', cube.serial)
+        self.assertEqual(4, len(cube.devices))
+
+    def test_missing_snapshot(self):
+        cube = MaxCube(None, auto_init=False)
+        self.assertFalse(MaxCubeSnapshot(os.path.join(self.directory, 'missing.json')).restore(cube))
+        self.assertEqual([], cube.devices)
@@ -0,0 +1,99 @@
+import datetime
+import time
+import unittest
+from maxcube.timers import MaxTimers, next_time_of_day
+
+
+def local(year, month, day, hour, minute, second=0):
+    return time.mktime(datetime.datetime(year, month, day, hour, minute, second).timetuple())
+
+
+class FakeClock(object):
+    def __init__(self, now):
+        self.now = now
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestMaxTimers(unittest.TestCase):
+    """ Test the sched based timers of the daemon. """
+
+    def setUp(self):
+        self.clock = FakeClock(local(2021, 3, 1, 6, 59, 58))
+        self.timers = MaxTimers(self.clock.time, self.clock.sleep)
+        self.fired = []
+
+    def test_next_time_of_day(self):
+        self.assertEqual(local(2021, 3, 1, 7, 0), next_time_of_day(700, local(2021, 3, 1, 6, 59, 59)))
+        # Exactly at the boundary the next one is a day later
+        self.assertEqual(local(2021, 3, 2, 7, 0), next_time_of_day(700, local(2021, 3, 1, 7, 0)))
+        self.assertEqual(local(2021, 3, 2, 0, 30), next_time_of_day(30, local(2021, 3, 1, 18, 0)))
+
+    def test_every_sleeps_until_due(self):
+        def poll():
+            self.fired.append(self.clock.now)
+            if len(self.fired) == 3:
+                self.timers.cancel(poll)
+
+        self.timers.every(1, poll)
+        self.timers.run()
+        start = local(2021, 3, 1, 6, 59, 58)
+        self.assertEqual([start, start + 1, start + 2], self.fired)
+        # Only sleeps, no polling in between
+        self.assertEqual([1, 1], [seconds for seconds in self.clock.sleeps if seconds])
+
+    def test_every_skips_missed_runs(self):
+        def slow():
+            self.fired.append(self.clock.now)
+            self.clock.now += 2.5
+            if len(self.fired) == 2:
+                self.timers.cancel(slow)
+
+        self.timers.every(1, slow)
+        self.timers.run()
+        start = local(2021, 3, 1, 6, 59, 58)
+        self.assertEqual([start, start + 3], self.fired)
+
+    def test_daily_fires_once_at_boundary(self):
+        def begin():
+            self.fired.append(datetime.datetime.fromtimestamp(self.clock.now))
+            self.timers.cancel(begin)
+
+        def poll():
+            if self.fired:
+                self.timers.cancel(poll)
+
+        self.timers.every(1, poll)
+        self.timers.daily(700, begin)
+        self.timers.run()
+        self.assertEqual([datetime.datetime(2021, 3, 1, 7, 0)], self.fired)
+
+    def test_failing_action_stays_scheduled(self):
+        def failing():
+            self.fired.append(self.clock.now)
+            if len(self.fired) == 2:
+                self.timers.cancel(failing)
+            raise ValueError('broken')
+
+        self.timers.every(5, failing)
+        self.timers.run()
+        self.assertEqual(2, len(self.fired))
+
+    def test_once(self):
+        def poll():
+            self.fired.append(('poll', self.clock.now))
+            if len(self.fired) == 1:
+                self.timers.once(lambda: self.fired.append(('once', self.clock.now)))
+            else:
+                self.timers.cancel(poll)
+
+        self.timers.every(1, poll)
+        self.timers.run()
+        start = local(2021, 3, 1, 6, 59, 58)
+        self.assertEqual([('poll', start), ('once', start), ('poll', start + 1)], self.fired)